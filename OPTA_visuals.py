@@ -12,25 +12,23 @@ import matplotlib.patches as patches
 import chart_studio.plotly as py
 import chart_studio.tools as tls
 import Tracking_Visuals as vis
+import Tracking_Arrays as ta
+import Tracking_Batch as batch
 import data_utils as utils
 from itertools import combinations
 import random
 
 
 def get_all_matches():
-    # get all matches in a range (for testing)
-    ids = np.arange(984455, 984635)
+    # get all matches in a range (for testing), read in parallel. Matches that can't be read are reported and skipped
+    ids = [int(i) for i in np.arange(984455, 984635)]
     # fpath = "/Users/laurieshaw/Documents/Football/Data/TrackingData/Tracab/SuperLiga/All/"
     fpath = "../OPTA/"
-    matches = []
-    for i in ids:
-        try:
-            match_OPTA = opta.read_OPTA_f7(fpath, str(i))
-            match_OPTA = opta.read_OPTA_f24(fpath, str(i), match_OPTA)
-            matches.append(match_OPTA)
-            print(i)
-        except:
-            print("error in %d" % (i))
+    results, failures = batch.process_matches(
+        batch.opta_match_task, ids, args=(fpath,))
+    for i in sorted(failures.keys()):
+        print("error in %d:\n%s" % (i, failures[i]))
+    matches = [results[i] for i in ids if i in results]
     return matches
 
 
@@ -866,6 +864,8 @@ def Generate_Tracab_Chance_Videos(match_OPTA, match_tb, frames_tb):
     t_init_buf = 0.5
     t_end_buf = 0.1
     match_end = frames_tb[-1].timestamp
+    # (half, time) -> frame lookup, built once for all the shots
+    time_index = ta.get_time_index(frames_tb, match_tb)
     all_shots = [e for e in match_OPTA.hometeam.events if e.is_shot] + \
         [e for e in match_OPTA.awayteam.events if e.is_shot]
     for shot in all_shots:
@@ -874,7 +874,7 @@ def Generate_Tracab_Chance_Videos(match_OPTA, match_tb, frames_tb):
                                       45*(shot.period_id-1) - t_init_buf))
         tend = (shot.period_id, min(match_end, shot.time -
                                     45*(shot.period_id-1) + t_end_buf))
-        frames_in_segment = vis.get_frames_between_timestamps(
-            frames_tb, match_tb, tstart, tend)
+        fstart, fend = time_index.frame_range(tstart, tend)
+        frames_in_segment = frames_tb[fstart:fend]
         vis.save_match_clip(frames_in_segment, match_tb, fpath=match_OPTA.fpath+'/chances/',
                             fname=shot.shot_id, include_player_velocities=False, description=shot.shot_descriptor)
@@ -7,9 +7,9 @@ Module for reading Tracab data and constructing frame and player objects, and ca
 @author: laurieshaw
 """
 
-from bs4 import BeautifulSoup
 import datetime as dt
 import numpy as np
+import Tracking_Arrays as ta
 import Tracking_Velocities as vel
 import xml.etree.ElementTree as ET
 
@@ -36,36 +36,29 @@ def get_tracabdata_paths(fpath, fname, league='EPL'):
 
 
 def read_tracab_match(fmetadata):
-    # get meta data
-    f = open(fmetadata, "r")
-    metadata = f.read()
-    # deal with xml markup (BS might be overkill here)
-    soup = BeautifulSoup(metadata, 'xml')
-    match_attributes = soup.match.attrs
+    # get meta data: the attributes of the match element and of each period that was played
+    # the file is parsed incrementally and parsing stops at the end of the match element
+    match_attributes = None
     period_attributes = {}
-    # navigate through the file to extract the info that we need
-    for p in soup.find_all('period'):
-        if p.attrs['iEndFrame'] > p.attrs['iStartFrame']:
-            period_attributes[int(p.attrs['iId'])] = p.attrs
+    with open(fmetadata, 'rb') as fp:
+        for event, elem in ET.iterparse(fp, events=('start', 'end')):
+            if event == 'start' and elem.tag == 'match':
+                match_attributes = dict(elem.attrib)
+            elif event == 'end' and elem.tag == 'period':
+                if int(elem.attrib['iEndFrame']) > int(elem.attrib['iStartFrame']):
+                    period_attributes[int(elem.attrib['iId'])] = dict(elem.attrib)
+                elem.clear()
+            elif event == 'end' and elem.tag == 'match':
+                break
+    if match_attributes is None:
+        raise ValueError("no match element in %s" % (fmetadata))
     match = tracab_match(match_attributes, period_attributes)
     return match
 
 
 def read_tracab_match_xml(fmetadata):
-    # get meta data
-    tree = ET.parse(fmetadata)
-    root = tree.getroot()
-
-    match_attributes = root.getchildren()[0].attrib
-
-    period_attributes = {}
-    temp = root.getchildren()[0].getchildren()
-    # navigate through the file to extract the info that we need
-    for t in temp:
-        if int(t.attrib['iEndFrame']) > int(t.attrib['iStartFrame']):
-            period_attributes[int(t.attrib['iId'])] = t.attrib
-    match = tracab_match(match_attributes, period_attributes)
-    return match
+    # same as read_tracab_match (kept for scripts that use this name)
+    return read_tracab_match(fmetadata)
 
 
 def read_tracab_match_data(league, fpath, fname, team1_exclude=None, team0_exclude=None, during_match_only=True, verbose=False):
@@ -77,29 +70,7 @@ def read_tracab_match_data(league, fpath, fname, team1_exclude=None, team0_exclu
     # now read in tracking data
     if verbose:
         print("Reading match tracking data")
-    frames = []
-    with open(fdata, "r") as fp:
-        for f in fp:  # go through line by line and break down data in individual players and the ball
-            # each line is a single frame
-            chunks = f.split(':')[:-1]  # last element is carriage return
-            if len(chunks) > 3:
-                print(chunks)
-            assert len(chunks) <= 3
-            frameid = int(chunks[0])
-            frame = tracab_frame(frameid)
-            # now get players
-            targets = chunks[1].split(';')
-            assert targets[-1] == ''
-            for target in targets[:-1]:
-                target = target.split(',')
-                team = int(target[0])
-                if team in [1, 0, 3]:
-                    frame.add_frame_target(target)
-            if len(chunks) > 2:  # is this never the case?
-                frame.add_frame_ball(chunks[2].split(';')[0].split(','))
-            frames.append(frame)
-    # sort the frames by frameid (they should be sorted anyway, but just to make sure)
-    frames = sorted(frames, key=lambda x: x.frameid)
+    frames = read_tracab_frames(fdata)
     # timestamp frames
     if verbose:
         print("Timestamping frames")
@@ -109,13 +80,10 @@ def read_tracab_match_data(league, fpath, fname, team1_exclude=None, team0_exclu
     if during_match_only:  # remove pre-match, post-match and half-time frames
         frames = frames[match.period_attributes[1]['iStart']:match.period_attributes[1]['iEnd'] +
                         1] + frames[match.period_attributes[2]['iStart']:match.period_attributes[2]['iEnd']+1]
-        match.period_attributes[1]['iEnd'] = match.period_attributes[1]['iEnd'] - \
-            match.period_attributes[1]['iStart']
-        match.period_attributes[1]['iStart'] = 0
-        match.period_attributes[2]['iEnd'] = match.period_attributes[2]['iEnd'] - \
-            match.period_attributes[2]['iStart'] + \
-            match.period_attributes[1]['iEnd']
-        match.period_attributes[2]['iStart'] = match.period_attributes[1]['iEnd']+1
+        period = [frame.period for frame in frames]
+        timestamp = [frame.timestamp for frame in frames]
+        set_period_indices(period, timestamp, match)
+        match.time_index = ta.frame_time_index(period, timestamp, frames)
     # identify which way each team is shooting
     set_parity(frames, match)
     # get player objects and calculate ball and player & team com velocity
@@ -134,6 +102,315 @@ def read_tracab_match_data(league, fpath, fname, team1_exclude=None, team0_exclu
     return frames, match, team1_players, team0_players
 
 
+def read_tracab_match_arrays(league, fpath, fname, team1_exclude=None, team0_exclude=None, during_match_only=True, verbose=False,
+                             player_window=7, player_polyorder=1, player_maxspeed=14, ball_window=5, ball_polyorder=3, ball_maxspeed=40):
+    # as read_tracab_match_data, but the frames are returned in a Tracking_Arrays.tracking_arrays store and velocities are
+    # measured with the array filters in Tracking_Velocities. See iter_tracab_frames for a streaming version
+    fmetadata, fdata = get_tracabdata_paths(fpath, fname, league)
+    if verbose:
+        print("Reading match metadata")
+    match = read_tracab_match(fmetadata)
+    if verbose:
+        print("Reading match tracking data")
+    tracking = read_tracab_dat(fdata)
+    timestamp_arrays(tracking, match)
+    if during_match_only:  # remove pre-match, post-match and half-time frames
+        tracking = tracking.take(np.flatnonzero(
+            (tracking.period == 1) | (tracking.period == 2)))
+    set_period_indices(tracking.period, tracking.timestamp, match)
+    match.time_index = ta.frame_time_index(
+        tracking.period, tracking.timestamp, tracking)
+    set_parity(tracking.frames, match)
+    if team1_exclude is None or team0_exclude is None:
+        team1_exclude, team0_exclude = get_goalkeeper_numbers(
+            tracking.frames, verbose=verbose)
+    match.team1_exclude = team1_exclude
+    match.team0_exclude = team0_exclude
+    if verbose:
+        print("Measuring velocities")
+    vel.estimate_player_velocities_arrays(
+        tracking, window=player_window, polyorder=player_polyorder, maxspeed=player_maxspeed)
+    vel.estimate_ball_velocities_arrays(
+        tracking, window=ball_window, polyorder=ball_polyorder, maxspeed=ball_maxspeed)
+    vel.estimate_com_arrays(tracking, team1_exclude, team0_exclude)
+    return tracking, match
+
+
+def read_tracab_frames(fdata):
+    # reads the raw tracking data into a list of tracab_frame objects, sorted by frameid
+    frames = []
+    with open(fdata, "r") as fp:
+        for f in fp:  # go through line by line and break down data in individual players and the ball
+            # each line is a single frame
+            chunks = f.split(':')[:-1]  # last element is carriage return
+            if len(chunks) > 3:
+                print(chunks)
+            assert len(chunks) <= 3
+            frameid = int(chunks[0])
+            frame = tracab_frame(frameid)
+            # now get players
+            targets = chunks[1].split(';')
+            assert targets[-1] == ''
+            for target in targets[:-1]:
+                target = target.split(',')
+                team = int(target[0])
+                if team in [1, 0, 3]:
+                    frame.add_frame_target(target)
+            if len(chunks) > 2:  # is this never the case?
+                frame.add_frame_ball(chunks[2].split(';')[0].split(','))
+            frames.append(frame)
+    # sort the frames by frameid (they should be sorted anyway, but just to make sure)
+    frames = sorted(frames, key=lambda x: x.frameid)
+    return frames
+
+
+def read_tracab_dat(fdata, block_size=2**20):
+    # fast reader for the raw tracking data: tokenizes the file in blocks of ~block_size bytes (rather than line by line) and
+    # returns a Tracking_Arrays.tracking_arrays store (sorted by frameid) rather than a list of tracab_frame objects
+    blocks = [parse_tracab_dat(raw) for raw in read_tracab_blocks(fdata, block_size)]
+    tracking = ta.concatenate_tracking_arrays(blocks)
+    # sort the frames by frameid (they should be sorted anyway, but just to make sure)
+    if np.any(np.diff(tracking.frameid) < 0):
+        tracking = tracking.take(np.argsort(tracking.frameid, kind='stable'))
+    return tracking
+
+
+def read_tracab_blocks(fdata, block_size=2**20):
+    # generator: reads the raw tracking data in blocks of ~block_size bytes that end on a line boundary
+    with open(fdata, "rb") as fp:
+        remainder = b''
+        while True:
+            raw = fp.read(block_size)
+            if not raw:
+                break
+            raw = remainder + raw
+            last_newline = raw.rfind(b'\n')
+            if last_newline < 0:
+                remainder = raw
+                continue
+            remainder = raw[last_newline+1:]
+            yield raw[:last_newline+1]
+        if remainder.strip():
+            yield remainder
+
+
+def iter_tracab_frames(fdata, match, chunk_frames=1500, during_match_only=True, block_size=2**20, team1_exclude=None, team0_exclude=None,
+                       player_window=7, player_polyorder=1, player_maxspeed=14, ball_window=5, ball_polyorder=3, ball_maxspeed=40):
+    # generator: reads the raw tracking data a block at a time and yields consecutive tracking_arrays stores of
+    # chunk_frames frames (the last may be shorter), timestamped and with player and ball velocities measured, so that
+    # a long file (or a live feed) can be processed in bounded memory. match is from read_tracab_match.
+    # The velocity filters only depend on frames close by, so each chunk is filtered along with `context` frames from the
+    # previous and next chunks: the velocities are identical to those from read_tracab_match_arrays.
+    # Assumes the frames in the file are sorted by frameid.
+    # If team1_exclude and team0_exclude (e.g. goalkeeper jersey numbers) are given, the team centres of mass are measured too
+    # longest filter window + 2 (see Tracking_Velocities.segment_velocities)
+    context = max(player_window, ball_window) + 2
+    filters = ((player_window, player_polyorder, player_maxspeed),
+               (ball_window, ball_polyorder, ball_maxspeed))
+    # frames that have been read but not yielded, preceded by nhead frames that have already been yielded (for context)
+    pending = None
+    nhead = 0
+    for raw in read_tracab_blocks(fdata, block_size):
+        block = parse_tracab_dat(raw)
+        timestamp_arrays(block, match)
+        if during_match_only:
+            block = block.take(np.flatnonzero(
+                (block.period == 1) | (block.period == 2)))
+        if block.nframes == 0:
+            continue
+        if pending is None:
+            pending = block
+        else:
+            if block.frameid[0] <= pending.frameid[-1]:
+                raise ValueError(
+                    "iter_tracab_frames requires frames sorted by frameid (frame %d follows %d)" % (block.frameid[0], pending.frameid[-1]))
+            pending = ta.concatenate_tracking_arrays([pending, block])
+        # yield chunks once the following context frames have been read
+        while pending.nframes - nhead >= chunk_frames + context:
+            chunk = _velocity_chunk(
+                pending, nhead, chunk_frames, context, filters)
+            pending = pending.take(
+                np.arange(max(nhead+chunk_frames-context, 0), pending.nframes))
+            nhead = min(context, nhead+chunk_frames)
+            if team1_exclude is not None and team0_exclude is not None:
+                vel.estimate_com_arrays(chunk, team1_exclude, team0_exclude)
+            yield chunk
+    while pending is not None and pending.nframes > nhead:
+        n = min(chunk_frames, pending.nframes-nhead)
+        chunk = _velocity_chunk(pending, nhead, n, context, filters)
+        pending = pending.take(np.arange(max(nhead+n-context, 0), pending.nframes))
+        nhead = min(context, nhead+n)
+        if team1_exclude is not None and team0_exclude is not None:
+            vel.estimate_com_arrays(chunk, team1_exclude, team0_exclude)
+        yield chunk
+
+
+def _velocity_chunk(pending, nhead, nframes, context, filters):
+    # measures velocities on frames nhead to nhead+nframes of pending (with up to context frames either side) and returns those frames
+    # filters are the (window, polyorder, maxspeed) of the player and ball velocity filters
+    padded = pending.take(np.arange(max(nhead-context, 0),
+                                    min(nhead+nframes+context, pending.nframes)))
+    player_filter, ball_filter = filters
+    vel.estimate_player_velocities_arrays(padded, *player_filter)
+    vel.estimate_ball_velocities_arrays(padded, *ball_filter)
+    start = min(nhead, context)
+    return padded.take(np.arange(start, start+nframes))
+
+
+def parse_tracab_dat(raw):
+    # raw is the (bytes) content of a Tracab .dat file, one frame per line:
+    #   frameid:team,sys_target_ID,jersey,x,y,speed;...;:ball_x,ball_y,ball_z,ball_speed,ball_team,ball_status[,contact_info];:
+    # rather than splitting each line, find all the delimiters and numbers in the file at once and work out which frame they belong to
+    buf = np.frombuffer(raw, dtype=np.uint8)
+    byte_class = _BYTE_CLASS[buf]
+    delimiters = np.flatnonzero(byte_class >= _COMMA)
+    delimiter_class = byte_class[delimiters]
+    # line boundaries (the last line may not end in a newline)
+    newlines = delimiters[delimiter_class == _NEWLINE]
+    if len(newlines) == 0 or newlines[-1] != len(buf)-1:
+        newlines = np.append(newlines, len(buf))
+    line_starts = np.concatenate(([0], newlines[:-1]+1))
+    # drop blank lines
+    nonblank = (newlines - line_starts) > 1
+    line_starts = line_starts[nonblank]
+    line_ends = newlines[nonblank]
+    nframes = len(line_ends)
+    # each line has a colon after the frameid, after the targets and (if the ball is in the frame) after the ball chunk
+    colons = delimiters[delimiter_class == _COLON]
+    first_colon = np.searchsorted(colons, line_starts)
+    ncolons = np.searchsorted(colons, line_ends) - first_colon
+    if np.any(ncolons < 2) or np.any(ncolons > 3):
+        raise ValueError("Unexpected Tracab frame format: every frame must have 2 or 3 ':' delimited chunks")
+    c0 = colons[first_colon]
+    c1 = colons[first_colon+1]
+    has_ball = ncolons == 3
+    # every target (player, referee, etc) has exactly 6 fields, and is terminated by a ';'
+    semicolons = delimiters[delimiter_class == _SEMICOLON]
+    ntargets = np.searchsorted(semicolons, c1) - np.searchsorted(semicolons, c0)
+    # now parse all the numbers in the file and assign them to frames
+    number_starts, number_ends, numbers = _parse_numbers(buf, byte_class, delimiters)
+    first_number = np.searchsorted(number_starts, line_starts)
+    nnumbers = np.searchsorted(number_starts, line_ends) - first_number
+    if np.any(nnumbers < 1 + 6*ntargets + 4*has_ball):
+        raise ValueError("Unexpected Tracab frame format: missing fields")
+    frameid = numbers[first_number].astype(np.int64)
+    # the targets are the next 6*ntargets numbers in each frame
+    target_frame = np.repeat(np.arange(nframes), ntargets)
+    target_rank = np.arange(len(target_frame)) - np.repeat(np.cumsum(ntargets) - ntargets, ntargets)
+    target_index = (first_number[target_frame] + 1 + 6*target_rank)[:, None] + np.arange(6)
+    targets = numbers[target_index]
+    team = targets[:, 0].astype(int)
+    jersey = targets[:, 2].astype(int)
+    team1_jerseys = np.unique(jersey[team == 1])
+    team0_jerseys = np.unique(jersey[team == 0])
+    tracking = ta.empty_tracking_arrays(nframes, team1_jerseys, team0_jerseys)
+    tracking.frameid[:] = frameid
+    for t, jerseys, array in [(1, team1_jerseys, tracking.team1), (0, team0_jerseys, tracking.team0)]:
+        rows = team == t
+        array[target_frame[rows], np.searchsorted(jerseys, jersey[rows]), :3] = targets[rows, 3:6]
+    referee = np.nan*np.zeros((nframes, ta.NPLAYER_FIELDS), dtype=float)
+    rows = team == 3
+    referee[target_frame[rows], :3] = targets[rows, 3:6]
+    tracking.referee = referee
+    # ball: four numbers followed by the owning team, ball status and (optionally) contact info
+    if np.any(has_ball):
+        ball_index = (first_number[has_ball] + 1 + 6*ntargets[has_ball])[:, None] + np.arange(4)
+        ball = tracking.ball[has_ball]
+        ball[:, :4] = numbers[ball_index]
+        ball[:, ta.BALL_SPEED] = ball[:, ta.BALL_SPEED] / 100.  # ball speed is in cm/s?
+        tracking.ball[has_ball] = ball
+        # the string fields follow the comma after the ball speed
+        team_start = number_ends[ball_index[:, 3]] + 1
+        team_end = delimiters[np.searchsorted(delimiters, team_start)]
+        status_start = team_end + 1
+        status_end = delimiters[np.searchsorted(delimiters, status_start)]
+        ball_team = -1*np.ones(len(team_start), dtype=np.int8)
+        ball_status = -1*np.ones(len(team_start), dtype=np.int8)
+        for k in ta.BALL_TEAM_CODES.keys():
+            ball_team[_match_field(buf, team_start, team_end, k)] = ta.BALL_TEAM_CODES[k]
+        for k in ta.BALL_STATUS_CODES.keys():
+            ball_status[_match_field(buf, status_start, status_end, k)] = ta.BALL_STATUS_CODES[k]
+        tracking.ball_team[has_ball] = ball_team
+        tracking.ball_status[has_ball] = ball_status
+        # contact info is only present in some frames
+        contact_start = status_end + 1
+        has_contact = buf[status_end] == ord(',')
+        contact_end = delimiters[np.searchsorted(
+            delimiters, contact_start[has_contact])]
+        contact_raw = [raw[i:j] for i, j in zip(contact_start[has_contact], contact_end)]
+        labels, contact = np.unique(np.array(contact_raw, dtype=bytes), return_inverse=True)
+        ball_contact = -1*np.ones(len(team_start), dtype=np.int16)
+        ball_contact[has_contact] = contact.ravel()
+        tracking.ball_contact[has_ball] = ball_contact
+        tracking.ball_contact_labels = [l.decode() for l in labels]
+    # sort the frames by frameid (they should be sorted anyway, but just to make sure)
+    if np.any(np.diff(tracking.frameid) < 0):
+        tracking = tracking.take(np.argsort(tracking.frameid, kind='stable'))
+    return tracking
+
+
+# byte classes used by parse_tracab_dat. Everything else (letters, carriage returns) is class 0
+_DIGIT, _MINUS, _POINT, _COMMA, _SEMICOLON, _COLON, _NEWLINE = 1, 2, 3, 4, 5, 6, 7
+_BYTE_CLASS = np.zeros(256, dtype=np.uint8)
+_BYTE_CLASS[ord('0'):ord('9')+1] = _DIGIT
+_BYTE_CLASS[ord('-')] = _MINUS
+_BYTE_CLASS[ord('.')] = _POINT
+_BYTE_CLASS[ord(',')] = _COMMA
+_BYTE_CLASS[ord(';')] = _SEMICOLON
+_BYTE_CLASS[ord(':')] = _COLON
+_BYTE_CLASS[ord('\n')] = _NEWLINE
+
+
+def _parse_numbers(buf, byte_class, delimiters):
+    # vectorized parsing of every number in buf. A number is any field between two delimiters made up only of digits, '-' and '.'
+    # returns the first and one-past-last byte of each number and its value
+    bounds = np.concatenate(([-1], delimiters, [len(buf)]))
+    starts = bounds[:-1] + 1
+    ends = bounds[1:]
+    nonempty = ends > starts
+    starts = starts[nonempty]
+    ends = ends[nonempty]
+    # remove text fields (e.g. ball status), and make sure any digits in them are ignored
+    text = np.flatnonzero(byte_class == 0)
+    is_text = np.zeros(len(starts), dtype=bool)
+    is_text[np.searchsorted(starts, text, 'right') - 1] = True
+    if np.any(is_text):
+        length = ends[is_text] - starts[is_text]
+        text = np.repeat(starts[is_text] - np.cumsum(length) + length, length) + np.arange(np.sum(length))
+        byte_class = byte_class.copy()
+        byte_class[text] = 0
+    starts = starts[~is_text]
+    ends = ends[~is_text]
+    negative = buf[starts] == ord('-')
+    points = np.flatnonzero(byte_class == _POINT)
+    point_number = np.searchsorted(starts, points, 'right') - 1
+    haspoint = np.zeros(len(starts), dtype=bool)
+    haspoint[point_number] = True
+    ndecimals = np.zeros(len(starts), dtype=np.intp)
+    ndecimals[point_number] = ends[point_number] - points - 1
+    ndigits = ends - starts - negative - haspoint
+    if np.any(ndigits < 1):
+        raise ValueError("Unexpected Tracab frame format: could not parse numbers")
+    # add up the digits of each number, weighted by their place value
+    digits = np.flatnonzero(byte_class == _DIGIT)
+    last_digit = np.cumsum(ndigits)
+    power = np.repeat(last_digit, ndigits) - np.arange(1, len(digits)+1)
+    pow10 = 10.**np.arange(max(1, ndigits.max(initial=0)))
+    values = (buf[digits] - np.uint8(ord('0'))) * pow10[power]
+    values = np.add.reduceat(values, last_digit - ndigits) if len(values) > 0 else np.zeros(0)
+    values = values / pow10[ndecimals]
+    values[negative] *= -1
+    return starts, ends, values
+
+
+def _match_field(buf, starts, ends, value):
+    # boolean array: True where buf[starts[i]:ends[i]] == value
+    match = (ends - starts) == len(value)
+    for k, c in enumerate(value.encode()):
+        match[match] = buf[starts[match]+k] == c
+    return match
+
+
 def set_parity(frames, match):
     # determines the direction in which the home team are shooting
     # 1: right->left, -1: left->right
@@ -210,105 +487,195 @@ def find_GK_substitution(frames, team, first_gk_id):
 
 
 def get_players(frames):
-    # first get all players that appear in at least one frame
-    # get all jerseys in frames
-    team1_jerseys = set([])  # home team
-    team0_jerseys = set([])  # away team
-    team1_players = {}
-    team0_players = {}
-    for frame in frames:
-        team1_jerseys.update(frame.team1_jersey_nums_in_frame)
-        team0_jerseys.update(frame.team0_jersey_nums_in_frame)
-    for j1 in team1_jerseys:
-        team1_players[j1] = tracab_player(j1, 1)
-    for j0 in team0_jerseys:
-        team0_players[j0] = tracab_player(j0, 0)
-    for frame in frames:
-        for j in team1_jerseys:
-            if j in frame.team1_jersey_nums_in_frame:
-                team1_players[j].add_frame(
-                    frame.team1_players[j], frame.frameid, frame.timestamp)
-            else:  # player is not in this frame
-                team1_players[j].add_null_frame(frame.frameid, frame.timestamp)
-        for j in team0_jerseys:
-            if j in frame.team0_jersey_nums_in_frame:
-                team0_players[j].add_frame(
-                    frame.team0_players[j], frame.frameid, frame.timestamp)
-            else:  # player is not in this frame
-                team0_players[j].add_null_frame(frame.frameid, frame.timestamp)
+    # get all players that appear in at least one frame. frames is a list of tracab_frames or a Tracking_Arrays.tracking_arrays store
+    # each player's trajectory is a set of arrays aligned to the frames, with a presence bitmap marking the frames they are in
+    team1_players = {}  # home team
+    team0_players = {}  # away team
+    if isinstance(frames, ta.tracking_arrays):
+        for team, players in [(1, team1_players), (0, team0_players)]:
+            data, jerseys, _ = frames.get_team(team)
+            present = frames.present(team)
+            for s, j in enumerate(jerseys):
+                players[int(j)] = tracab_player(
+                    int(j), team, frames.frameid, frames.timestamp, data[:, s, :], present[:, s])
+        return team1_players, team0_players
+    frameids = np.array([frame.frameid for frame in frames], dtype=np.int64)
+    timestamps = np.array([getattr(frame, 'timestamp', -1)
+                           for frame in frames], dtype=float)
+    for team, players in [(1, team1_players), (0, team0_players)]:
+        data, jerseys, fnums, slots, targets = ta.frame_targets_to_array(frames, team)
+        present = np.zeros(data.shape[:2], dtype=bool)
+        present[fnums, slots] = True
+        target_array = np.empty(len(targets), dtype=object)
+        target_array[:] = targets
+        for s, j in enumerate(jerseys):
+            players[int(j)] = tracab_player(
+                int(j), team, frameids, timestamps, data[:, s, :], present[:, s])
+            # keep the frames' targets so that velocities can be written back to them
+            players[int(j)].targets = list(target_array[slots == s])
     return team1_players, team0_players
 
 
 def timestamp_frames(frames, match):
     # Frames must be sorted into ascending frameid first
-    frame_period = 1/float(match.iFrameRateFps)
-    # ASSUMES NO INJURY TIME
-    match.period_attributes[1]['iStart'] = None
-    match.period_attributes[2]['iStart'] = None
-    match.period_attributes[1]['iEnd'] = None
-    match.period_attributes[2]['iEnd'] = None
-    for i, frame in enumerate(frames):
-        if frame.frameid < match.period_attributes[1]['iStartFrame']:
-            frame.period = 0  # pre match
-            frame.timestamp = -1
-        elif frame.frameid > match.period_attributes[2]['iEndFrame']:
-            frame.period = 4  # post match
-            frame.timestamp = -1
-        elif frame.frameid <= match.period_attributes[1]['iEndFrame']:
-            frame.period = 1  # first half
-            frame.timestamp = (
-                frame.frameid-match.period_attributes[1]['iStartFrame'])*frame_period/60.
-            frame.min = str(int(frame.timestamp))
-            frame.sec = "%1.2f" % (
-                round((frame.timestamp-int(frame.timestamp))*60., 3))
-            if match.period_attributes[1]['iStart'] is None:
-                match.period_attributes[1]['iStart'] = i
-            if frame.frameid == match.period_attributes[1]['iEndFrame']:
-                match.period_attributes[1]['iEnd'] = i
-                match.period_attributes[1]['iEndTime'] = frame.timestamp
-        elif frame.frameid >= match.period_attributes[2]['iStartFrame']:
-            frame.period = 2  # second half
-            frame.timestamp = (
-                frame.frameid-match.period_attributes[2]['iStartFrame'])*frame_period/60.
-            frame.min = str(int(frame.timestamp))
-            frame.sec = "%1.2f" % (
-                round((frame.timestamp-int(frame.timestamp))*60., 3))
-            if match.period_attributes[2]['iStart'] is None:
-                match.period_attributes[2]['iStart'] = i
-            if frame.frameid == match.period_attributes[2]['iEndFrame']:
-                match.period_attributes[2]['iEnd'] = i
-                match.period_attributes[2]['iEndTime'] = frame.timestamp
-        else:
-            frame.period = 3  # half time
-            frame.timestamp = -1
+    # sets the period and timestamp (minutes since the start of the half) of each frame. See frame_periods
+    frameid = np.array([frame.frameid for frame in frames], dtype=np.int64)
+    period, timestamp = frame_periods(frameid, match)
+    for frame, p, t in zip(frames, period.tolist(), timestamp.tolist()):
+        frame.period = p
+        frame.timestamp = t
+    set_period_indices(period, timestamp, match)
+    match.time_index = ta.frame_time_index(period, timestamp, frames)
     return frames, match
 
 
+def timestamp_arrays(tracking, match):
+    # timestamp_frames for a tracking_arrays store: sets the period and timestamp of every frame
+    tracking.period, tracking.timestamp = frame_periods(tracking.frameid, match)
+    return tracking
+
+
+def frame_periods(frameid, match):
+    # period and timestamp (minutes since the start of the half, -1 outside of the halves) of each frameid
+    # period 0: pre match, 1: first half, 2: second half, 3: half time, 4: post match
+    # ASSUMES NO INJURY TIME
+    frame_period = 1/float(match.iFrameRateFps)
+    first = match.period_attributes[1]
+    second = match.period_attributes[2]
+    f = np.asarray(frameid)
+    period = 3*np.ones(len(f), dtype=np.int8)  # half time
+    period[f < first['iStartFrame']] = 0  # pre match
+    period[f > second['iEndFrame']] = 4  # post match
+    period[(f >= first['iStartFrame']) & (f <= first['iEndFrame'])] = 1
+    period[(f >= second['iStartFrame']) & (f <= second['iEndFrame']) & (
+        f > first['iEndFrame'])] = 2
+    timestamp = -1*np.ones(len(f), dtype=float)
+    for p, attributes in [(1, first), (2, second)]:
+        inperiod = period == p
+        timestamp[inperiod] = (
+            f[inperiod]-attributes['iStartFrame'])*frame_period/60.
+    return period, timestamp
+
+
+def set_period_indices(period, timestamp, match):
+    # index of the first and last frame of each half, and the time at the end of the half
+    for p in [1, 2]:
+        inperiod = np.flatnonzero(np.asarray(period) == p)
+        if len(inperiod) == 0:
+            match.period_attributes[p]['iStart'] = None
+            match.period_attributes[p]['iEnd'] = None
+            continue
+        match.period_attributes[p]['iStart'] = int(inperiod[0])
+        match.period_attributes[p]['iEnd'] = int(inperiod[-1])
+        match.period_attributes[p]['iEndTime'] = float(timestamp[inperiod[-1]])
+    return match
+
+
+# fields of the possession record array returned by get_tracab_posessions: the period and team ('H' or 'A') in posession, the
+# frame ids and frame indices of the first and last frame, the number of frames, the start and end timestamps (minutes, in the
+# period and from the start of the match), the duration in seconds, the posession type ('A' attacking: the team's centre of mass
+# in the opposition half, 'D' defending: deep in its own half, 'N' neutral), how it started ('DeadBall' or 'WinPosession') and
+# bad_possesion, set when the players on the pitch change during the posession (suggesting an error in the ball status)
+POSSESSION_DTYPE = [('period', np.int8), ('team', 'U1'), ('pos_start_fid', np.int64), ('pos_end_fid', np.int64),
+                    ('pos_start_fnum', np.int64), ('pos_end_fnum', np.int64), ('pos_Nframes', np.int64),
+                    ('pos_start_time', float), ('pos_end_time', float), ('pos_start_matchtime', float),
+                    ('pos_end_matchtime', float), ('pos_duration', float), ('pos_type', 'U1'),
+                    ('pos_start_type', 'U12'), ('bad_possesion', bool)]
+
+
 def get_tracab_posessions(frames, match, min_pos_length=0):
-    posessions = []
-    for p in match.period_attributes.keys():
-        newpos = True
-        period = match.period_attributes[p]
-        for i in np.arange(period['iStart'], period['iEnd']+1):
-            if newpos:
-                if frames[i].ball_status == 'Alive':
-                    istart = i
-                    newpos = False
-            else:
-                if frames[i].ball_status != 'Alive' or frames[i].ball_team != frames[istart].ball_team:
-                    posessions.append(tracab_possesion(
-                        frames[istart], frames[i-1], istart, match))
-                    newpos = True
-        if not newpos:
-            posessions.append(tracab_possesion(
-                frames[istart], frames[i], istart, match))
-    posessions = [
-        pos for pos in posessions if pos.pos_duration > min_pos_length]
-    for pos in posessions:
-        pos.set_possession_type(frames, match)
+    # every period of continuous posession (ball alive and owned by the same team) in the two halves, as a record array with
+    # POSSESSION_DTYPE fields, so p.team, p.pos_start_fnum, p.pos_type etc. work on each element and on the whole array at once
+    # frames is a list of tracab_frames or a tracking_arrays store (or its frames view); the team centre of mass (team1_x,
+    # team0_x) must have been measured. Posessions no longer than min_pos_length seconds are removed
+    if isinstance(frames, ta.tracking_frames):
+        frames = frames.tracking
+    if isinstance(frames, ta.tracking_arrays):
+        tracking = frames
+        frameid, period, timestamp = tracking.frameid, tracking.period, tracking.timestamp
+        ball_status, ball_team = tracking.ball_status, tracking.ball_team
+        team1_x, team0_x = tracking.frame_data['team1_x'], tracking.frame_data['team0_x']
+    else:
+        frameid = np.array([f.frameid for f in frames], dtype=np.int64)
+        period = np.array([f.period for f in frames], dtype=np.int8)
+        timestamp = np.array([f.timestamp for f in frames], dtype=float)
+        ball_status = np.array([ta.BALL_STATUS_CODES.get(getattr(f, 'ball_status', None), -1)
+                                for f in frames], dtype=np.int8)
+        ball_team = np.array([ta.BALL_TEAM_CODES.get(getattr(f, 'ball_team', None), -1)
+                              for f in frames], dtype=np.int8)
+        team1_x = np.array([f.team1_x for f in frames], dtype=float)
+        team0_x = np.array([f.team0_x for f in frames], dtype=float)
+    # run length encode the frames in play: a posession ends when the ball goes dead, changes team or the period ends
+    inplay = (ball_status == ta.BALL_STATUS_CODES['Alive']) & (
+        (period == 1) | (period == 2))
+    breaks = vel.period_breaks(period)
+    breaks[1:] |= ball_team[1:] != ball_team[:-1]
+    istart, iend = vel.valid_segments(inplay, breaks)
+    iend = iend - 1
+    posessions = np.recarray(len(istart), dtype=POSSESSION_DTYPE)
+    posessions.period = period[istart]
+    posessions.team = np.where(ball_team[istart] == ta.BALL_TEAM_CODES['H'], 'H', 'A')
+    posessions.pos_start_fid = frameid[istart]
+    posessions.pos_end_fid = frameid[iend]
+    posessions.pos_start_fnum = istart
+    posessions.pos_end_fnum = iend
+    posessions.pos_Nframes = frameid[iend] - frameid[istart]
+    posessions.pos_start_time = timestamp[istart]
+    posessions.pos_end_time = timestamp[iend]
+    offset = (posessions.period-1)*match.period_attributes[1]['iEndTime']
+    posessions.pos_start_matchtime = posessions.pos_start_time + offset
+    posessions.pos_end_matchtime = posessions.pos_end_time + offset
+    posessions.pos_duration = 60*(posessions.pos_end_time - posessions.pos_start_time)
+    posessions = posessions[posessions.pos_duration > min_pos_length]
+    istart = posessions.pos_start_fnum
+    iend = posessions.pos_end_fnum
+    # check if team changes during the possesion (suggesions a data error in ball status)
+    if isinstance(frames, ta.tracking_arrays):
+        posessions.bad_possesion = np.any(tracking.present(1)[istart] != tracking.present(1)[iend], axis=1) | np.any(
+            tracking.present(0)[istart] != tracking.present(0)[iend], axis=1)
+    else:
+        posessions.bad_possesion = [(set(frames[s].team1_jersey_nums_in_frame) != set(frames[e].team1_jersey_nums_in_frame)) or (
+            set(frames[s].team0_jersey_nums_in_frame) != set(frames[e].team0_jersey_nums_in_frame)) for s, e in zip(istart, iend)]
+    for pos in posessions[posessions.bad_possesion]:
+        print("bad posession: period %d, %1.2f to %1.2f" %
+              (pos.period, pos.pos_start_time, pos.pos_end_time))
+    set_possession_types(posessions, team1_x, team0_x, ball_status, match)
     return posessions
 
 
+def set_possession_types(posessions, team1_x, team0_x, ball_status, match):
+    # posession type from the median x position of the team in posession: 'A' (attacking, in the opponents' half), 'D'
+    # (defending, in its own defensive quarter) or 'N' (neutral). Start type 'DeadBall' if the ball was dead in the frame before
+    # the posession started, otherwise 'WinPosession'
+    home = posessions.team == 'H'
+    x = np.where(home, segment_medians(team1_x, posessions.pos_start_fnum, posessions.pos_end_fnum),
+                 segment_medians(team0_x, posessions.pos_start_fnum, posessions.pos_end_fnum))
+    # home team shooting from right->left when the parity is 1
+    parity = np.array([match.period_parity[p] for p in posessions.period], dtype=float)
+    x = x * np.where(home, parity, -1*parity)
+    with np.errstate(invalid='ignore'):
+        posessions.pos_type = np.where(x < 0, 'A', np.where(
+            x > match.fPitchXSizeMeters*100/4., 'D', 'N'))
+    istart = posessions.pos_start_fnum
+    deadball = (istart == 0) | (ball_status[np.maximum(istart-1, 0)] == ta.BALL_STATUS_CODES['Dead'])
+    posessions.pos_start_type = np.where(deadball, 'DeadBall', 'WinPosession')
+    return posessions
+
+
+def segment_medians(x, istart, iend):
+    # median of x[istart[k]:iend[k]+1] for each k (nan if the segment contains a nan), by sorting the values of all the segments at once
+    lengths = np.asarray(iend) - np.asarray(istart) + 1
+    if len(lengths) == 0:
+        return np.zeros(0, dtype=float)
+    offsets = np.cumsum(lengths) - lengths
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+    values = np.asarray(x, dtype=float)[np.arange(np.sum(lengths)) - offsets[segment] + np.asarray(istart)[segment]]
+    values = values[np.lexsort((values, segment))]
+    medians = 0.5*(values[offsets+(lengths-1)//2] + values[offsets+lengths//2])
+    medians[np.add.reduceat(np.isnan(values), offsets) > 0] = np.nan
+    return medians
+
+
 def make_posession_plot(posessions):
     home = [p.pos_duration for p in posessions if p.team == 'H']
     away = [p.pos_duration for p in posessions if p.team == 'A']
@@ -362,6 +729,15 @@ class tracab_frame(object):
         self.ball = False
         self.referee = None
 
+    @property
+    def min(self):
+        # minutes and seconds since the start of the half, as strings (for display)
+        return str(int(self.timestamp))
+
+    @property
+    def sec(self):
+        return "%1.2f" % (round((self.timestamp-int(self.timestamp))*60., 3))
+
     def add_frame_target(self, target_raw):
         # add a player to the frame
         team = int(target_raw[0])
@@ -417,81 +793,54 @@ class tracab_target(object):
 
 class tracab_player(object):
     # contains trajectory of a single player over the entire match
-    def __init__(self, jersey_num, teamID):
+    # data is a (nframes, Tracking_Arrays.NPLAYER_FIELDS) array (a view into the frame store if built from one), present is True in
+    # the frames that the player is in. pos_x, pos_y, speed, vx and vy are masked arrays, masked in the frames the player is not in
+    def __init__(self, jersey_num, teamID, frameids, frame_timestamps, data, present):
         self.jersey_num = jersey_num
         self.teamID = teamID
-        self.frame_targets = []
-        self.frame_timestamps = []
-        self.frameids = []
-
-    def add_frame(self, target, frameid, timestamp):
-        self.frame_targets.append(target)
-        self.frame_timestamps.append(timestamp)
-        self.frameids.append(frameid)
-
-    def add_null_frame(self, frameid, timestamp):
-        # player is not on the pitch (specifically, is not in a frame)
-        self.frame_timestamps.append(timestamp)
-        self.frameids.append(frameid)
-        self.frame_targets.append(tracab_target(
-            self.teamID, None, self.jersey_num, 0.0, 0.0, 0.0))
-
-
-class tracab_possesion(object):
-    # a single period of continuous posession for a team
-    def __init__(self, fstart, fend, fstart_num, match):
-        self.period = fstart.period
-        self.pos_start_fid = fstart.frameid
-        self.pos_end_fid = fend.frameid
-        self.pos_start_time = fstart.timestamp
-        self.pos_end_time = fend.timestamp
-        self.pos_start_matchtime = self.pos_start_time + \
-            (self.period-1)*match.period_attributes[1]['iEndTime']
-        self.pos_end_matchtime = self.pos_end_time + \
-            (self.period-1)*match.period_attributes[1]['iEndTime']
-        self.pos_duration = 60*(self.pos_end_time - self.pos_start_time)
-        self.pos_Nframes = self.pos_end_fid - self.pos_start_fid
-        self.team = fstart.ball_team
-        self.pos_start_fnum = fstart_num
-        self.pos_end_fnum = fstart_num+self.pos_Nframes
-        self.prev_pos_type = None
-        # check if team changes during the possesion (suggesions a data error in ball status)
-        self.bad_possesion = (set(fstart.team1_jersey_nums_in_frame) != set(fend.team1_jersey_nums_in_frame)) or (
-            set(fstart.team0_jersey_nums_in_frame) != set(fend.team0_jersey_nums_in_frame))
-        if self.bad_possesion:
-            print("bad posession: period %d, %1.2f to %1.2f" %
-                  (self.period, self.pos_start_time, self.pos_end_time))
-        assert self.team == fend.ball_team
-        assert fstart.period == fend.period
-
-    def set_possession_type(self, frames_tb, match_tb):
-        frames = frames_tb[self.pos_start_fnum:self.pos_end_fnum+1]
-        if self.team == 'H':  # team shooting from right->left
-            # ball-based metric
-            #x = np.median( [f.ball_pos_x for f in frames] ) * match_tb.period_parity[self.period]
-            # team-based metric
-            x = np.median([f.team1_x for f in frames]) * \
-                match_tb.period_parity[self.period]
-        else:  # team shooting from left->right
-            # ball-based metric
-            #x = np.median( [f.ball_pos_x for f in frames] ) * -1*match_tb.period_parity[self.period]
-            x = np.median([f.team0_x for f in frames]) * -1 * \
-                match_tb.period_parity[self.period]
-        if x < 0:
-            self.pos_type = 'A'
-        elif x > match_tb.fPitchXSizeMeters*100/4.:
-            self.pos_type = 'D'
-        else:
-            self.pos_type = 'N'  # neutral
-        self.set_possession_start(frames_tb)
-
-    def set_possession_start(self, frames_tb):
-        if self.pos_start_fnum == 0 or frames_tb[self.pos_start_fnum-1].ball_status == 'Dead':
-            self.pos_start_type = 'DeadBall'
-        else:
-            self.pos_start_type = 'WinPosession'
+        self.frameids = frameids
+        self.frame_timestamps = frame_timestamps
+        self.data = data
+        self.present = present
+        # tracab_targets in the frames the player is in (if built from a list of tracab_frames)
+        self.targets = []
+
+    def field(self, k):
+        return np.ma.masked_array(self.data[:, k], mask=~self.present)
+
+    @property
+    def pos_x(self):
+        return self.field(ta.X)
+
+    @property
+    def pos_y(self):
+        return self.field(ta.Y)
+
+    @property
+    def speed(self):
+        return self.field(ta.SPEED)
+
+    @property
+    def vx(self):
+        return self.field(ta.VX)
+
+    @property
+    def vy(self):
+        return self.field(ta.VY)
+
+    @property
+    def speed_filter(self):
+        return np.ma.sqrt(self.vx**2 + self.vy**2)
+
+    def set_velocities(self, vx, vy):
+        # sets the velocity in the frames the player is in (and in their tracab_targets)
+        self.data[:, ta.VX] = np.where(self.present, vx, np.nan)
+        self.data[:, ta.VY] = np.where(self.present, vy, np.nan)
+        for target, tvx, tvy in zip(self.targets, self.data[self.present, ta.VX], self.data[self.present, ta.VY]):
+            target.vx = tvx
+            target.vy = tvy
+            target.speed_filter = np.sqrt(tvx**2 + tvy**2)
 
     def __repr__(self):
-        s = 'Team %s, Period %d, Type %s, start = %1.2f, end = %1.2f, length = %1.2f' % (
-            self.team, self.period, self.pos_type, self.pos_start_time, self.pos_end_time, self.pos_duration)
-        return s
+        return 'Player %d (team %d): in %d of %d frames' % (self.jersey_num, self.teamID, np.sum(self.present), len(self.present))
+
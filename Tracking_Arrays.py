@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:31 2026
+
+Module for storing Tracab tracking data as contiguous NumPy arrays (frames x player slots x fields)
+rather than as per-frame tracab_frame/tracab_target objects. A light-weight view layer exposes the
+old frame.team1_players[j].pos_x style attributes so that existing code can run on the array store.
+"""
+
+import numpy as np
+import operator
+
+# fields in the per-team player arrays
+X, Y, SPEED, VX, VY = 0, 1, 2, 3, 4
+NPLAYER_FIELDS = 5
+# fields in the ball array
+BALL_X, BALL_Y, BALL_Z, BALL_SPEED, BALL_VX, BALL_VY, BALL_VZ = 0, 1, 2, 3, 4, 5, 6
+NBALL_FIELDS = 7
+# integer codes for the ball owner and ball status strings. -1 means no ball in frame
+BALL_TEAM_CODES = {'H': 1, 'A': 0}
+BALL_STATUS_CODES = {'Alive': 1, 'Dead': 0}
+BALL_TEAM_LABELS = {1: 'H', 0: 'A'}
+BALL_STATUS_LABELS = {1: 'Alive', 0: 'Dead'}
+
+
+class tracking_arrays(object):
+    # columnar store of every frame in a match
+    # team1/team0 are (nframes, nslots, NPLAYER_FIELDS) arrays, nan where a player is not in the frame
+    # team1_jerseys/team0_jerseys map slot -> jersey number, team1_slots/team0_slots map jersey number -> slot
+    # ball is a (nframes, NBALL_FIELDS) array, nan where the ball is not in the frame
+    def __init__(self, frameid, team1, team1_jerseys, team0, team0_jerseys, ball, ball_team, ball_status, ball_contact=None, ball_contact_labels=None):
+        self.provider = 'Tracab'
+        self.frameid = np.asarray(frameid, dtype=np.int64)
+        self.nframes = len(self.frameid)
+        self.team1 = team1
+        self.team0 = team0
+        self.team1_jerseys = np.asarray(team1_jerseys, dtype=int)
+        self.team0_jerseys = np.asarray(team0_jerseys, dtype=int)
+        self.team1_slots = dict((j, s) for s, j in enumerate(self.team1_jerseys))
+        self.team0_slots = dict((j, s) for s, j in enumerate(self.team0_jerseys))
+        self.ball = ball
+        self.ball_team = np.asarray(ball_team, dtype=np.int8)
+        self.ball_status = np.asarray(ball_status, dtype=np.int8)
+        if ball_contact is None:
+            ball_contact = -1*np.ones(self.nframes, dtype=np.int16)
+        self.ball_contact = np.asarray(ball_contact, dtype=np.int16)
+        self.ball_contact_labels = [] if ball_contact_labels is None else list(ball_contact_labels)
+        # set when the frames are timestamped. period 0: pre-match, 1/2: halves, 3: half time, 4: post match
+        self.period = np.zeros(self.nframes, dtype=np.int8)
+        self.timestamp = -1*np.ones(self.nframes, dtype=float)
+        # any other per-frame quantities (e.g. team centre of mass), keyed by the old tracab_frame attribute name
+        self.frame_data = {}
+        # (nframes, NPLAYER_FIELDS) referee (team 3) positions, if they have been read
+        self.referee = None
+
+    def __len__(self):
+        return self.nframes
+
+    def get_team(self, team):
+        # returns the player array, slot->jersey and jersey->slot maps for team 1 (home) or 0 (away)
+        if team == 1:
+            return self.team1, self.team1_jerseys, self.team1_slots
+        elif team == 0:
+            return self.team0, self.team0_jerseys, self.team0_slots
+        raise ValueError("team must be 1 (home) or 0 (away), not %s" % (team,))
+
+    def present(self, team):
+        # (nframes, nslots) boolean array: True if a player is in the frame
+        players, _, _ = self.get_team(team)
+        return ~np.isnan(players[:, :, X])
+
+    def ball_in_frame(self):
+        return ~np.isnan(self.ball[:, BALL_X])
+
+    def jersey_nums_in_frame(self, i, team):
+        players, jerseys, _ = self.get_team(team)
+        return [int(j) for j in jerseys[~np.isnan(players[i, :, X])]]
+
+    def take(self, index):
+        # returns a new store containing the frames selected by index (a slice, boolean mask or array of frame numbers)
+        sub = tracking_arrays(self.frameid[index], self.team1[index], self.team1_jerseys, self.team0[index], self.team0_jerseys,
+                              self.ball[index], self.ball_team[index], self.ball_status[index], self.ball_contact[index], self.ball_contact_labels)
+        sub.period = self.period[index]
+        sub.timestamp = self.timestamp[index]
+        if self.referee is not None:
+            sub.referee = self.referee[index]
+        for k in self.frame_data.keys():
+            sub.frame_data[k] = self.frame_data[k][index]
+        return sub
+
+    @property
+    def frames(self):
+        # list-like view that behaves like the old list of tracab_frames
+        return tracking_frames(self)
+
+    def frame(self, i):
+        return array_frame(self, i)
+
+    @property
+    def nbytes(self):
+        arrays = [self.frameid, self.team1, self.team0, self.ball, self.ball_team,
+                  self.ball_status, self.ball_contact, self.period, self.timestamp]
+        if self.referee is not None:
+            arrays.append(self.referee)
+        return sum([a.nbytes for a in arrays]) + sum([a.nbytes for a in self.frame_data.values()])
+
+    def __repr__(self):
+        s = 'Tracking arrays: %d frames, %d home slots, %d away slots, %1.1f MB' % (
+            self.nframes, len(self.team1_jerseys), len(self.team0_jerseys), self.nbytes/1e6)
+        return s
+
+
+def empty_tracking_arrays(nframes, team1_jerseys, team0_jerseys):
+    # allocates a store of nan-filled arrays to be filled in by a reader
+    team1 = np.nan*np.zeros((nframes, len(team1_jerseys), NPLAYER_FIELDS), dtype=float)
+    team0 = np.nan*np.zeros((nframes, len(team0_jerseys), NPLAYER_FIELDS), dtype=float)
+    ball = np.nan*np.zeros((nframes, NBALL_FIELDS), dtype=float)
+    ball_team = -1*np.ones(nframes, dtype=np.int8)
+    ball_status = -1*np.ones(nframes, dtype=np.int8)
+    return tracking_arrays(np.zeros(nframes, dtype=np.int64), team1, team1_jerseys, team0, team0_jerseys, ball, ball_team, ball_status)
+
+
+def concatenate_tracking_arrays(blocks):
+    # joins a list of stores (e.g. consecutive blocks of a file) into a single store. Player slots are the union of the jersey numbers in each block
+    team1_jerseys = np.unique(np.concatenate([b.team1_jerseys for b in blocks]))
+    team0_jerseys = np.unique(np.concatenate([b.team0_jerseys for b in blocks]))
+    nframes = sum([b.nframes for b in blocks])
+    tracking = empty_tracking_arrays(nframes, team1_jerseys, team0_jerseys)
+    labels = sorted(set([l for b in blocks for l in b.ball_contact_labels]))
+    tracking.ball_contact_labels = labels
+    frame_data_keys = set(blocks[0].frame_data.keys()) if len(blocks) > 0 else set([])
+    for b in blocks:
+        frame_data_keys.intersection_update(b.frame_data.keys())
+    for k in frame_data_keys:
+        tracking.frame_data[k] = np.concatenate([b.frame_data[k] for b in blocks])
+    if all([b.referee is not None for b in blocks]) and len(blocks) > 0:
+        tracking.referee = np.concatenate([b.referee for b in blocks])
+    i = 0
+    for b in blocks:
+        f = slice(i, i+b.nframes)
+        tracking.frameid[f] = b.frameid
+        tracking.period[f] = b.period
+        tracking.timestamp[f] = b.timestamp
+        tracking.team1[f, np.searchsorted(team1_jerseys, b.team1_jerseys), :] = b.team1
+        tracking.team0[f, np.searchsorted(team0_jerseys, b.team0_jerseys), :] = b.team0
+        tracking.ball[f] = b.ball
+        tracking.ball_team[f] = b.ball_team
+        tracking.ball_status[f] = b.ball_status
+        if len(b.ball_contact_labels) > 0:
+            relabel = np.array([labels.index(l) for l in b.ball_contact_labels] + [-1], dtype=np.int16)
+            tracking.ball_contact[f] = relabel[b.ball_contact]  # -1 stays -1
+        i += b.nframes
+    return tracking
+
+
+def frames_to_arrays(frames):
+    # converts a list of tracab_frames (as returned by Tracab.read_tracab_match_data) into a tracking_arrays store
+    # velocities, timestamps and centre of mass attributes are copied if they have been measured
+    team1, team1_jerseys, _, _, _ = frame_targets_to_array(frames, 1)
+    team0, team0_jerseys, _, _, _ = frame_targets_to_array(frames, 0)
+    tracking = empty_tracking_arrays(len(frames), team1_jerseys, team0_jerseys)
+    tracking.team1 = team1
+    tracking.team0 = team0
+    contact_labels = {}
+    for i, frame in enumerate(frames):
+        tracking.frameid[i] = frame.frameid
+        tracking.period[i] = getattr(frame, 'period', 0)
+        tracking.timestamp[i] = getattr(frame, 'timestamp', -1)
+        if frame.ball:
+            tracking.ball[i, :] = [frame.ball_pos_x, frame.ball_pos_y, frame.ball_pos_z, frame.ball_speed, getattr(
+                frame, 'ball_vx', np.nan), getattr(frame, 'ball_vy', np.nan), getattr(frame, 'ball_vz', np.nan)]
+            tracking.ball_team[i] = BALL_TEAM_CODES.get(frame.ball_team, -1)
+            tracking.ball_status[i] = BALL_STATUS_CODES.get(frame.ball_status, -1)
+            if frame.ball_contact_info is not None:
+                if frame.ball_contact_info not in contact_labels:
+                    contact_labels[frame.ball_contact_info] = len(contact_labels)
+                tracking.ball_contact[i] = contact_labels[frame.ball_contact_info]
+    tracking.ball_contact_labels = sorted(contact_labels.keys(), key=lambda x: contact_labels[x])
+    # team centre of mass, if it has been calculated (see Tracking_Velocities.estimate_com_frames)
+    for k in ['team1_x', 'team1_y', 'team1_vx', 'team1_vy', 'team0_x', 'team0_y', 'team0_vx', 'team0_vy']:
+        if len(frames) > 0 and hasattr(frames[0], k):
+            tracking.frame_data[k] = np.array([getattr(frame, k) for frame in frames], dtype=float)
+    return tracking
+
+
+def frame_targets_to_array(frames, team):
+    # collects the players of team 1 (home) or 0 (away) in a list of tracab_frames into a (nframes, nslots, NPLAYER_FIELDS) array
+    # returns the array, the jersey number in each slot, and the frame number, slot and tracab_target of every player in every frame
+    fnums = []
+    jnums = []
+    targets = []
+    for i, frame in enumerate(frames):
+        players = frame.team1_players if team == 1 else frame.team0_players
+        fnums.extend([i]*len(players))
+        jnums.extend(players.keys())
+        targets.extend(players.values())
+    fnums = np.array(fnums, dtype=int)
+    jerseys, slots = np.unique(np.array(jnums, dtype=int), return_inverse=True)
+    data = np.nan*np.zeros((len(frames), len(jerseys), NPLAYER_FIELDS), dtype=float)
+    if len(targets) > 0:
+        for k, field in [(X, 'pos_x'), (Y, 'pos_y'), (SPEED, 'speed')]:
+            data[fnums, slots, k] = np.fromiter(
+                map(operator.attrgetter(field), targets), dtype=float, count=len(targets))
+        if hasattr(targets[0], 'vx'):  # velocities have been measured
+            data[fnums, slots, VX] = [getattr(target, 'vx', np.nan) for target in targets]
+            data[fnums, slots, VY] = [getattr(target, 'vy', np.nan) for target in targets]
+    return data, jerseys, fnums, slots, targets
+
+
+class frame_time_index(object):
+    # maps (half, timestamp) to a frame number by binary search on the frame timestamps of each half
+    # period and timestamp are per-frame arrays (see Tracab.timestamp_frames); the frames of each half must be contiguous
+    # and in time order. source is the frame list or store that the index was built from
+    def __init__(self, period, timestamp, source=None):
+        self.period = np.asarray(period, dtype=np.int8)
+        self.timestamp = np.asarray(timestamp, dtype=float)
+        self.nframes = len(self.period)
+        self.source_id = _source_id(source)
+        # index of the first frame in each half, and the timestamps of the frames in the half
+        self.half_start = {}
+        self.half_timestamps = {}
+        for p in [1, 2]:
+            inperiod = np.flatnonzero(self.period == p)
+            if len(inperiod) > 0:
+                self.half_start[p] = inperiod[0]
+                self.half_timestamps[p] = self.timestamp[inperiod[0]:inperiod[-1]+1]
+
+    def framenum(self, half, timestamp):
+        # number of the first frame in the half at or after timestamp (one past the end of the half if there isn't one)
+        if half not in self.half_start:
+            raise ValueError("no frames in half %s" % (half,))
+        return int(self.half_start[half] + np.searchsorted(self.half_timestamps[half], timestamp, side='left'))
+
+    def frame_range(self, tstart, tend):
+        # (first, last+1) frame numbers between two times. tstart, tend are tuples (half [1,2], timestamp)
+        return self.framenum(*tstart), self.framenum(*tend)
+
+    def matches(self, frames):
+        return self.nframes == len(frames) and self.source_id == _source_id(frames)
+
+
+def _source_id(frames):
+    # identity of the frame list or store an index was built from (tracking_frames views are recreated on every access)
+    if isinstance(frames, tracking_frames):
+        frames = frames.tracking
+    return None if frames is None else id(frames)
+
+
+def get_time_index(frames, match):
+    # the frame_time_index of frames, kept on match so that it is built once for a given list of frames
+    index = getattr(match, 'time_index', None)
+    if index is None or not index.matches(frames):
+        if isinstance(frames, tracking_arrays):
+            index = frame_time_index(frames.period, frames.timestamp, frames)
+        elif isinstance(frames, tracking_frames):
+            index = frame_time_index(
+                frames.tracking.period, frames.tracking.timestamp, frames)
+        else:
+            index = frame_time_index([f.period for f in frames], [
+                                     f.timestamp for f in frames], frames)
+        match.time_index = index
+    return index
+
+
+class tracking_frames(object):
+    # sequence of array_frame views over a tracking_arrays store. Slicing returns a list, like slicing the old frame list
+    def __init__(self, tracking):
+        self.tracking = tracking
+
+    def __len__(self):
+        return self.tracking.nframes
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [array_frame(self.tracking, k) for k in range(*i.indices(self.tracking.nframes))]
+        if i < 0:
+            i += self.tracking.nframes
+        if i < 0 or i >= self.tracking.nframes:
+            raise IndexError("frame index out of range")
+        return array_frame(self.tracking, i)
+
+    def __iter__(self):
+        for i in range(self.tracking.nframes):
+            yield array_frame(self.tracking, i)
+
+
+class array_frame(object):
+    # view of a single frame in a tracking_arrays store, with the same attributes as a tracab_frame
+    def __init__(self, tracking, i):
+        self.provider = 'Tracab'
+        self.tracking = tracking
+        self.i = i
+
+    @property
+    def frameid(self):
+        return int(self.tracking.frameid[self.i])
+
+    @property
+    def period(self):
+        return int(self.tracking.period[self.i])
+
+    @property
+    def timestamp(self):
+        return float(self.tracking.timestamp[self.i])
+
+    @property
+    def min(self):
+        return str(int(self.timestamp))
+
+    @property
+    def sec(self):
+        return "%1.2f" % (round((self.timestamp-int(self.timestamp))*60., 3))
+
+    @property
+    def team1_jersey_nums_in_frame(self):
+        return self.tracking.jersey_nums_in_frame(self.i, 1)
+
+    @property
+    def team0_jersey_nums_in_frame(self):
+        return self.tracking.jersey_nums_in_frame(self.i, 0)
+
+    @property
+    def team1_players(self):
+        return self.get_players(1)
+
+    @property
+    def team0_players(self):
+        return self.get_players(0)
+
+    def get_players(self, team):
+        players, jerseys, _ = self.tracking.get_team(team)
+        row = players[self.i]
+        targets = {}
+        for s in np.flatnonzero(~np.isnan(row[:, X])):
+            targets[int(jerseys[s])] = array_target(row[s], team, int(jerseys[s]))
+        return targets
+
+    @property
+    def referee(self):
+        if self.tracking.referee is None or np.isnan(self.tracking.referee[self.i, X]):
+            return None
+        return array_target(self.tracking.referee[self.i], 3, 0)
+
+    @property
+    def ball(self):
+        return not np.isnan(self.tracking.ball[self.i, BALL_X])
+
+    @property
+    def ball_pos_x(self):
+        return self.tracking.ball[self.i, BALL_X]
+
+    @property
+    def ball_pos_y(self):
+        return self.tracking.ball[self.i, BALL_Y]
+
+    @property
+    def ball_pos_z(self):
+        return self.tracking.ball[self.i, BALL_Z]
+
+    @property
+    def ball_speed(self):
+        return self.tracking.ball[self.i, BALL_SPEED]
+
+    @property
+    def ball_vx(self):
+        return self.tracking.ball[self.i, BALL_VX]
+
+    @property
+    def ball_vy(self):
+        return self.tracking.ball[self.i, BALL_VY]
+
+    @property
+    def ball_vz(self):
+        return self.tracking.ball[self.i, BALL_VZ]
+
+    @property
+    def ball_speed_filter2(self):
+        return np.sqrt(self.ball_vx**2 + self.ball_vy**2)
+
+    @property
+    def ball_speed_filter3(self):
+        return np.sqrt(self.ball_vx**2 + self.ball_vy**2 + self.ball_vz**2)
+
+    @property
+    def ball_team(self):
+        return BALL_TEAM_LABELS.get(int(self.tracking.ball_team[self.i]))
+
+    @property
+    def ball_status(self):
+        return BALL_STATUS_LABELS.get(int(self.tracking.ball_status[self.i]))
+
+    @property
+    def ball_contact_info(self):
+        c = self.tracking.ball_contact[self.i]
+        return None if c < 0 else self.tracking.ball_contact_labels[c]
+
+    def __getattr__(self, name):
+        # other per-frame quantities, e.g. team1_x (team centre of mass)
+        frame_data = self.__dict__['tracking'].frame_data
+        if name in frame_data:
+            return frame_data[name][self.__dict__['i']]
+        raise AttributeError(name)
+
+    def __repr__(self):
+        nplayers = len(self.team1_jersey_nums_in_frame) + \
+            len(self.team0_jersey_nums_in_frame)
+        nrefs = 0 if self.referee is None else 1
+        s = 'Frame id: %d, nplayers: %d, nrefs: %d, nballs: %d' % (
+            self.frameid, nplayers, nrefs, self.ball*1)
+        return s
+
+
+class array_target(object):
+    # view of a single player in a single frame, with the same attributes as a tracab_target
+    # row is a view into the store, so setting e.g. vx writes through to the arrays
+    def __init__(self, row, team, jersey_num):
+        self.row = row
+        self.team = team
+        self.sys_target_ID = None
+        self.jersey_num = jersey_num
+
+    @property
+    def pos_x(self):
+        return self.row[X]
+
+    @pos_x.setter
+    def pos_x(self, value):
+        self.row[X] = value
+
+    @property
+    def pos_y(self):
+        return self.row[Y]
+
+    @pos_y.setter
+    def pos_y(self, value):
+        self.row[Y] = value
+
+    @property
+    def speed(self):
+        return self.row[SPEED]
+
+    @speed.setter
+    def speed(self, value):
+        self.row[SPEED] = value
+
+    @property
+    def vx(self):
+        return self.row[VX]
+
+    @vx.setter
+    def vx(self, value):
+        self.row[VX] = value
+
+    @property
+    def vy(self):
+        return self.row[VY]
+
+    @vy.setter
+    def vy(self, value):
+        self.row[VY] = value
+
+    @property
+    def speed_filter(self):
+        return np.sqrt(self.row[VX]**2 + self.row[VY]**2)
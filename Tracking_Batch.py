@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:21:09 2026
+
+Module for processing a season of matches in parallel. process_matches runs a per-match task (e.g. reading a Tracab match,
+finding its possessions and measuring formations, or reading the OPTA f7/f24 files) in a pool of worker processes. Each task
+returns a compact, picklable result rather than the full list of frames, a failure in one match is recorded without stopping
+the others, and worker processes are replaced after a number of matches to stop memory use from growing over a season.
+"""
+
+import Tracab as tracab
+import Tracking_Formation as form
+import OPTA as opta
+import numpy as np
+import concurrent.futures as futures
+import copy
+import os
+import sys
+import time
+import traceback
+
+
+def process_matches(task, match_ids, args=(), kwargs=None, max_workers=None, max_tasks_per_child=4, max_retries=1, progress=True):
+    # runs task(match_id, *args, **kwargs) for every match id in a pool of max_workers processes (default: one per cpu). task must be
+    # a module level function so that it can be sent to the workers. Each worker process is replaced after max_tasks_per_child
+    # matches. progress is True to print a line as each match finishes, or a function called with (ndone, ntotal, match_id, ok)
+    # Returns (results, failures): dictionaries keyed by match id of the task results, and of the error message of each match
+    # that failed. Matches that were running when a worker process died (e.g. ran out of memory) are retried up to max_retries times,
+    # each in a pool of its own so that only the match that kills its worker fails
+    # Workers may be started by importing the calling script, so scripts that call this need an if __name__ == '__main__' guard
+    kwargs = {} if kwargs is None else kwargs
+    match_ids = list(match_ids)
+    results = {}
+    failures = {}
+    attempts = dict((m, 0) for m in match_ids)
+    pending = list(match_ids)
+    tstart = time.time()
+    isolate = False
+    while pending:
+        retry = []
+        batches = [[m] for m in pending] if isolate else _worker_batches(
+            pending, max_workers, max_tasks_per_child)
+        for batch in batches:
+            with _make_executor(1 if isolate else max_workers, max_tasks_per_child) as executor:
+                jobs = dict((executor.submit(_run_task, task, m, args, kwargs), m)
+                            for m in batch)
+                for job in futures.as_completed(jobs):
+                    m = jobs[job]
+                    attempts[m] += 1
+                    try:
+                        ok, value = job.result()
+                    except futures.process.BrokenProcessPool:
+                        if attempts[m] <= max_retries:
+                            retry.append(m)
+                            continue
+                        ok, value = False, 'worker process died'
+                    if ok:
+                        results[m] = value
+                    else:
+                        failures[m] = value
+                    _report_progress(progress, len(results)+len(failures), len(match_ids), m, ok, tstart)
+        pending = retry
+        isolate = True
+    return results, failures
+
+
+def _run_task(task, match_id, args, kwargs):
+    # runs in a worker process: exceptions are returned as a traceback string so that one bad match doesn't stop the batch
+    try:
+        return True, task(match_id, *args, **kwargs)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _make_executor(max_workers, max_tasks_per_child):
+    # worker recycling (max_tasks_per_child) needs python 3.11. Otherwise _worker_batches splits the matches into batches that are
+    # each run in a new pool
+    try:
+        return futures.ProcessPoolExecutor(max_workers=max_workers, max_tasks_per_child=max_tasks_per_child)
+    except TypeError:
+        return futures.ProcessPoolExecutor(max_workers=max_workers)
+
+
+def _worker_batches(match_ids, max_workers, max_tasks_per_child):
+    if sys.version_info >= (3, 11) or max_tasks_per_child is None:
+        return [match_ids]
+    nworkers = os.cpu_count() if max_workers is None else max_workers
+    n = max(1, nworkers*max_tasks_per_child)
+    return [match_ids[i:i+n] for i in range(0, len(match_ids), n)]
+
+
+def _report_progress(progress, ndone, ntotal, match_id, ok, tstart):
+    if callable(progress):
+        progress(ndone, ntotal, match_id, ok)
+    elif progress:
+        print("[%d/%d] match %s %s (%1.0f s)" % (ndone, ntotal, match_id,
+                                                 'done' if ok else 'FAILED', time.time()-tstart))
+        sys.stdout.flush()
+
+
+def tracab_formation_task(match_id, fpath, league='DSL', min_pos_length=60., max_pos_length=120., subsample=10, min_possession=5.):
+    # reads a Tracab match, finds its possessions and measures the attacking and defensive formations of each team in
+    # possession windows of min_pos_length to max_pos_length seconds (as in clustering_example.py). Possessions in the
+    # defensive quarter, bad possessions and those shorter than min_possession seconds that don't start with a dead ball are
+    # not used. Returns a dictionary with the match metadata, the possessions, the formations (with their lattices deleted) and
+    # the counts (match_id, home attacking, home defensive, away attacking, away defensive) - but not the frames
+    fname = str(match_id)
+    frames_tb, match_tb, team1_players, team0_players = tracab.read_tracab_match_data(
+        league, fpath, fname, verbose=False)
+    posessions = tracab.get_tracab_posessions(frames_tb, match_tb, min_pos_length=1)
+    use = np.isin(posessions.pos_type, ['A', 'N']) & ~posessions.bad_possesion & (
+        (posessions.pos_duration > min_possession) | (posessions.pos_start_type == 'DeadBall'))
+    formations = {}
+    for team in ['H', 'A']:
+        team_posessions = list(posessions[use & (posessions.team == team)])
+        if len(team_posessions) == 0:
+            formations[team] = ([], [])
+            continue
+        formations[team] = form.calc_formation_by_period(max_pos_length, min_pos_length, team_posessions, frames_tb, match_tb, subsample,
+                                                         match_tb.team1_exclude, match_tb.team0_exclude, plotfig=False, deleteLattices=True)
+    A, D = formations['H']
+    A2, D2 = formations['A']
+    return {'match_id': match_id,
+            'match': compact_match(match_tb),
+            'posessions': posessions,
+            'formations': A + D + A2 + D2,
+            'stats': (match_id, len(A), len(D), len(A2), len(D2))}
+
+
+def compact_match(match):
+    # copy of a tracab_match without the per-frame time index, to send back from a worker
+    match = copy.copy(match)
+    if hasattr(match, 'time_index'):
+        del match.time_index
+    return match
+
+
+def opta_match_task(match_id, fpath):
+    # reads the OPTA f7 and f24 files of a match. The BeautifulSoup markup kept by the OPTA objects is dropped
+    fname = str(match_id)
+    match_OPTA = opta.read_OPTA_f7(fpath, fname)
+    match_OPTA = opta.read_OPTA_f24(fpath, fname, match_OPTA)
+    return drop_raw_markup(match_OPTA)
+
+
+def drop_raw_markup(match_OPTA):
+    # the raw xml elements are only needed while reading a match, and are large and slow to pickle
+    match_OPTA.raw = None
+    for team in [match_OPTA.hometeam, match_OPTA.awayteam]:
+        team.raw = None
+        for player in team.players:
+            player.raw = None
+    for e in match_OPTA.events:
+        e.raw = None
+    return match_OPTA
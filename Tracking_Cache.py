@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:02:47 2026
+
+Module for caching parsed Tracab matches on disk. A match is read once (with Tracab.read_tracab_match_arrays),
+and the timestamped, velocity-annotated arrays are saved as .npy files with a small JSON metadata file, so that
+later runs can memory-map them rather than reparse the raw data. Entries are keyed by a hash of the raw .dat and
+metadata files and of the reader parameters, and the least recently used entries are deleted when the cache
+exceeds its disk budget.
+"""
+
+import Tracab as tracab
+import Tracking_Arrays as ta
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# bump when the layout of a cache entry changes: entries written with a different version are ignored
+CACHE_VERSION = 2
+# default location and disk budget (in bytes) of the cache
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.tracab_cache')
+default_max_bytes = 5*2**30
+# reader parameters (see Tracab.read_tracab_match_arrays) that are part of the cache key, and their defaults
+default_params = {'during_match_only': True,
+                  'player_window': 7, 'player_polyorder': 1, 'player_maxspeed': 14,
+                  'ball_window': 5, 'ball_polyorder': 3, 'ball_maxspeed': 40}
+# arrays in a tracking_arrays store that are saved in a cache entry (frame_data and referee are handled separately)
+_arrays = ['frameid', 'team1', 'team0', 'ball', 'ball_team',
+           'ball_status', 'ball_contact', 'period', 'timestamp']
+
+
+def read_tracab_match_cached(league, fpath, fname, cache_dir=None, max_bytes=None, mmap_mode='c', verbose=False, **params):
+    # returns (tracking, match) as Tracab.read_tracab_match_arrays, from the cache if this match has been read with the same
+    # parameters before. params are any of default_params. mmap_mode is passed to np.load: 'c' (copy on write) lets the
+    # arrays be modified in memory without changing the cache, 'r' is read only and None reads the arrays into memory
+    cache_dir = default_cache_dir if cache_dir is None else cache_dir
+    max_bytes = default_max_bytes if max_bytes is None else max_bytes
+    for k in params.keys():
+        if k not in default_params:
+            raise TypeError("unknown reader parameter '%s'" % (k))
+    reader_params = dict(default_params)
+    reader_params.update(params)
+    fmetadata, fdata = tracab.get_tracabdata_paths(fpath, fname, league)
+    key = cache_key([fmetadata, fdata], reader_params)
+    entry = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(entry, 'metadata.json')):
+        try:
+            tracking, match = load_tracking_arrays(entry, mmap_mode=mmap_mode)
+            touch_cache_entry(entry)
+            if verbose:
+                print("Loaded match %s from cache %s" % (fname, entry))
+            return tracking, match
+        except (IOError, OSError, ValueError, KeyError) as err:
+            # a corrupt or out of date entry: read the raw data again
+            print("Ignoring cache entry %s: %s" % (entry, err))
+            shutil.rmtree(entry, ignore_errors=True)
+    if verbose:
+        print("Match %s not in cache, reading raw data" % (fname))
+    tracking, match = tracab.read_tracab_match_arrays(
+        league, fpath, fname, verbose=verbose, **reader_params)
+    save_tracking_arrays(entry, tracking, match, extra={
+                         'source': [fmetadata, fdata], 'params': reader_params})
+    evict_cache_entries(cache_dir, max_bytes, keep=[key])
+    if mmap_mode is not None:  # return the memory-mapped arrays so that a cold and warm read behave the same way
+        tracking, match = load_tracking_arrays(entry, mmap_mode=mmap_mode)
+    return tracking, match
+
+
+def cache_key(files, params):
+    # hex digest of the contents of files and the (json serializable) params
+    h = hashlib.sha1()
+    h.update(('%d' % (CACHE_VERSION)).encode())
+    for fn in files:
+        with open(fn, 'rb') as fp:
+            while True:
+                chunk = fp.read(2**22)
+                if not chunk:
+                    break
+                h.update(chunk)
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def save_tracking_arrays(entry, tracking, match, extra=None):
+    # writes a tracking_arrays store and its tracab_match to the directory entry. The directory is written under a
+    # temporary name and then renamed, so a partly written entry is never read
+    parent = os.path.dirname(os.path.abspath(entry))
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+    try:
+        for k in _arrays:
+            np.save(os.path.join(tmp, k+'.npy'), getattr(tracking, k))
+        if tracking.referee is not None:
+            np.save(os.path.join(tmp, 'referee.npy'), tracking.referee)
+        for k in tracking.frame_data.keys():
+            np.save(os.path.join(tmp, 'frame_data_'+k+'.npy'),
+                    tracking.frame_data[k])
+        metadata = {'version': CACHE_VERSION,
+                    'created': time.time(),
+                    'team1_jerseys': [int(j) for j in tracking.team1_jerseys],
+                    'team0_jerseys': [int(j) for j in tracking.team0_jerseys],
+                    'ball_contact_labels': tracking.ball_contact_labels,
+                    'referee': tracking.referee is not None,
+                    'frame_data': sorted(tracking.frame_data.keys()),
+                    'match': match_to_json(match)}
+        if extra is not None:
+            metadata.update(extra)
+        with open(os.path.join(tmp, 'metadata.json'), 'w') as fp:
+            json.dump(metadata, fp, indent=1)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return entry
+
+
+def load_tracking_arrays(entry, mmap_mode='c'):
+    # reads a tracking_arrays store and tracab_match written by save_tracking_arrays
+    with open(os.path.join(entry, 'metadata.json'), 'r') as fp:
+        metadata = json.load(fp)
+    if metadata['version'] != CACHE_VERSION:
+        raise ValueError("cache version %s, expected %d" %
+                         (metadata['version'], CACHE_VERSION))
+    arrays = dict((k, np.load(os.path.join(entry, k+'.npy'), mmap_mode=mmap_mode))
+                  for k in _arrays)
+    tracking = ta.tracking_arrays(arrays['frameid'], arrays['team1'], metadata['team1_jerseys'], arrays['team0'], metadata['team0_jerseys'],
+                                  arrays['ball'], arrays['ball_team'], arrays['ball_status'], arrays['ball_contact'], metadata['ball_contact_labels'])
+    tracking.period = arrays['period']
+    tracking.timestamp = arrays['timestamp']
+    if metadata['referee']:
+        tracking.referee = np.load(os.path.join(
+            entry, 'referee.npy'), mmap_mode=mmap_mode)
+    for k in metadata['frame_data']:
+        tracking.frame_data[k] = np.load(os.path.join(
+            entry, 'frame_data_'+k+'.npy'), mmap_mode=mmap_mode)
+    match = match_from_json(metadata['match'])
+    return tracking, match
+
+
+def match_to_json(match):
+    # the tracab_match attributes, in a form that can be written with json (period numbers are dictionary keys)
+    periods = dict((str(p), dict((k, _json_value(v)) for k, v in attributes.items()))
+                   for p, attributes in match.period_attributes.items())
+    m = {'match_attributes': dict(match.match_attributes),
+         'period_attributes': periods}
+    if hasattr(match, 'period_parity'):
+        m['period_parity'] = dict((str(p), v)
+                                  for p, v in match.period_parity.items())
+    for k in ['team1_exclude', 'team0_exclude']:
+        if hasattr(match, k):
+            m[k] = [int(j) for j in getattr(match, k)]
+    return m
+
+
+def match_from_json(m):
+    periods = dict((int(p), attributes)
+                   for p, attributes in m['period_attributes'].items())
+    # tracab_match casts the period attributes to int, so keep the floats (e.g. iEndTime) to one side
+    floats = dict((p, dict((k, v) for k, v in attributes.items() if isinstance(v, float)))
+                  for p, attributes in periods.items())
+    match = tracab.tracab_match(m['match_attributes'], dict((p, dict((k, v) for k, v in attributes.items() if not isinstance(v, float)))
+                                                           for p, attributes in periods.items()))
+    for p in floats.keys():
+        match.period_attributes[p].update(floats[p])
+    if 'period_parity' in m:
+        match.period_parity = dict((int(p), v)
+                                   for p, v in m['period_parity'].items())
+    for k in ['team1_exclude', 'team0_exclude']:
+        if k in m:
+            setattr(match, k, m[k])
+    return match
+
+
+def _json_value(v):
+    # numpy scalars are not json serializable
+    if isinstance(v, np.integer):
+        return int(v)
+    if isinstance(v, np.floating):
+        return float(v)
+    if isinstance(v, np.str_):
+        return str(v)
+    return v
+
+
+def touch_cache_entry(entry):
+    # records that an entry has been used (the modification time of the metadata file is used for LRU eviction)
+    os.utime(os.path.join(entry, 'metadata.json'), None)
+
+
+def cache_entries(cache_dir):
+    # list of (last used time, size in bytes, path) of every entry in the cache, least recently used first
+    entries = []
+    if not os.path.exists(cache_dir):
+        return entries
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        metadata = os.path.join(entry, 'metadata.json')
+        if key.startswith('.') or not os.path.exists(metadata):
+            continue
+        size = sum([os.path.getsize(os.path.join(entry, fn))
+                    for fn in os.listdir(entry)])
+        entries.append((os.path.getmtime(metadata), size, entry))
+    return sorted(entries)
+
+
+def evict_cache_entries(cache_dir, max_bytes, keep=[]):
+    # deletes the least recently used entries until the cache takes up at most max_bytes. Entries in keep are not deleted
+    entries = cache_entries(cache_dir)
+    total = sum([e[1] for e in entries])
+    evicted = []
+    for last_used, size, entry in entries:
+        if total <= max_bytes:
+            break
+        if os.path.basename(entry) in keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        evicted.append(entry)
+    return evicted
+
+
+def clear_cache(cache_dir=None):
+    cache_dir = default_cache_dir if cache_dir is None else cache_dir
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
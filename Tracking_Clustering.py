@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:34:05 2026
+
+Module for hierarchical clustering of formation libraries that are too large for a dense (nformations x nformations) distance
+matrix. The distances between formations are only computed when they are needed (formation_distances, with a bounded LRU cache),
+the clustering is done on a sparse graph of each formation's k nearest neighbours (found with Tracking_Index.formation_index),
+and the result is a scipy linkage matrix and the same ctypes as Tracking_Formation.make_dendogram, so that
+generate_formation_from_sub_cluster can build the cluster templates (with formation_distances in place of Amatrix).
+"""
+
+import Tracking_Formation as form
+import numpy as np
+import scipy.cluster.hierarchy as sch
+import scipy.sparse as sparse
+import collections
+import heapq
+
+default_squeeze = [0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5]
+
+
+class formation_distances(object):
+    # Hungarian_Cost between formations, computed when they are first asked for: D[i, j] is the cost between formations i and j
+    # (and D.squeeze(i, j) the best squeeze value), so a formation_distances can be used in place of Amatrix for indexing single
+    # pairs (e.g. in generate_formation_from_sub_cluster). At most cache_size pairs are kept, the least recently used are dropped
+    def __init__(self, formations, metric='WM', squeeze=default_squeeze, cache_size=2**20):
+        self.snapshots = [F if isinstance(F, form.formation_arrays) else form.formation_arrays(F) for F in formations]
+        self.metric = metric
+        self.squeeze_values = squeeze
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.shape = (len(self.snapshots), len(self.snapshots))
+        self.ncomputed = 0
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def __getitem__(self, ij):
+        return self.cost(*ij)[0]
+
+    def squeeze(self, i, j):
+        return self.cost(i, j)[1]
+
+    def cost(self, i, j):
+        # (cost, squeeze) between formations i and j. Hungarian_Cost isn't symmetric in the squeeze value, so the pair is always
+        # computed with the lower index first (as the upper triangle of Amatrix in formation_distance_matrix)
+        i, j = int(i), int(j)
+        if i == j:
+            return 0., 1.
+        key = (i, j) if i < j else (j, i)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        c, pids1, pmatch, s = form.Hungarian_Cost(
+            self.snapshots[key[0]], self.snapshots[key[1]], None, metric=self.metric, squeeze=self.squeeze_values)
+        self.ncomputed += 1
+        self.cache[key] = (c, s)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return c, s
+
+    def add(self, i, j, c, s):
+        # records a cost that is already known (e.g. from formation_index.query)
+        key = (int(i), int(j)) if i < j else (int(j), int(i))
+        self.cache[key] = (c, s)
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+
+def knn_graph(index, nformations, k=15, ncandidates=None, distances=None):
+    # sparse (nformations x nformations) matrix of the cost between each formation in index (a Tracking_Index.formation_index over
+    # the formations) and its k most similar formations, made symmetric. Formations that aren't in the index have no edges
+    # ncandidates (default 2*(k+1)) are compared exactly for each formation, so this takes nformations*ncandidates Hungarian_Costs
+    # The costs found are added to distances (a formation_distances), if given
+    ncandidates = 2*(k+1) if ncandidates is None else ncandidates
+    edges = {}
+    for i, S in zip(index.indices, index.snapshots):
+        neighbours, costs, squeezes = index.query(S, k=k+1, ncandidates=ncandidates)
+        for j, c, s in zip(neighbours, costs, squeezes):
+            if j == i:
+                continue
+            key = (int(i), int(j)) if i < j else (int(j), int(i))
+            if key not in edges:
+                edges[key] = c
+            # Hungarian_Cost isn't quite symmetric in the squeeze value: keep the lower cost
+            edges[key] = min(edges[key], c)
+            if distances is not None and i < j:
+                distances.add(i, j, c, s)
+    rows = np.array([e[0] for e in edges.keys()], dtype=int)
+    cols = np.array([e[1] for e in edges.keys()], dtype=int)
+    data = np.array(list(edges.values()), dtype=float)
+    # explicit zeros (identical formations) are kept
+    return sparse.csr_matrix((np.concatenate((data, data)), (np.concatenate((rows, cols)), np.concatenate((cols, rows)))),
+                             shape=(nformations, nformations))
+
+
+def sparse_linkage(graph, method='average', distances=None, max_pairs=64):
+    # agglomerative clustering restricted to the edges of graph (a sparse symmetric matrix of distances). Returns a linkage matrix
+    # in the format of scipy.cluster.hierarchy.linkage. Clusters are only merged along edges, and the distances from a merged cluster
+    # are updated with the Lance-Williams formula for method ('average' or 'single'). When a neighbour K of the merged cluster is
+    # only a neighbour of one of the two clusters I and J, say I, the missing distance d(J,K) is computed from distances (a
+    # formation_distances) if J and K have at most max_pairs pairs of formations between them. Otherwise K keeps its distance to I
+    # (as in connectivity-constrained agglomerative clustering). Clusters that are not connected are merged at the end, at twice
+    # the largest merge distance. Merge distances are made non-decreasing so that the linkage can be cut with fcluster
+    if method not in ['average', 'single']:
+        raise ValueError("sparse_linkage supports 'average' and 'single' linkage, not '%s'" % (method))
+    n = graph.shape[0]
+    graph = sparse.coo_matrix(graph)
+    neighbours = [dict() for i in range(2*n-1)]
+    for i, j, d in zip(graph.row.tolist(), graph.col.tolist(), graph.data.tolist()):
+        if i != j:
+            neighbours[i][j] = d
+    members = [[i] for i in range(n)] + [None]*(n-1)
+    size = np.ones(2*n-1, dtype=int)
+    active = np.zeros(2*n-1, dtype=bool)
+    active[:n] = True
+    heap = [(d, i, j) for i in range(n) for j, d in neighbours[i].items() if i < j]
+    heapq.heapify(heap)
+    L = np.zeros((max(n-1, 0), 4))
+    m = 0
+
+    def cluster_distance(a, b):
+        # linkage distance between clusters a and b, from the distances between their formations (None if too many pairs)
+        if distances is None or size[a]*size[b] > max_pairs:
+            return None
+        d = [distances[p, q] for p in members[a] for q in members[b]]
+        return np.mean(d) if method == 'average' else np.min(d)
+
+    while heap:
+        d, i, j = heapq.heappop(heap)
+        if not (active[i] and active[j]) or neighbours[i].get(j) != d:
+            continue
+        u = n+m
+        L[m] = [i, j, d, size[i]+size[j]]
+        size[u] = size[i]+size[j]
+        members[u] = members[i] + members[j]
+        merged = {}
+        for k in set(neighbours[i].keys()) | set(neighbours[j].keys()):
+            if k == i or k == j:
+                continue
+            dik = neighbours[i][k] if k in neighbours[i] else cluster_distance(i, k)
+            djk = neighbours[j][k] if k in neighbours[j] else cluster_distance(j, k)
+            if dik is None or djk is None:
+                merged[k] = djk if dik is None else dik
+            elif method == 'average':
+                merged[k] = (size[i]*dik + size[j]*djk)/float(size[u])
+            else:
+                merged[k] = min(dik, djk)
+            neighbours[k].pop(i, None)
+            neighbours[k].pop(j, None)
+            neighbours[k][u] = merged[k]
+            heapq.heappush(heap, (merged[k], k, u))
+        neighbours[u] = merged
+        neighbours[i] = {}
+        neighbours[j] = {}
+        members[i] = members[j] = None
+        active[i] = active[j] = False
+        active[u] = True
+        m += 1
+    # join the clusters that are not connected
+    remaining = list(np.flatnonzero(active))
+    top = 2.*np.max(L[:m, 2]) if m > 0 else 1.
+    while len(remaining) > 1:
+        i, j = remaining[0], remaining[1]
+        u = n+m
+        L[m] = [i, j, top, size[i]+size[j]]
+        size[u] = size[i]+size[j]
+        remaining = [u] + remaining[2:]
+        m += 1
+    L[:, 2] = np.maximum.accumulate(L[:, 2]) if len(L) > 0 else L[:, 2]
+    return L
+
+
+def make_sparse_dendogram(index, formation_stats, nformations, k=15, t=80, method='average', ncandidates=None, distances=None, max_pairs=64):
+    # as Tracking_Formation.make_dendogram, from the sparse k nearest neighbour graph of the formations in index rather than a dense
+    # Amatrix. Returns (ctypes, L): the cluster of each formation (cut at distance t) and the linkage matrix
+    graph = knn_graph(index, nformations, k=k, ncandidates=ncandidates, distances=distances)
+    L = sparse_linkage(graph, method=method, distances=distances, max_pairs=max_pairs)
+    fcl = sch.fcluster(L, t=t, criterion='distance')
+    return form.formation_ctypes(fcl, formation_stats), L
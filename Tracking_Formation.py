@@ -13,12 +13,21 @@ import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from scipy.optimize import linear_sum_assignment
 import scipy.cluster.hierarchy as sch
-from scipy.linalg import sqrtm
 import copy as copy
 import itertools
 import data_utils as utils
-import pickle
+from Tracking_Cache import _json_value
 import scipy.stats as stats
+import concurrent.futures as futures
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# bump when the layout of a saved formation library changes: libraries written with a different version are not read
+FORMATION_LIBRARY_VERSION = 1
 
 
 def calc_formation_by_period(period_length, min_period_length, posessions, frames_tb, match_tb, subsample, excludeH, excludeA, plotfig=False, deleteLattices=False):
@@ -187,7 +196,11 @@ def make_dendogram(Amatrix, formation_stats, t=80, method='ward', dendogram=True
                               leaf_font_size=12., show_contracted=True, annotate_above=10)
     # group clusters
     fcl = sch.fcluster(L, t=t, criterion='distance', depth=2)
-    # now map formations to clusters
+    return formation_ctypes(fcl, formation_stats)
+
+
+def formation_ctypes(fcl, formation_stats):
+    # now map formations to clusters: (formation number, match, team, attacking/defending, cluster) for each formation, sorted by cluster
     ctypes = []
     tmat = ['A', 'D', 'A', 'D']
     count = 0
@@ -198,7 +211,7 @@ def make_dendogram(Amatrix, formation_stats, t=80, method='ward', dendogram=True
             for j in range(f[i]):
                 ctypes.append((count, f[0], teams[i-1], tmat[i-1], fcl[count]))
                 count += 1
-        ctypes = sorted(ctypes, key=lambda x: x[4])
+    ctypes = sorted(ctypes, key=lambda x: x[4])
     return ctypes
 
 
@@ -227,11 +240,12 @@ def fancy_dendrogram(*args, **kwargs):
     return ddata
 
 
-def generate_formation_from_sub_cluster(ctypes, all_formations, clusternums, Amatrix, match_tb, method='ward', squeeze=[0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5]):
+def generate_formation_from_sub_cluster(ctypes, all_formations, clusternums, Amatrix, match_tb, method='ward', squeeze=[0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5], merge_cache=None):
     '''
     rather than crudely averaging together formations in the same sub-cluster, we should build them hierarchically. 'cluster nums' is the clusters identified in the dendogram
     plus cut-off that determine which formation observations will be combined. Amatrix is the distance matrix between the observations. Squeeze contains the values of the
-    compactness parameter that we marginalize over.
+    compactness parameter that we marginalize over. merge_cache is an optional dictionary of the Hungarian_Cost of each merge, that can be
+    shared between calls (e.g. when the same sub-clusters are combined in different ways).
     '''
     # first need to get the formation ids in the sub-cluster. Also remove formations with less than 10 outfield players
     ctypes = [c for c in ctypes if c[4] in clusternums and len(
@@ -241,69 +255,71 @@ def generate_formation_from_sub_cluster(ctypes, all_formations, clusternums, Ama
     cluster_formations = [all_formations[n] for n in formation_nums]
     nformations = len(formation_nums)
     # now generate the distance submatrix for this cluster(s)
-    Asubmatrix = np.zeros((nformations, nformations))
-    for i in range(nformations):
-        for j in range(nformations):
-            Asubmatrix[i, j] = Amatrix[formation_nums[i], formation_nums[j]]
+    if isinstance(Amatrix, np.ndarray):
+        Asubmatrix = np.array(Amatrix[np.ix_(formation_nums, formation_nums)], dtype=float)
+    else:  # e.g. a Tracking_Clustering.formation_distances
+        Asubmatrix = np.zeros((nformations, nformations))
+        for i in range(nformations):
+            for j in range(nformations):
+                Asubmatrix[i, j] = Amatrix[formation_nums[i], formation_nums[j]]
     # convert distances to a 1-dy array
     d = sch.distance.squareform(Asubmatrix)
     # do the clustering
-    L = sch.linkage(d, method=method)
+    L = sch.linkage(d, method=method) if nformations > 1 else np.zeros((0, 4))
     #dn = fancy_dendrogram(L,truncate_mode='lastp',p=100,leaf_rotation=90.,leaf_font_size=12.,show_contracted=True,annotate_above=10)
     # now work way up tree
     scale = match_tb.fPitchYSizeMeters*2. / \
         3.  # set a cluster 'scale' width. Will try to use this to ensure averaged formation observations don't shrink or grow too much
-    for cluster_formation in cluster_formations:  # initialize some values
-        cluster_formation.n_in_cluster = 1
-        cluster_formation.nodes_cluster = {}
-        for pid in cluster_formation.pids:
-            x = cluster_formation.nodes[pid].x
-            y = cluster_formation.nodes[pid].y
-            cluster_formation.nodes_cluster[pid] = np.array([x, y])
-
-    for link in L:
+    # the formations and the clusters made by each merge are kept as arrays (the node positions, means and covariances of each role),
+    # leaf formations first then one per row of L
+    nclusters = 2*nformations - 1
+    positions = np.zeros((nclusters, 10, 2))
+    mu = np.zeros((nclusters, 10, 2))
+    cov = np.zeros((nclusters, 10, 2, 2))
+    n_in_cluster = np.ones(nclusters, dtype=int)
+    for i, cluster_formation in enumerate(cluster_formations):  # initialize some values
+        positions[i] = formation_positions(cluster_formation)
+        mu[i], cov[i] = formation_covariances(cluster_formation)
+    widths = np.zeros(nclusters)
+    widths[:nformations] = np.max(positions[:nformations, :, 1], axis=1) - np.min(positions[:nformations, :, 1], axis=1)
+    merges = []
+    merge_cache = {} if merge_cache is None else merge_cache
+    for m, link in enumerate(L):
         # now work our way up the dendogram, combining formations as we go
-        f1 = cluster_formations[int(link[0])]  # first formation/cluster
-        f2 = cluster_formations[int(link[1])]  # second formation/cluster
-        f1.width = max([f1.nodes[pid].y for pid in f1.pids]) - \
-            min([f1.nodes[pid].y for pid in f1.pids])
-        f2.width = max([f2.nodes[pid].y for pid in f2.pids]) - \
-            min([f2.nodes[pid].y for pid in f2.pids])
-        if np.abs(f1.width-scale) > np.abs(f2.width-scale):
+        c1 = int(link[0])  # first formation/cluster
+        c2 = int(link[1])  # second formation/cluster
+        if np.abs(widths[c1]-scale) > np.abs(widths[c2]-scale):
             # switch ordering to try to maintain constant scale size
-            f1 = cluster_formations[int(link[1])]
-            f2 = cluster_formations[int(link[0])]
+            c1, c2 = c2, c1
         # calculate Wasserstein distance again, marginalising over the 'squeeze' parameters
-        c, pids1, pids2, s = Hungarian_Cost(
-            f1, f2, match_tb, metric='WM', plot=False, squeeze=squeeze)
+        c, col_ind, s = _merge_cost(positions[c1], cov[c1], positions[c2], cov[c2], squeeze, merge_cache)
         # create a new formation cluster from the combined formations
-        clustered_formation = formation('C')
-        clustered_formation.is_cluster_template = False
-        clustered_formation.nodes = {}
-        clustered_formation.nodes_cluster = {}
-        clustered_formation.formation_distributions = {}
-        clustered_formation.n_in_cluster = f1.n_in_cluster + f2.n_in_cluster
-        w1 = f1.n_in_cluster/float(clustered_formation.n_in_cluster)
-        w2 = f2.n_in_cluster/float(clustered_formation.n_in_cluster)
+        u = nformations + m
+        n_in_cluster[u] = n_in_cluster[c1] + n_in_cluster[c2]
+        w1 = n_in_cluster[c1]/float(n_in_cluster[u])
+        w2 = n_in_cluster[c2]/float(n_in_cluster[u])
         # quick check that the number of formation observations in the combined cluster is what it is supposed to be.
-        assert clustered_formation.n_in_cluster == link[3]
-        for i, pid in enumerate(pids1):
-            # average positions
-            xm = w1*f1.formation_distributions[pid][0][0] + \
-                w2*f2.formation_distributions[pids2[i]][0][0]*s
-            ym = w1*f1.formation_distributions[pid][0][1] + \
-                w2*f2.formation_distributions[pids2[i]][0][1]*s
-            cov = f1.formation_distributions[pid][1]*w1 + \
-                f2.formation_distributions[pids2[i]][1]*w2*s*s
-            clustered_formation.formation_distributions[i] = [
-                np.array([xm, ym]), cov]
-            clustered_formation.nodes[i] = node(i, xm, ym)
-            clustered_formation.nodes_cluster[i] = np.vstack(
-                (f1.nodes_cluster[pid], f2.nodes_cluster[pids2[i]]*s))
-        clustered_formation.pids = clustered_formation.nodes.keys()
-        cluster_formations.append(clustered_formation)
+        assert n_in_cluster[u] == link[3]
+        # average positions
+        mu[u] = w1*mu[c1] + w2*mu[c2][col_ind]*s
+        cov[u] = cov[c1]*w1 + cov[c2][col_ind]*w2*s*s
+        positions[u] = mu[u]
+        widths[u] = np.max(positions[u, :, 1]) - np.min(positions[u, :, 1])
+        merges.append((c1, c2, col_ind, s))
     # get the final formation at the top of the tree
-    cluster_formation = cluster_formations[-1]
+    top = nclusters - 1
+    cluster_formation = formation('C')
+    cluster_formation.is_cluster_template = False
+    cluster_formation.n_in_cluster = int(n_in_cluster[top])
+    cluster_formation.pids = list(range(10))
+    cluster_formation.nodes = {}
+    cluster_formation.formation_distributions = {}
+    for i in cluster_formation.pids:
+        cluster_formation.formation_distributions[i] = [mu[top, i], cov[top, i]]
+        cluster_formation.nodes[i] = node(i, mu[top, i, 0], mu[top, i, 1])
+    # the points of every formation in the cluster, for each role
+    nodes_cluster = cluster_points(positions[:nformations], merges, nformations)
+    cluster_formation.nodes_cluster = dict((i, nodes_cluster[i]) for i in cluster_formation.pids)
     # model distributions of positions for each player in formation as bivariate normal
     cluster_formation.calc_player_distributions_within_cluster_formation()
     cluster_formation.is_cluster_template = True
@@ -311,33 +327,393 @@ def generate_formation_from_sub_cluster(ctypes, all_formations, clusternums, Ama
     return cluster_formation
 
 
-def get_superliga_clusters(Amatrix, Smatrix, all_formations, formation_stats, match_tb):
-    # generates clusters for latest presentation
+def _merge_cost(xy1, cov1, xy2, cov2, squeeze, merge_cache):
+    # Hungarian_Cost ('WM') between two formations or clusters given as arrays: returns (cost, the role in the second matched to each
+    # role in the first, squeeze). Results are kept in merge_cache, keyed by the contents of the arrays
+    h = hashlib.sha1()
+    for a in [xy1, cov1, xy2, cov2, np.asarray(squeeze, dtype=float)]:
+        h.update(np.ascontiguousarray(a).tobytes())
+    key = h.hexdigest()
+    if key not in merge_cache:
+        F1 = formation_arrays()
+        F2 = formation_arrays()
+        for F, xy, C in [(F1, xy1, cov1), (F2, xy2, cov2)]:
+            F.pids = list(range(len(xy)))
+            F.team = 'C'
+            F.is_cluster_template = False
+            F.positions = xy
+            F.mu = xy
+            F.cov = C
+        c, pids1, col_ind, s = Hungarian_Cost(F1, F2, None, metric='WM', plot=False, squeeze=squeeze)
+        merge_cache[key] = (c, np.asarray(col_ind), s)
+    return merge_cache[key]
+
+
+def cluster_points(xy, merges, nformations):
+    # (roles x formations x 2) array of the node positions of every formation in a cluster, in the roles of the cluster at the top of
+    # the tree. merges are (first, second, col_ind, squeeze) for each merge: role i of the merged cluster is role i of the first
+    # and role col_ind[i] of the second, which is multiplied by squeeze. The formations are in the order they are merged (the
+    # first cluster of each merge before the second), and each is copied once into a preallocated array
+    nroles = xy.shape[1]
+    points = np.zeros((nroles, nformations, 2))
+    if len(merges) == 0:
+        points[:, 0, :] = xy[0]
+        return points
+    # walk down from the top of the tree, keeping the role of each cluster that each final role maps to and the product of the squeezes
+    stack = [(nformations + len(merges) - 1, np.arange(nroles), 1.)]
+    n = 0
+    while stack:
+        c, roles, s = stack.pop()
+        if c < nformations:
+            points[:, n, :] = xy[c][roles]*s
+            n += 1
+            continue
+        c1, c2, col_ind, squeeze = merges[c - nformations]
+        # second is pushed first so that the first is taken first
+        stack.append((c2, col_ind[roles], s*squeeze))
+        stack.append((c1, roles, s))
+    return points
+
+
+def get_superliga_clusters(Amatrix, Smatrix, all_formations, formation_stats, match_tb, clusternums=None):
+    # generates clusters for latest presentation. clusternums are the groups of dendogram clusters that are combined into each
+    # cluster template (default: the groupings used for the superliga presentation)
+    # to add new matches to these clusters without recalculating Amatrix, see Tracking_Templates.template_assigner
     ctypes = make_dendogram(Amatrix, formation_stats, t=80, method='ward')
-    clusternums = [[1], [2], [3], [4, 5], [6, 7, 8], [9], [10], [11], [12], [13, 14], [
-        15, 16], [17, 18, 19], [20], [21], [22], [23], [24], [25], [26], [27, 28]]
+    if clusternums is None:
+        clusternums = [[1], [2], [3], [4, 5], [6, 7, 8], [9], [10], [11], [12], [13, 14], [
+            15, 16], [17, 18, 19], [20], [21], [22], [23], [24], [25], [26], [27, 28]]
     nclusters = len(clusternums)
     print(nclusters)
     clustered_formations = []
+    merge_cache = {}
     for cluster in clusternums:
         print(cluster)
         clustered_formations.append(generate_formation_from_sub_cluster(
-            ctypes, all_formations, cluster, Amatrix, Smatrix, match_tb))
-    assert len(clustered_formations) == 20
+            ctypes, all_formations, cluster, Amatrix, match_tb, merge_cache=merge_cache))
+    assert len(clustered_formations) == nclusters
     return clustered_formations
 
 
-def save_clustered_formations(clustered_formations):
-    fname = "/Users/laurieshaw/Documents/Football/Data/TrackingData/Tracab/clustered_formations_WMs.pkl"
-    with open(fname, 'wb') as output:
-        pickle.dump(clustered_formations, output, pickle.HIGHEST_PROTOCOL)
-
-
-def load_clustered_formations():
-    fname = "/Users/laurieshaw/Documents/Football/Data/TrackingData/Tracab/clustered_formations_WMs.pkl"
-    with open(fname, 'rb') as input:
-        clustered_formations = pickle.load(input)
-    return clustered_formations
+def save_clustered_formations(clustered_formations, fpath):
+    # saves the cluster templates as a formation library (see save_formation_library) in the directory fpath
+    return save_formation_library(fpath, clustered_formations)
+
+
+def load_clustered_formations(fpath):
+    return formation_library(fpath).formations()
+
+
+def save_formation_library(fpath, formations, Amatrix=None, Smatrix=None, formation_stats=None):
+    # writes formations (observations and/or cluster templates) to the directory fpath as .npy arrays with a JSON manifest, rather
+    # than pickling the formation objects. The players of all the formations are stored in a single set of arrays (pids, positions,
+    # means and covariances), with player_offsets giving the rows of each formation. Cluster templates also keep their cluster
+    # distributions, the points in each role (nodes_cluster) and their ctypes. Amatrix and Smatrix (e.g. from formation_distance_matrix)
+    # are saved as .npy files that formation_library memory-maps. Lattices and per-lattice deviations are not saved.
+    # The directory is written under a temporary name and then renamed, so a partly written library is never read
+    fpath = os.path.abspath(fpath)
+    parent = os.path.dirname(fpath)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+    try:
+        arrays = formation_library_arrays(formations)
+        for k, a in arrays.items():
+            np.save(os.path.join(tmp, k+'.npy'), a)
+        matrices = []
+        for k, a in [('Amatrix', Amatrix), ('Smatrix', Smatrix)]:
+            if a is not None:
+                assert a.shape == (len(formations), len(formations))
+                np.save(os.path.join(tmp, k+'.npy'), a)
+                matrices.append(k)
+        ctypes = dict((str(i), [[_json_value(v) for v in c] for c in F.ctypes])
+                      for i, F in enumerate(formations) if hasattr(F, 'ctypes'))
+        manifest = {'version': FORMATION_LIBRARY_VERSION,
+                    'created': time.time(),
+                    'nformations': len(formations),
+                    'nplayers': len(arrays['pids']),
+                    'arrays': sorted(arrays.keys()),
+                    'matrices': matrices,
+                    'ctypes': ctypes,
+                    'formation_stats': None if formation_stats is None else [[_json_value(v) for v in f] for f in formation_stats]}
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as fp:
+            json.dump(manifest, fp, indent=1)
+        if os.path.exists(fpath):
+            shutil.rmtree(fpath)
+        os.rename(tmp, fpath)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return fpath
+
+
+def formation_library_arrays(formations):
+    # the arrays of a formation library (see save_formation_library). The cluster arrays only have rows for the players of cluster
+    # templates, given by cluster_offsets
+    nplayers = [len(F.pids) for F in formations]
+    ncluster = [len(F.pids) if F.is_cluster_template else 0 for F in formations]
+    player_offsets = np.concatenate(([0], np.cumsum(nplayers))).astype(np.int64)
+    cluster_offsets = np.concatenate(([0], np.cumsum(ncluster))).astype(np.int64)
+    P = int(player_offsets[-1])
+    arrays = {'team': np.array([F.team for F in formations], dtype='U1'),
+              'is_cluster_template': np.array([F.is_cluster_template for F in formations], dtype=bool),
+              'n_in_cluster': np.array([getattr(F, 'n_in_cluster', 0) for F in formations], dtype=np.int64),
+              'player_offsets': player_offsets,
+              'cluster_offsets': cluster_offsets,
+              'pids': np.array([pid for F in formations for pid in F.pids], dtype=np.int64).reshape(P),
+              'positions': np.zeros((P, 2)),
+              'mu': np.zeros((P, 2)),
+              'cov': np.zeros((P, 2, 2)),
+              'cluster_mu': np.zeros((int(cluster_offsets[-1]), 2)),
+              'cluster_cov': np.zeros((int(cluster_offsets[-1]), 2, 2))}
+    points = []
+    for F, i0, i1, c0, c1 in zip(formations, player_offsets[:-1], player_offsets[1:], cluster_offsets[:-1], cluster_offsets[1:]):
+        arrays['positions'][i0:i1] = formation_positions(F)
+        arrays['mu'][i0:i1], arrays['cov'][i0:i1] = formation_covariances(F)
+        if F.is_cluster_template:
+            arrays['cluster_mu'][c0:c1], arrays['cluster_cov'][c0:c1] = formation_covariances(F, cluster=True)
+            points += [np.asarray(F.nodes_cluster[pid], dtype=float).reshape(-1, 2) for pid in F.pids]
+    arrays['cluster_points_offsets'] = np.concatenate(([0], np.cumsum([len(p) for p in points]))).astype(np.int64)
+    arrays['cluster_points'] = np.vstack(points) if points else np.zeros((0, 2))
+    return arrays
+
+
+class formation_library(object):
+    # a formation library written by save_formation_library. The arrays are memory-mapped when they are first used, and formations
+    # are only built when asked for: formation(i) for a single formation (e.g. one cluster template), formations() for all of them,
+    # or arrays(i) for the formation_arrays snapshot used by the cost metrics. Amatrix and Smatrix are memory-mapped
+    # Nothing is unpickled (the arrays are loaded with allow_pickle=False)
+    def __init__(self, fpath, mmap_mode='r'):
+        self.fpath = fpath
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(fpath, 'manifest.json'), 'r') as fp:
+            self.manifest = json.load(fp)
+        if self.manifest['version'] != FORMATION_LIBRARY_VERSION:
+            raise ValueError("formation library version %s, expected %d" %
+                             (self.manifest['version'], FORMATION_LIBRARY_VERSION))
+        self._arrays = {}
+
+    def __len__(self):
+        return self.manifest['nformations']
+
+    def array(self, name):
+        if name not in self._arrays:
+            if name not in self.manifest['arrays'] and name not in self.manifest['matrices']:
+                raise KeyError("formation library %s has no array '%s'" % (self.fpath, name))
+            self._arrays[name] = np.load(os.path.join(
+                self.fpath, name+'.npy'), mmap_mode=self.mmap_mode, allow_pickle=False)
+        return self._arrays[name]
+
+    @property
+    def Amatrix(self):
+        return self.array('Amatrix')
+
+    @property
+    def Smatrix(self):
+        return self.array('Smatrix')
+
+    @property
+    def formation_stats(self):
+        fstats = self.manifest['formation_stats']
+        return None if fstats is None else [tuple(f) for f in fstats]
+
+    @property
+    def templates(self):
+        # indices of the cluster templates
+        return np.flatnonzero(self.array('is_cluster_template'))
+
+    def arrays(self, i):
+        # formation_arrays snapshot of formation i, without building the formation
+        return self.snapshots([i])[0]
+
+    def formation(self, i):
+        # formation i, with its nodes and distributions (and, for a cluster template, its cluster distributions, nodes_cluster and ctypes)
+        return self.formations([i])[0]
+
+    def formations(self, indices=None):
+        indices = range(len(self)) if indices is None else indices
+        formations = []
+        for i, S in zip(indices, self.snapshots(indices)):
+            F = formation(S.team)
+            F.is_cluster_template = S.is_cluster_template
+            F.pids = S.pids
+            F.nodes = {}
+            F.formation_distributions = {}
+            positions = S.positions.tolist()
+            for pid, (x, y), mu, cov in zip(S.pids, positions, S.mu, S.cov):
+                F.nodes[pid] = node(pid, x, y)
+                F.formation_distributions[pid] = (mu, cov)
+            if len(positions) > 0:  # as calc_formation_bounds
+                x, y = zip(*positions)
+                F.bounds = (min(x), max(x), min(y), max(y))
+            n_in_cluster = int(self.array('n_in_cluster')[i])
+            if n_in_cluster > 0:
+                F.n_in_cluster = n_in_cluster
+            if S.is_cluster_template:
+                F.cluster_formation_distributions = {}
+                F.nodes_cluster = {}
+                for k, pid in enumerate(S.pids):
+                    F.cluster_formation_distributions[pid] = (S.cluster_mu[k], S.cluster_cov[k])
+                    F.nodes_cluster[pid] = S.nodes_cluster[k]
+                if str(i) in self.manifest['ctypes']:
+                    F.ctypes = [tuple(c) for c in self.manifest['ctypes'][str(i)]]
+            formations.append(F)
+        return formations
+
+    def snapshots(self, indices=None):
+        # formation_arrays of the formations in indices (default: all), e.g. for formation_distance_matrix. This is much faster than
+        # building the formations. The player arrays are read in a single slice, from the first to the last formation in indices
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices, dtype=np.int64).reshape(-1)
+        if len(indices) == 0:
+            return []
+        offsets = self.array('player_offsets')
+        coffsets = self.array('cluster_offsets')
+        i0, i1 = int(indices.min()), int(indices.max())+1
+        rows = slice(int(offsets[i0]), int(offsets[i1]))
+        crows = slice(int(coffsets[i0]), int(coffsets[i1]))
+        offsets = np.asarray(offsets[i0:i1+1]) - rows.start
+        coffsets = np.asarray(coffsets[i0:i1+1]) - crows.start
+        pids = np.asarray(self.array('pids')[rows]).tolist()
+        arrays = dict((k, np.array(self.array(k)[rows])) for k in ['positions', 'mu', 'cov'])
+        carrays = dict((k, np.array(self.array(k)[crows])) for k in ['cluster_mu', 'cluster_cov'])
+        team = np.asarray(self.array('team')[i0:i1]).tolist()
+        is_template = np.asarray(self.array('is_cluster_template')[i0:i1]).tolist()
+        snapshots = []
+        for i in (indices - i0).tolist():
+            S = formation_arrays()
+            a, b = offsets[i], offsets[i+1]
+            S.pids = pids[a:b]
+            S.team = team[i]
+            S.is_cluster_template = is_template[i]
+            S.positions, S.mu, S.cov = arrays['positions'][a:b], arrays['mu'][a:b], arrays['cov'][a:b]
+            if S.is_cluster_template:
+                c, d = coffsets[i], coffsets[i+1]
+                S.cluster_mu, S.cluster_cov = carrays['cluster_mu'][c:d], carrays['cluster_cov'][c:d]
+                poffsets = self.array('cluster_points_offsets')[crows.start+c:crows.start+d+1]
+                S.nodes_cluster = [np.array(self.array('cluster_points')[poffsets[k]:poffsets[k+1]]) for k in range(d-c)]
+            snapshots.append(S)
+        return snapshots
+
+
+def formation_distance_matrix(formations, metric='WM', squeeze=[0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5], n_jobs=None, tile_size=256, checkpoint=None, progress=True):
+    # matrix of Hungarian_Cost between every pair of formations (as Amatrix and Smatrix in clustering_example.py): returns
+    # (Amatrix, Smatrix), the (nformations x nformations) cost and best squeeze value, filled in symmetrically from the upper triangle
+    # The upper triangle is split into tile_size x tile_size tiles that are computed in a pool of n_jobs processes (default: one per
+    # cpu, 1 to run in this process) from compact array snapshots of the formations (see formation_arrays). If checkpoint is a
+    # directory, the matrices are memory-mapped .npy files in it and each tile is saved as soon as it is finished: calling this again
+    # with the same checkpoint directory (and the same formations, metric and squeeze) only computes the tiles that are missing.
+    # Scripts that use n_jobs > 1 need an if __name__ == '__main__' guard, as the workers may import the calling script
+    snapshots = [f if isinstance(f, formation_arrays) else formation_arrays(f) for f in formations]
+    n = len(snapshots)
+    starts = list(range(0, n, tile_size))
+    tiles = [(bi, bj) for bi in range(len(starts)) for bj in range(bi, len(starts))]
+    Amatrix, Smatrix, done = _open_distance_matrices(
+        checkpoint, snapshots, metric, squeeze, tile_size, len(starts))
+    todo = [(bi, bj) for bi, bj in tiles if not done[bi, bj]]
+    if progress and len(todo) < len(tiles):
+        print("resuming from checkpoint: %d of %d tiles already done" % (len(tiles)-len(todo), len(tiles)))
+
+    def tile_args(bi, bj):
+        rows = range(starts[bi], min(n, starts[bi]+tile_size))
+        cols = range(starts[bj], min(n, starts[bj]+tile_size))
+        return (rows.start, cols.start, [snapshots[i] for i in rows], [snapshots[j] for j in cols], metric, squeeze, bi == bj)
+
+    def save_tile(bi, bj, result):
+        i0, j0, A, S = result
+        ni, nj = A.shape
+        Amatrix[i0:i0+ni, j0:j0+nj] = A
+        Smatrix[i0:i0+ni, j0:j0+nj] = S
+        Amatrix[j0:j0+nj, i0:i0+ni] = A.T
+        Smatrix[j0:j0+nj, i0:i0+ni] = S.T
+        if checkpoint is not None:  # the tile must be on disk before it is marked as done
+            Amatrix.flush()
+            Smatrix.flush()
+        done[bi, bj] = True
+        if checkpoint is not None:
+            done.flush()
+        if progress:
+            print("distance matrix: %d of %d tiles" % (np.sum(done[np.triu_indices(len(starts))]), len(tiles)))
+
+    if n_jobs == 1:
+        for bi, bj in todo:
+            save_tile(bi, bj, _distance_tile(*tile_args(bi, bj)))
+    else:
+        with futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            # keep a few tiles per worker queued, rather than sending every tile (and its formations) at once
+            nqueue = 2*(n_jobs if n_jobs is not None else os.cpu_count())
+            todo = list(reversed(todo))
+            jobs = {}
+            while todo or jobs:
+                while todo and len(jobs) < nqueue:
+                    bi, bj = todo.pop()
+                    jobs[executor.submit(_distance_tile, *tile_args(bi, bj))] = (bi, bj)
+                finished, _ = futures.wait(jobs, return_when=futures.FIRST_COMPLETED)
+                for job in finished:
+                    bi, bj = jobs.pop(job)
+                    save_tile(bi, bj, job.result())
+    return Amatrix, Smatrix
+
+
+def _distance_tile(i0, j0, row_formations, col_formations, metric, squeeze, diagonal):
+    # Hungarian_Cost between every pair in a tile. On the diagonal only the pairs above the diagonal are computed
+    A = np.zeros((len(row_formations), len(col_formations)))
+    S = np.zeros((len(row_formations), len(col_formations)))
+    for i, F1 in enumerate(row_formations):
+        for j, F2 in enumerate(col_formations):
+            if diagonal and j <= i:
+                continue
+            A[i, j], pids1, pmatch, S[i, j] = Hungarian_Cost(
+                F1, F2, None, metric=metric, squeeze=squeeze)
+    if diagonal:  # the lower triangle is filled in from the upper triangle when the tile is saved
+        A = np.triu(A) + np.triu(A, 1).T
+        S = np.triu(S) + np.triu(S, 1).T
+    return i0, j0, A, S
+
+
+def _open_distance_matrices(checkpoint, snapshots, metric, squeeze, tile_size, ntiles):
+    # the cost and squeeze matrices and the (ntiles x ntiles) record of finished tiles, in memory or memory-mapped in checkpoint
+    n = len(snapshots)
+    if checkpoint is None:
+        return np.zeros((n, n)), np.zeros((n, n)), np.zeros((ntiles, ntiles), dtype=bool)
+    h = hashlib.sha1()
+    for f in snapshots:
+        h.update(np.ascontiguousarray(f.positions).tobytes())
+    manifest = {'nformations': n, 'metric': metric, 'squeeze': [float(s) for s in squeeze],
+                'tile_size': tile_size, 'formations': h.hexdigest()}
+    fmanifest = os.path.join(checkpoint, 'manifest.json')
+    files = [os.path.join(checkpoint, f) for f in ['Amatrix.npy', 'Smatrix.npy', 'tiles_done.npy']]
+    if os.path.exists(fmanifest):
+        with open(fmanifest, 'r') as fp:
+            previous = json.load(fp)
+        if previous != manifest:
+            raise ValueError("checkpoint %s was made with different formations or parameters" % (checkpoint))
+        Amatrix, Smatrix, done = [np.load(f, mmap_mode='r+') for f in files]
+    else:
+        if not os.path.exists(checkpoint):
+            os.makedirs(checkpoint)
+        Amatrix = np.lib.format.open_memmap(files[0], mode='w+', dtype=float, shape=(n, n))
+        Smatrix = np.lib.format.open_memmap(files[1], mode='w+', dtype=float, shape=(n, n))
+        done = np.lib.format.open_memmap(files[2], mode='w+', dtype=bool, shape=(ntiles, ntiles))
+        done.flush()
+        # the manifest is written last, so a checkpoint without one is started again
+        with open(fmanifest, 'w') as fp:
+            json.dump(manifest, fp, indent=1)
+    return Amatrix, Smatrix, done
+
+
+class formation_arrays(object):
+    # compact snapshot of the arrays of a formation that the cost metrics use (see Cost_Tensor), to send to worker processes
+    # F=None gives an empty snapshot, to be filled in (see formation_library.arrays)
+    def __init__(self, F=None):
+        if F is None:
+            return
+        self.pids = list(F.pids)
+        self.team = F.team
+        self.is_cluster_template = F.is_cluster_template
+        self.positions = formation_positions(F)
+        self.mu, self.cov = formation_covariances(F)
+        if F.is_cluster_template:
+            self.cluster_mu, self.cluster_cov = formation_covariances(F, cluster=True)
 
 
 def Hungarian_Cost(F1, F2, match_tb, metric='L2', squeeze=[1.], plot=False):
@@ -347,37 +723,17 @@ def Hungarian_Cost(F1, F2, match_tb, metric='L2', squeeze=[1.], plot=False):
     pids1 = np.array(F1.pids)
     pids2 = np.array(F2.pids)
     n1 = len(pids1)
-    n2 = len(pids2)
-    if len(squeeze) > 1:  # marginalise over the squeeze paramter
-        cost = []
-        for s in squeeze:
-            C = np.zeros(shape=(n1, n2))
-            for i in range(n1):
-                pid1 = pids1[i]
-                for j in np.arange(n2):
-                    pid2 = pids2[j]
-                    C[i, j] = Cost_Metric(
-                        F1, F2, pid1, pid2, metric=metric, s=s)
-            row_ind, col_ind = linear_sum_assignment(C)
-            cost.append((s, C[row_ind, col_ind].sum(), col_ind))
-        cost = sorted(cost, key=lambda x: x[1])
-        col_ind_min = cost[0][2]
-        cost_min = cost[0][1]
-        squeeze_min = cost[0][0]
-        # print squeeze_min
-        pmatch = pids2[col_ind_min]
-    else:  # just use a single squeeze parameter. Obviously can simplify this.
-        squeeze_min = squeeze[0]
-        C = np.zeros(shape=(n1, n2))
-        for i in range(n1):
-            pid1 = pids1[i]
-            for j in range(n2):
-                pid2 = pids2[j]
-                C[i, j] = Cost_Metric(F1, F2, pid1, pid2,
-                                      metric=metric, s=squeeze_min)
-        row_ind, col_ind = linear_sum_assignment(C)
-        cost_min = C[row_ind, col_ind].sum()
-        pmatch = pids2[col_ind]
+    # marginalise over the squeeze paramter: cost matrices for every squeeze value at once, then the best assignment for each
+    C = Cost_Tensor(F1, F2, metric=metric, squeeze=squeeze)
+    cost = []
+    for k, s in enumerate(squeeze):
+        row_ind, col_ind = linear_sum_assignment(C[k])
+        cost.append((s, C[k][row_ind, col_ind].sum(), col_ind))
+    cost = sorted(cost, key=lambda x: x[1])
+    col_ind_min = cost[0][2]
+    cost_min = cost[0][1]
+    squeeze_min = cost[0][0]
+    pmatch = pids2[col_ind_min]
     if plot:
         fig, ax = vis.plot_pitch(match_tb)
         F1.plot_formation(factor=100, figax=(fig, ax), lt='ro')
@@ -390,6 +746,124 @@ def Hungarian_Cost(F1, F2, match_tb, metric='L2', squeeze=[1.], plot=False):
     return cost_min, pids1, pmatch, squeeze_min
 
 
+def Cost_Tensor(F1, F2, metric='L2', squeeze=[1.]):
+    # (squeeze x n1 x n2) array of Cost_Metric between each player in F1 (in the order of F1.pids) and each player in F2, for
+    # every squeeze value. Built by broadcasting, with the 2x2 matrix inverses, determinants and cholesky decompositions written
+    # out in closed form
+    s = np.asarray(squeeze, dtype=float)[:, np.newaxis, np.newaxis]
+    # positions: (1 x n1 x 1 x 2) and (squeeze x 1 x n2 x 2)
+    r1 = formation_positions(F1)[np.newaxis, :, np.newaxis, :]
+    r2 = formation_positions(F2)[np.newaxis, np.newaxis, :, :]*s[..., np.newaxis]
+    if metric == 'L1':
+        return np.sum(np.abs(r1-r2), axis=3)
+    elif metric == 'L2':
+        # square of Euclidean distance
+        return np.sum((r1-r2)**2, axis=3)
+    mu1, cov1 = formation_covariances(F1)
+    cov1 = cov1[np.newaxis, :, np.newaxis, :, :]
+    if metric == 'LLa':
+        # returns negative log-likelihood in which only formation 1 has an associated covariance
+        return np.log(2.*np.pi) + 0.5*np.log(det2(cov1)) + 0.5*quadratic_form2(r1-r2, inv2(cov1))
+    cluster = metric in ['LL', 'LLb'] and F2.is_cluster_template
+    mu2, cov2 = formation_covariances(F2, cluster=cluster)
+    mu2 = mu2[np.newaxis, np.newaxis, :, :]*s[..., np.newaxis]
+    cov2 = cov2[np.newaxis, np.newaxis, :, :, :]*(s*s)[..., np.newaxis, np.newaxis]
+    if metric == 'L2W':
+        # variance-weighted distance
+        d = (r1-r2)**2
+        return d[..., 0]/(cov1[..., 0, 0]+cov2[..., 0, 0]) + d[..., 1]/(cov1[..., 1, 1]+cov2[..., 1, 1])
+    elif metric == 'KL':
+        # symmetric KL divergence
+        rank = np.linalg.matrix_rank(formation_covariances(F1)[1])[np.newaxis, :, np.newaxis]
+        invcov1 = inv2(cov1)
+        invcov2 = inv2(cov2)
+        mudif = r1 - r2
+        return -1*rank + 0.5*(trace_product2(invcov2, cov1) + trace_product2(invcov1, cov2) +
+                              quadratic_form2(mudif, invcov2) + quadratic_form2(mudif, invcov1))
+    elif metric == 'WM':
+        # Wasserstein metric for bivariate normal
+        return Wasserstein_Metric_Tensor(r1, r2, cov1, cov2)
+    elif metric == 'LL':
+        # returns negative log-likelihood
+        totalcov = cov1 + cov2
+        return np.log(2.*np.pi) + 0.5*np.log(det2(totalcov)) + 0.5*quadratic_form2(r1-mu2, inv2(totalcov))
+    elif metric == 'LLb':
+        # returns negative log-likelihood in which only formation 2 has an associated covariance
+        return np.log(2.*np.pi) + 0.5*np.log(det2(cov2)) + 0.5*quadratic_form2(r1-mu2, inv2(cov2))
+    raise ValueError("unknown metric '%s'" % (metric))
+
+
+def Wasserstein_Metric_Tensor(mu1, mu2, cov1, cov2):
+    # Wasserstein metric (squared 2-Wasserstein distance) between bivariate normals, for arrays of means (... x 2) and
+    # covariances (... x 2 x 2) that broadcast together. The eigenvalues of sqrtm(C2) C1 sqrtm(C2) are those of C1 C2, so
+    # trace(sqrtm(sqrtm(C2) C1 sqrtm(C2))) = sqrt(trace(C1 C2) + 2 sqrt(det(C1) det(C2))) and no square roots of matrices are needed
+    mudif = mu1 - mu2
+    W = np.sum(mudif*mudif, axis=-1)
+    det1 = det2(cov1)
+    det12 = det2(cov2)
+    if np.any(det1 < 0) or np.any(det12 < 0):
+        raise np.linalg.LinAlgError("Matrix is not positive definite")
+    trace_sqrt = np.sqrt(np.maximum(0.0, trace_product2(cov1, cov2) + 2.0*np.sqrt(det1*det12)))
+    W = W + cov1[..., 0, 0] + cov1[..., 1, 1] + cov2[..., 0, 0] + cov2[..., 1, 1] - 2.0*trace_sqrt
+    return np.maximum(0.0, np.round(W, 5))
+
+
+def formation_positions(F):
+    # (players x 2) array of the player positions in a formation, in the order of F.pids
+    if isinstance(F, formation_arrays):
+        return F.positions
+    return np.array([[F.nodes[pid].x, F.nodes[pid].y] for pid in F.pids], dtype=float).reshape(-1, 2)
+
+
+def formation_covariances(F, cluster=False):
+    # (players x 2) means and (players x 2 x 2) covariances of the player distributions in a formation, in the order of F.pids
+    # cluster: use the distributions of a cluster template
+    if isinstance(F, formation_arrays):
+        return (F.cluster_mu, F.cluster_cov) if cluster else (F.mu, F.cov)
+    distributions = F.cluster_formation_distributions if cluster else F.formation_distributions
+    mu = np.array([distributions[pid][0] for pid in F.pids], dtype=float).reshape(-1, 2)
+    cov = np.array([distributions[pid][1] for pid in F.pids], dtype=float).reshape(-1, 2, 2)
+    return mu, cov
+
+
+def det2(C):
+    # determinants of an array of 2x2 matrices (... x 2 x 2)
+    return C[..., 0, 0]*C[..., 1, 1] - C[..., 0, 1]*C[..., 1, 0]
+
+
+def inv2(C):
+    # inverses of an array of 2x2 matrices
+    inv = np.empty(C.shape, dtype=float)
+    inv[..., 0, 0] = C[..., 1, 1]
+    inv[..., 0, 1] = -C[..., 0, 1]
+    inv[..., 1, 0] = -C[..., 1, 0]
+    inv[..., 1, 1] = C[..., 0, 0]
+    return inv/det2(C)[..., np.newaxis, np.newaxis]
+
+
+def sqrtm2(C):
+    # symmetric square roots of an array of symmetric positive (semi-)definite 2x2 matrices:
+    # sqrtm(C) = (C + sqrt(det(C)) I) / sqrt(trace(C) + 2 sqrt(det(C)))
+    sdet = np.sqrt(np.maximum(0.0, det2(C)))
+    t = np.sqrt(C[..., 0, 0] + C[..., 1, 1] + 2.0*sdet)
+    R = np.array(C, dtype=float)
+    R[..., 0, 0] += sdet
+    R[..., 1, 1] += sdet
+    with np.errstate(invalid='ignore', divide='ignore'):
+        R = R/t[..., np.newaxis, np.newaxis]
+    return np.where(t[..., np.newaxis, np.newaxis] > 0, R, 0.0)
+
+
+def trace_product2(A, B):
+    # trace(A B) for arrays of 2x2 matrices
+    return np.sum(A*np.swapaxes(B, -2, -1), axis=(-2, -1))
+
+
+def quadratic_form2(v, A):
+    # v.A.v for arrays of 2-vectors (... x 2) and 2x2 matrices (... x 2 x 2)
+    return np.sum(v*np.sum(A*v[..., np.newaxis, :], axis=-1), axis=-1)
+
+
 def Cost_Metric(F1, F2, pid1, pid2, metric='L2', s=1.):
     if metric == 'L1':
         return np.abs((F1.nodes[pid1].x-s*F2.nodes[pid2].x)) + np.abs((F1.nodes[pid1].y-s*F2.nodes[pid2].y))
@@ -416,7 +890,7 @@ def Cost_Metric(F1, F2, pid1, pid2, metric='L2', s=1.):
         cov1 = F1.formation_distributions[pid1][1]
         mu2 = np.array([F2.nodes[pid2].x, F2.nodes[pid2].y])*s
         cov2 = F2.formation_distributions[pid2][1]*s*s
-        return Wasserstein_Metric(mu1, mu2, cov1, cov2, method='fast')
+        return Wasserstein_Metric(mu1, mu2, cov1, cov2)
     elif metric == 'LL':
         # returns negative log-likelihood
         cov1 = F1.formation_distributions[pid1][1]
@@ -469,12 +943,18 @@ def Sym_KL_Divergence(mu1, mu2, cov1, cov2):
     return KLs
 
 
-def Wasserstein_Metric(mu1, mu2, cov1, cov2, method='fast'):
+def Wasserstein_Metric(mu1, mu2, cov1, cov2, method='exact'):
     # Wasserstein Metric (see wikipedia entrance)
-    if method != 'fast':
-        C2half = sqrtm(cov2)
+    # method: 'exact' uses the closed form of Wasserstein_Metric_Tensor, 'sqrtm' takes the matrix square roots explicitly (with
+    # sqrtm2) and 'fast' is the old approximation, with cholesky factors in place of the square roots and the covariance term
+    # skipped when the covariances are close (only to reproduce earlier results)
+    if method == 'exact':
+        return float(Wasserstein_Metric_Tensor(np.asarray(mu1, dtype=float), np.asarray(mu2, dtype=float),
+                                               np.asarray(cov1, dtype=float), np.asarray(cov2, dtype=float)))
+    elif method == 'sqrtm':
+        C2half = sqrtm2(cov2)
         Cmult = cov1 + cov2 - 2.0 * \
-            sqrtm(np.matmul(C2half, np.matmul(cov1, C2half)))
+            sqrtm2(np.matmul(C2half, np.matmul(cov1, C2half)))
     elif np.abs(np.sum(cov1-cov2)) < 0.01:  # for speed up
         Cmult = np.zeros((2, 2))
     else:
@@ -500,45 +980,34 @@ class formation(object):
         self.lattices = []
         self.team = team  # team in posession
         self.is_cluster_template = False  # until set True
+        self.delete_lattices()
 
     def calc_player_deviations_within_formation(self, match, nexclude=0):
         # first need to find formation centre of mass within each lattice frame
-        # do this by calculating com having iteratively excluded nexclude players to minimize cost
-        self.create_formation_deviations()
-        for lattice in self.lattices:
-            if nexclude == 0:
-                # formation com is the same as formation com
-                lattice.formation_xcom = lattice.xcom
-                lattice.formation_ycom = lattice.ycom
-            else:
-                costs = []
-                excludes = list(itertools.combinations(self.pids, nexclude))
-                for ex in excludes:
-                    ecom = lattice.get_com(ex)
-                    c = self.lattice_formation_cost(lattice, ecom, ex)
-                    costs.append((c, ecom, ex))
-                costs = sorted(costs, key=lambda x: x[0])
-                ecom = costs[0][1]
-                lattice.formation_xcom = ecom[0]
-                lattice.formation_ycom = ecom[1]
-
-            # basically a correction to the com frame in the lattice
-            com_shift_x = lattice.xcom - lattice.formation_xcom
-            com_shift_y = lattice.ycom - lattice.formation_ycom
-            ymax = match.fPitchYSizeMeters / 2.
-            xmax = match.fPitchXSizeMeters / 2.
-            for pid in self.pids:
-                # don't let positions go off edge of field.
-                # need to think about this - is it an issue?
-                dev_x = lattice.nodes[pid].x+com_shift_x
-                #dev_x = np.sign(dev_x) * np.min( [xmax,np.abs(dev_x)] )
-                dev_y = lattice.nodes[pid].y+com_shift_y
-                #dev_y = np.sign(dev_y) * np.min( [ymax,np.abs(dev_y)] )
-                # build array of all positions relative to formation CoM
-                self.formation_deviations_x[pid] = np.concatenate(
-                    (self.formation_deviations_x[pid], [dev_x]))
-                self.formation_deviations_y[pid] = np.concatenate(
-                    (self.formation_deviations_y[pid], [dev_y]))
+        # do this by calculating com having excluded the nexclude players that minimize cost (see formation_com_search)
+        index = np.array([self.lattice_index[pid] for pid in self.pids])
+        xy = self.lattice_xy[:, index, :]
+        com = self.lattice_com
+        if nexclude == 0:
+            # formation com is the same as formation com
+            ecom = com.copy()
+        else:
+            formation_xy = np.array([[self.nodes[pid].x, self.nodes[pid].y]
+                                     for pid in self.pids])
+            ecom = formation_com_search(xy, com, formation_xy, nexclude)
+        for lattice, (xcom, ycom) in zip(self.lattices, ecom.tolist()):
+            lattice.formation_xcom = xcom
+            lattice.formation_ycom = ycom
+        # basically a correction to the com frame in the lattice
+        # don't let positions go off edge of field.
+        # need to think about this - is it an issue?
+        deviations = xy + (com - ecom)[:, np.newaxis, :]
+        # build array of all positions relative to formation CoM
+        self.formation_deviations_x = {}
+        self.formation_deviations_y = {}
+        for i, pid in enumerate(self.pids):
+            self.formation_deviations_x[pid] = deviations[:, i, 0]
+            self.formation_deviations_y[pid] = deviations[:, i, 1]
         # finally, calc bivariate distributions for players
         self.calc_player_distributions_within_formation()
 
@@ -569,10 +1038,12 @@ class formation(object):
         dr2 = 0
         frame_dif_x = lattice.xcom - ecom[0]
         frame_dif_y = lattice.ycom - ecom[1]
+        xy = lattice.xy.tolist()
         for pid in self.pids:
             if pid not in pid_exclude:
-                dx = lattice.nodes[pid].x - self.nodes[pid].x + frame_dif_x
-                dy = lattice.nodes[pid].y - self.nodes[pid].y + frame_dif_y
+                x, y = xy[lattice.pid_index[pid]]
+                dx = x - self.nodes[pid].x + frame_dif_x
+                dy = y - self.nodes[pid].y + frame_dif_y
                 # this is the difference between the lattice position and the formation position for that player
                 dr2 += dx*dx + dy*dy
         return dr2
@@ -580,14 +1051,60 @@ class formation(object):
     def add_latice(self, lattice):
         if len(self.lattices) == 0:
             self.pids = set(lattice.pids)
+            # order of the players in the stacked lattice arrays
+            self.lattice_pids = list(lattice.pids)
+            self.lattice_index = dict((p, i) for i, p in enumerate(self.lattice_pids))
         else:
             if set(lattice.pids) != self.pids:
                 print(set(lattice.pids), self.pids)
                 assert False
         self.lattices.append(lattice)
+        self.stack_lattice(lattice)
+
+    def stack_lattice(self, lattice):
+        # copies the lattice positions and edges into the (lattices x players x 2) and (lattices x players x players x 2) buffers,
+        # in the order of lattice_pids. The buffers double in size when they are full
+        n = len(self.lattices)
+        if n > len(self._lattice_xy):
+            nplayers = len(self.lattice_pids)
+            size = max(16, 2*len(self._lattice_xy))
+            xy = np.zeros((size, nplayers, 2), dtype=float)
+            edges = np.zeros((size, nplayers, nplayers, 2), dtype=float)
+            com = np.zeros((size, 2), dtype=float)
+            if n > 1:
+                xy[:n-1] = self._lattice_xy[:n-1]
+                edges[:n-1] = self._lattice_edges[:n-1]
+                com[:n-1] = self._lattice_com[:n-1]
+            self._lattice_xy, self._lattice_edges, self._lattice_com = xy, edges, com
+        if lattice.pids == self.lattice_pids:
+            self._lattice_xy[n-1] = lattice.xy
+            self._lattice_edges[n-1] = lattice.edges
+        else:
+            order = np.array([lattice.pids.index(p) for p in self.lattice_pids])
+            self._lattice_xy[n-1] = lattice.xy[order]
+            self._lattice_edges[n-1] = lattice.edges[order][:, order]
+        self._lattice_com[n-1] = lattice.xcom, lattice.ycom
+
+    @property
+    def lattice_xy(self):
+        # (lattices x players x 2) player positions relative to the lattice centre of mass
+        return self._lattice_xy[:len(self.lattices)]
+
+    @property
+    def lattice_edges(self):
+        # (lattices x players x players x 2) vectors between the players in each lattice
+        return self._lattice_edges[:len(self.lattices)]
+
+    @property
+    def lattice_com(self):
+        # (lattices x 2) centre of mass of each lattice
+        return self._lattice_com[:len(self.lattices)]
 
     def delete_lattices(self):
         self.lattices = []
+        self._lattice_xy = np.zeros((0, 0, 2), dtype=float)
+        self._lattice_edges = np.zeros((0, 0, 0, 2), dtype=float)
+        self._lattice_com = np.zeros((0, 2), dtype=float)
 
     def assign_neighbour_position(self, pid, n_neighbours):
         for i in range(n_neighbours):
@@ -633,40 +1150,32 @@ class formation(object):
 
     def calc_average_lattice(self, match, n_neighbours=3, nexclude=1):
         # the key method for averaging together lattices to get a formation observation
+        pids = list(self.pids)
+        index = np.array([self.lattice_index[p] for p in pids])
+        # median x diff and y diff between each pair of players over all the lattices: median[i, j] is pids[j] relative to pids[i]
+        median = np.median(
+            self.lattice_edges[:, index[:, np.newaxis], index[np.newaxis, :], :], axis=0)
+        dist = np.sqrt(median[:, :, 0]*median[:, :, 0] +
+                       median[:, :, 1]*median[:, :, 1])
+        np.fill_diagonal(dist, np.inf)
+        # sort by nearest neighbours (each player is its own furthest neighbour, so drop the last column)
+        nearest = np.argsort(dist, axis=1, kind='mergesort')[:, :-1]
+        # local density is the distance to the n_neighbours'th nearest neighbour
+        density = np.partition(dist, n_neighbours-1, axis=1)[:, n_neighbours-1]
+        # sort nodes by local density
+        order = np.argsort(density, kind='mergesort')
+        xy = place_nodes(median, nearest, order, n_neighbours)
+        self.pids = [pids[i] for i in order]
         self.nodes = {}
-        for p in self.pids:
-            newnode = node(p, np.nan, np.nan)
-            for n in self.pids:
+        for i, p in enumerate(pids):
+            newnode = node(p, xy[i, 0], xy[i, 1])
+            for j, n in enumerate(pids):
                 if n != p:
-                    px = []
-                    py = []
-                    for lattice in self.lattices:
-                        # print lattice.nodes[p].neighbours.keys()
-                        px.append(lattice.nodes[p].neighbours[n][1])  # x diff
-                        py.append(lattice.nodes[p].neighbours[n][2])  # y diff
-                    newnode.add_neighbour(n, np.median(px), np.median(py))
-            # sort by nearest neighbours
-            newnode.sort_neighbours()
-            newnode.calc_local_density(n_neighbours)
+                    newnode.add_neighbour(n, median[i, j, 0], median[i, j, 1])
+            newnode.nearest_neighours = [
+                newnode.neighbours[pids[j]] for j in nearest[i]]
+            newnode.local_density = density[i]
             self.nodes[p] = newnode
-        self.pids = list(self.pids)
-        # print self.pids
-        # sort nodes by local density
-        self.pids = sorted(
-            self.pids, key=lambda x: self.nodes[x].local_density, reverse=False)
-        # start with highest density node in the lattice: call that the primary node (0,0)
-        # print self.pids
-        self.nodes[self.pids[0]].x = 0.0
-        self.nodes[self.pids[0]].y = 0.0
-        for pid in self.pids:
-            # if node already has a position, use it to determine neighbour positions from averaged vectors
-            if self.nodes[pid].has_position():
-                self.assign_neighbour_position(pid, n_neighbours=n_neighbours)
-        # now fill in any nodes without positions
-        for pid in self.pids:
-            if not self.nodes[pid].has_position():
-                # print "%d has no position" % (pid)
-                self.find_nearest_neighbour_with_position(pid)
         # now everyone should have a position in the formation
         # finally transform to com frame of lattice
         self.to_com_frame()
@@ -737,16 +1246,68 @@ class formation(object):
         return np.array(xydata)
 
 
+def formation_com_search(xy, com, formation_xy, nexclude, chunk=1024):
+    # centre of mass of each lattice, having excluded the nexclude players that give the best fit to the formation
+    # xy: (lattices x players x 2) positions relative to the lattice com, com: (lattices x 2) lattice com, formation_xy: (players x 2)
+    # formation positions. The cost of excluding a subset of players is the summed squared distance of the other players from their
+    # formation positions, once the lattice is shifted to the com of the other players (see formation.lattice_formation_cost).
+    # Every subset is evaluated for every lattice at once, chunk lattices at a time. Ties go to the first subset in
+    # itertools.combinations order. Returns the (lattices x 2) com of the best subset in each lattice
+    nlattices, nplayers = xy.shape[:2]
+    excludes = np.array(list(itertools.combinations(range(nplayers), nexclude)))
+    # keep[k, i] is False if player i is in the k'th subset
+    keep = np.ones((len(excludes), nplayers), dtype=bool)
+    keep[np.arange(len(excludes))[:, np.newaxis], excludes] = False
+    mask = keep[np.newaxis, :, :, np.newaxis]
+    ecom = np.zeros((nlattices, 2), dtype=float)
+    for start in range(0, nlattices, chunk):
+        x = xy[start:start+chunk, np.newaxis, :, :]
+        c = com[start:start+chunk, np.newaxis, :]
+        # (lattices x subsets x 2) com with each subset excluded
+        subset_com = np.sum(np.where(mask, x + c[:, :, np.newaxis, :], 0.),
+                            axis=2)/float(nplayers-nexclude)
+        d = x - formation_xy + (c - subset_com)[:, :, np.newaxis, :]
+        cost = np.sum(np.where(mask[:, :, :, 0], d[..., 0]*d[..., 0] + d[..., 1]*d[..., 1], 0.), axis=2)
+        best = np.argmin(cost, axis=1)
+        ecom[start:start+chunk] = subset_com[np.arange(len(best)), best]
+    return ecom
+
+
+def place_nodes(median, nearest, order, n_neighbours):
+    # positions of the players in a formation from the median vectors between them (see formation.calc_average_lattice)
+    # start with highest density node in the lattice (the first in order): call that the primary node (0,0). Then, in order,
+    # each node that has a position places those of its n_neighbours nearest neighbours that don't have one yet. Finally
+    # any node still without a position is placed from its nearest neighbour that has one
+    xy = np.nan*np.zeros((len(order), 2))
+    placed = np.zeros(len(order), dtype=bool)
+    xy[order[0]] = 0.
+    placed[order[0]] = True
+    for i in order:
+        if placed[i]:
+            for j in nearest[i, :n_neighbours]:
+                if not placed[j]:
+                    xy[j] = xy[i] + median[i, j]
+                    placed[j] = True
+    for i in order:
+        if not placed[i]:
+            j = nearest[i][placed[nearest[i]]][0]
+            xy[i] = xy[j] - median[i, j]
+            placed[i] = True
+    return xy
+
+
 class lattice(object):
     # contains a lattice of player positions. Can be from a single frame, or an aggregated posession window
+    # xy is a (players x 2) array of the player positions relative to the lattice centre of mass, in the order of pids, and
+    # edges is the (players x players x 2) array of the vectors between them: edges[i, j] is the position of pids[j] relative to pids[i]
     def __init__(self, pos_type, team_parity, timestamp, players, exclude):
         self.pos_type = 1 if pos_type == 'A' else -1
         self.period_sign = self.pos_type * team_parity
         self.players = players
         self.pids = [p for p in self.players.keys() if p not in exclude]
+        self.pid_index = dict((p, i) for i, p in enumerate(self.pids))
         self.timestamp = timestamp
         self.exclude = exclude
-        self.nodes = {}
         self.formation_offset_nodes = {}
         self.add_nodes()
         self.calc_com()
@@ -755,58 +1316,50 @@ class lattice(object):
 
     def add_nodes(self):
         # player positions in formation
-        for p in self.pids:
-            px = self.players[p].pos_x/100.*self.period_sign
-            py = self.players[p].pos_y/100.*self.period_sign
-            self.nodes[p] = node(p, px, py)
+        self.xy = np.array([[self.players[p].pos_x, self.players[p].pos_y]
+                            for p in self.pids], dtype=float).reshape(-1, 2)/100.*self.period_sign
+
+    @property
+    def nodes(self):
+        # node objects for each player, with the vectors to their neighbours. Built when asked for: the arrays are used internally
+        nodes = {}
+        for i, p in enumerate(self.pids):
+            nodes[p] = node(p, self.xy[i, 0], self.xy[i, 1])
+            for j, n in enumerate(self.pids):
+                if j != i:
+                    nodes[p].add_neighbour(
+                        n, self.edges[i, j, 0], self.edges[i, j, 1])
+        return nodes
 
     def add_formation_offset_nodes(self, pid, dx, dy):
         self.formation_offset_nodes[pid] = node(pid, dx, dy)
 
     def calc_edges(self):
         # calculate vectors between all the nodes
-        for p in self.pids:
-            for n in self.pids:
-                if p != n:
-                    dx = self.nodes[n].x - self.nodes[p].x
-                    dy = self.nodes[n].y - self.nodes[p].y
-                    self.nodes[p].add_neighbour(self.nodes[n].pid, dx, dy)
+        self.edges = self.xy[np.newaxis, :, :] - self.xy[:, np.newaxis, :]
 
     def calc_com(self):
-        self.xcom = 0.
-        self.ycom = 0.
-        for p in self.pids:
-            self.xcom += self.nodes[p].x
-            self.ycom += self.nodes[p].y
-        self.xcom = self.xcom/float(len(self.pids))
-        self.ycom = self.ycom/float(len(self.pids))
+        self.xcom, self.ycom = np.sum(self.xy, axis=0)/float(len(self.pids))
 
     def get_com(self, exclude=[]):
         xcom = 0.
         ycom = 0.
-        for p in self.pids:
+        for p, (x, y) in zip(self.pids, self.xy.tolist()):
             if p not in exclude:
-                xcom += self.nodes[p].x + self.xcom
-                ycom += self.nodes[p].y + self.ycom
+                xcom += x + self.xcom
+                ycom += y + self.ycom
         xcom = xcom/float(len(self.pids)-len(exclude))
         ycom = ycom/float(len(self.pids)-len(exclude))
         return xcom, ycom
 
     def from_com(self):
-        for p in self.pids:
-            self.nodes[p].x += self.xcom
-            self.nodes[p].y += self.ycom
+        self.xy += [self.xcom, self.ycom]
 
     def to_com(self):
-        for p in self.pids:
-            self.nodes[p].x -= self.xcom
-            self.nodes[p].y -= self.ycom
+        self.xy -= [self.xcom, self.ycom]
 
     def get_xydata(self):
-        xydata = []
-        for p in self.pids:
-            xydata.append([self.nodes[p].x, self.nodes[p].y])
-        return np.array(xydata)
+        return self.xy.copy()
 
 
 class node(object):
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:52:37 2026
+
+Module for finding the formation observations that are most similar to a given formation. Each formation is embedded as a fixed
+length vector that doesn't depend on the order of its players: its player positions and the square roots of their x and y
+variances, ordered by their (L2 Hungarian) assignment to the roles of a reference formation. The squared distance between two
+embeddings approximates the Wasserstein metric between the formations. The embeddings are stored in a KD-tree, which is used to
+pick a short list of candidates (for every squeeze value) that are then re-ranked with the exact Hungarian_Cost.
+"""
+
+import Tracking_Formation as form
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
+
+default_squeeze = [0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5]
+
+
+class formation_index(object):
+    # nearest neighbour index over formations (formation objects or formation_arrays, e.g. formation_library.snapshots()). Only
+    # formations with the same number of players as the reference (by default the first formation) are indexed: self.indices are
+    # their positions in formations. The reference is refined n_iter times by averaging the aligned formations
+    def __init__(self, formations, reference=None, metric='WM', squeeze=default_squeeze, n_iter=2):
+        self.metric = metric
+        self.squeeze = squeeze
+        snapshots = [_snapshot(F) for F in formations]
+        if reference is None:
+            reference = snapshots[0]
+        self.reference = form.formation_positions(_snapshot(reference))
+        self.nplayers = len(self.reference)
+        self.indices = np.array([i for i, S in enumerate(snapshots) if len(S.pids) == self.nplayers], dtype=int)
+        self.nformations = len(snapshots)  # every formation passed in, indexed or not
+        self.snapshots = [snapshots[i] for i in self.indices]
+        for k in range(n_iter):
+            self.embeddings = self.embed(self.snapshots)
+            self.reference = np.mean(self.embeddings, axis=0).reshape(self.nplayers, 4)[:, 0:2]
+        self.embeddings = self.embed(self.snapshots)
+        self.tree = cKDTree(self.embeddings)
+
+    def embed(self, formations, scale=1.):
+        # (nformations x 4*nplayers) embeddings: the positions and standard deviations in x and y of the players of each formation, in
+        # the order of the reference roles they are assigned to. scale multiplies the formations (as the squeeze parameter)
+        embeddings = np.zeros((len(formations), self.nplayers, 4))
+        for i, F in enumerate(formations):
+            S = _snapshot(F)
+            xy = form.formation_positions(S)*scale
+            d = xy[:, np.newaxis, :] - self.reference[np.newaxis, :, :]
+            row_ind, col_ind = linear_sum_assignment(np.sum(d*d, axis=2))
+            embeddings[i, col_ind, 0:2] = xy[row_ind]
+            embeddings[i, col_ind, 2] = np.sqrt(S.cov[row_ind, 0, 0])*scale
+            embeddings[i, col_ind, 3] = np.sqrt(S.cov[row_ind, 1, 1])*scale
+        return embeddings.reshape(len(formations), 4*self.nplayers)
+
+    def add(self, formations):
+        # adds formations to the index (the KD-tree is rebuilt). Their indices continue on from all the formations passed in so far
+        # (including those that weren't indexed), as if formations were appended to the original list
+        snapshots = [_snapshot(F) for F in formations]
+        keep = [i for i, S in enumerate(snapshots) if len(S.pids) == self.nplayers]
+        self.indices = np.concatenate((self.indices, self.nformations+np.array(keep, dtype=int)))
+        self.nformations += len(snapshots)
+        self.snapshots += [snapshots[i] for i in keep]
+        self.embeddings = np.vstack((self.embeddings, self.embed([snapshots[i] for i in keep])))
+        self.tree = cKDTree(self.embeddings)
+
+    def candidates(self, F, n):
+        # indices (into formations) of the n formations with the nearest embeddings to F
+        return self.indices[self.nearest(F, n)]
+
+    def nearest(self, F, n):
+        # rows of self.snapshots and self.embeddings of the n formations nearest to F. Hungarian_Cost compares F to each formation
+        # multiplied by a squeeze value s, and |F - s*F2|^2 = s^2 |F/s - F2|^2, so the tree is searched with F/s for every s
+        n = min(n, len(self.snapshots))
+        s = np.asarray(self.squeeze, dtype=float)
+        queries = np.vstack([self.embed([F], scale=1./si) for si in s])
+        dist, rows = self.tree.query(queries, k=n)
+        dist = (dist.reshape(len(s), n)*s[:, np.newaxis])**2
+        rows = rows.reshape(len(s), n)
+        # the best squeeze value for each formation, then the n closest formations
+        order = np.argsort(dist, axis=None, kind='mergesort')
+        unique, first = np.unique(rows.ravel()[order], return_index=True)
+        return unique[np.argsort(first, kind='mergesort')][:n]
+
+    def query(self, F, k=10, ncandidates=None):
+        # the k formations most similar to F: returns (indices, costs, squeezes), sorted by the Hungarian_Cost (self.metric) of F
+        # against each of them. Only the ncandidates (default 10*k) formations with the nearest embeddings are compared exactly
+        ncandidates = 10*k if ncandidates is None else max(k, ncandidates)
+        rows = self.nearest(F, ncandidates)
+        S = _snapshot(F)
+        costs = np.zeros(len(rows))
+        squeezes = np.zeros(len(rows))
+        for j, r in enumerate(rows):
+            costs[j], pids1, pmatch, squeezes[j] = form.Hungarian_Cost(
+                S, self.snapshots[r], None, metric=self.metric, squeeze=self.squeeze)
+        order = np.argsort(costs, kind='mergesort')[:k]
+        return self.indices[rows[order]], costs[order], squeezes[order]
+
+
+def _snapshot(F):
+    return F if isinstance(F, form.formation_arrays) else form.formation_arrays(F)
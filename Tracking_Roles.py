@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:47:18 2026
+
+Module for tracking formations frame by frame. assign_frame_roles takes a formation (usually a cluster template) and assigns each
+outfield player of a team, in every frame of a tracking_arrays store, to one of its roles. The player positions (relative to the
+team's centre of mass, and oriented as the formations in Tracking_Formation) are scored against the bivariate normal of each role
+for all the frames at once; the costs are smoothed over time to stop players flickering between roles, and then solved frame by
+frame with the Hungarian algorithm. The result is a (frames x player slots) array of role numbers.
+"""
+
+import Tracking_Arrays as ta
+import Tracking_Formation as form
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+
+def assign_frame_roles(tracking, match, template, team, squeeze=(1.,), smooth=25, exclude=None, chunk=20000):
+    # assigns the outfield players of team ('H' or 'A') in every frame of tracking (a Tracking_Arrays.tracking_arrays) to the roles
+    # of template (the formation's pids, in order: role k is template.pids[k])
+    # Returns (roles, costs, squeezes): roles is a (nframes x nslots) int8 array of the role of each player slot of the team (in the
+    # order of the team's jerseys in tracking), -1 if the player isn't on the pitch, is excluded (the goalkeepers: default
+    # match.team1_exclude/team0_exclude) or isn't assigned (more outfield players than roles). costs and squeezes are the total
+    # (smoothed) cost and the best squeeze value of each frame (nan outside the periods in match.period_parity)
+    # smooth is the number of frames that the costs are averaged over, so a player only changes role if the new role fits better
+    # for about that long. Each squeeze value is another Hungarian solve per frame
+    players, jerseys, _ = tracking.get_team(1 if team == 'H' else 0)
+    if exclude is None:
+        exclude = match.team1_exclude if team == 'H' else match.team0_exclude
+    outfield = np.flatnonzero(~np.isin(jerseys, list(exclude)))
+    mu, cov = frame_role_distributions(template)
+    roles = -1*np.ones((tracking.nframes, len(jerseys)), dtype=np.int8)
+    costs = np.full(tracking.nframes, np.nan)
+    squeezes = np.full(tracking.nframes, np.nan)
+    half = max(0, smooth//2)
+    # runs of consecutive frames in the same period: the costs are not smoothed across periods
+    starts = np.flatnonzero(np.diff(tracking.period) != 0)+1
+    for p0, p1 in zip(np.concatenate(([0], starts)), np.concatenate((starts, [tracking.nframes]))):
+        if p1 <= p0 or tracking.period[p0] not in match.period_parity:
+            continue
+        # play direction of the team in the period: formations are measured with the team attacking right->left
+        parity = match.period_parity[tracking.period[p0]]*(1 if team == 'H' else -1)
+        for f0 in range(p0, p1, chunk):
+            f1 = min(p1, f0+chunk)
+            # the costs are smoothed over the frames either side of the chunk too
+            g0 = max(p0, f0-half)
+            g1 = min(p1, f1+half)
+            xy = frame_positions(players[g0:g1, outfield, :], parity)
+            best = np.full(f1-f0, np.inf)
+            for s in squeeze:
+                C = smooth_costs(frame_role_costs(xy, mu*s, cov*s*s), smooth)[f0-g0:f1-g0]
+                r, c = solve_frame_assignments(C)
+                better = c < best
+                best[better] = c[better]
+                roles[f0:f1, outfield] = np.where(better[:, np.newaxis], r, roles[f0:f1, outfield])
+                squeezes[f0:f1][better] = s
+            costs[f0:f1] = np.where(np.isfinite(best), best, np.nan)
+    return roles, costs, squeezes
+
+
+def frame_role_distributions(template):
+    # (roles x 2) means and (roles x 2 x 2) covariances of a player's position in a single frame in each role of template: the
+    # spread of the player about their average position within a formation observation plus (for a cluster template) the spread
+    # of the average positions between the observations in the cluster
+    mu = form.formation_positions(template)
+    _, cov = form.formation_covariances(template)
+    if template.is_cluster_template:
+        _, cluster_cov = form.formation_covariances(template, cluster=True)
+        cov = cov + cluster_cov
+    return mu, cov
+
+
+def frame_positions(players, parity):
+    # (frames x players x 2) positions in metres relative to the centre of mass of the players in each frame, oriented so that the
+    # team attacks right->left (as lattice). players is a (frames x players x NPLAYER_FIELDS) array, and parity the play direction
+    # of the team (+1 or -1)
+    xy = players[:, :, ta.X:ta.Y+1]*(parity/100.)
+    with np.errstate(invalid='ignore'):
+        count = np.sum(~np.isnan(xy[:, :, 0]), axis=1)
+        com = np.nansum(xy, axis=1)/count[:, np.newaxis]
+    return xy - com[:, np.newaxis, :]
+
+
+def frame_role_costs(xy, mu, cov):
+    # (frames x players x roles) negative log-likelihood of each player position (xy: frames x players x 2) in each role (bivariate
+    # normals with means mu: roles x 2 and covariances cov: roles x 2 x 2). nan where a player isn't in the frame
+    # the quadratic form is written out for the symmetric 2x2 inverses, to keep the (frames x players x roles) temporaries few
+    dx = xy[:, :, np.newaxis, 0] - mu[:, 0]
+    dy = xy[:, :, np.newaxis, 1] - mu[:, 1]
+    icov = form.inv2(cov)
+    C = icov[:, 0, 0]*dx*dx
+    C += 2.*icov[:, 0, 1]*dx*dy
+    C += icov[:, 1, 1]*dy*dy
+    C *= 0.5
+    C += np.log(2.*np.pi) + 0.5*np.log(form.det2(cov))
+    return C
+
+
+def smooth_costs(C, window):
+    # centred moving average of the costs (frames x players x roles) over window frames. Frames in which a player isn't present
+    # don't contribute to the average, and stay nan
+    if window <= 1:
+        return C
+    valid = ~np.isnan(C)
+    csum = np.concatenate((np.zeros((1,)+C.shape[1:]), np.cumsum(np.where(valid, C, 0.), axis=0)))
+    ccount = np.concatenate((np.zeros((1,)+C.shape[1:]), np.cumsum(valid, axis=0)))
+    n = len(C)
+    lo = np.maximum(0, np.arange(n) - window//2)
+    hi = np.minimum(n, np.arange(n) - window//2 + window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        S = (csum[hi] - csum[lo])/(ccount[hi] - ccount[lo])
+    S[~valid] = np.nan
+    return S
+
+
+def solve_frame_assignments(C):
+    # Hungarian assignment of players to roles in each frame of C (frames x players x roles, nan where a player isn't present)
+    # Returns a (frames x players) array of the role of each player (-1 if not assigned) and the total cost of each frame (inf if no
+    # players are present). Frames with the same players present are solved together, without any per-frame indexing of the masks
+    roles = -1*np.ones(C.shape[0:2], dtype=np.int8)
+    total = np.full(C.shape[0], np.inf)
+    present = ~np.isnan(C[:, :, 0])
+    patterns, inverse = np.unique(np.packbits(present, axis=1), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    for k in range(len(patterns)):
+        frames = np.flatnonzero(inverse == k)
+        rows = np.flatnonzero(present[frames[0]])
+        if len(rows) == 0:
+            continue
+        block = C[frames][:, rows, :]
+        assigned = -1*np.ones((len(frames), len(rows)), dtype=np.int8)
+        for b in range(len(frames)):
+            row_ind, col_ind = linear_sum_assignment(block[b])
+            assigned[b, row_ind] = col_ind
+        roles[frames[:, np.newaxis], rows[np.newaxis, :]] = assigned
+        # total cost of each frame from the assigned players (all of them if there are no more players than roles)
+        cost = np.take_along_axis(block, np.maximum(assigned, 0)[:, :, np.newaxis], axis=2)[:, :, 0]
+        total[frames] = np.sum(np.where(assigned >= 0, cost, 0.), axis=1)
+    return roles, total
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:40:12 2026
+
+Module for assigning new formation observations to existing cluster templates. A template_assigner scores each new observation
+against the cluster templates (is_cluster_template=True formations, e.g. from Tracking_Formation.get_superliga_clusters or a saved
+formation library) with Hungarian_Cost, so adding a match costs O(templates) per observation rather than a new row of the
+season-wide distance matrix. The assignment costs of the observations are compared to those of a calibration set, and a full
+re-cluster (recluster_formations) is started in a background process only when the recent costs drift away from the calibration.
+"""
+
+import Tracking_Formation as form
+import numpy as np
+import scipy.cluster.hierarchy as sch
+import concurrent.futures as futures
+
+default_squeeze = [0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5]
+
+
+def template_costs(formations, templates, metric='LL', squeeze=default_squeeze):
+    # (nformations x ntemplates) arrays of the Hungarian_Cost of each formation against each template, and the best squeeze value
+    # With metric 'LL' this is the negative log-likelihood of the observation given the template's cluster distributions
+    # Formations with a different number of players to a template (e.g. fewer than 10 outfield players) are not scored against it
+    # (nan): the cost would sum over fewer roles, and so be biased low
+    snapshots = [T if isinstance(T, form.formation_arrays) else form.formation_arrays(T) for T in templates]
+    costs = np.full((len(formations), len(snapshots)), np.nan)
+    squeezes = np.full((len(formations), len(snapshots)), np.nan)
+    for i, F in enumerate(formations):
+        S = F if isinstance(F, form.formation_arrays) else form.formation_arrays(F)
+        for j, T in enumerate(snapshots):
+            if len(S.pids) != len(T.pids):
+                continue
+            costs[i, j], pids1, pmatch, squeezes[i, j] = form.Hungarian_Cost(
+                S, T, None, metric=metric, squeeze=squeeze)
+    return costs, squeezes
+
+
+def best_templates(costs):
+    # the lowest cost template of each formation from template_costs, and its cost: -1 and nan for formations that were not scored
+    # against any template
+    scored = ~np.all(np.isnan(costs), axis=1)
+    labels = -1*np.ones(len(costs), dtype=int)
+    labels[scored] = np.nanargmin(costs[scored], axis=1)
+    best = np.full(len(costs), np.nan)
+    best[scored] = costs[np.flatnonzero(scored), labels[scored]]
+    return labels, best
+
+
+def recluster_formations(formations, match_tb, metric='WM', t=80, method='ward', min_cluster_size=10, assign_metric='LL', squeeze=default_squeeze, n_jobs=1):
+    # full re-cluster of formations: the distance matrix (formation_distance_matrix), the dendogram cut at distance t (as in
+    # make_dendogram) and a cluster template (generate_formation_from_sub_cluster) for each cluster with at least min_cluster_size
+    # observations of 10 outfield players. Returns (templates, costs): the new templates and the assign_metric costs of every
+    # formation against them (for template_assigner.calibrate)
+    Amatrix, Smatrix = form.formation_distance_matrix(
+        formations, metric=metric, squeeze=squeeze, n_jobs=n_jobs, progress=False)
+    L = sch.linkage(sch.distance.squareform(Amatrix, checks=False), method=method)
+    fcl = sch.fcluster(L, t=t, criterion='distance', depth=2)
+    # ctypes as make_dendogram, without the match ids
+    ctypes = [(i, None, F.team, None, fcl[i]) for i, F in enumerate(formations)]
+    templates = []
+    for c in np.unique(fcl):
+        members = [i for i in np.flatnonzero(fcl == c) if len(formations[i].pids) == 10]
+        if len(members) >= max(2, min_cluster_size):
+            templates.append(form.generate_formation_from_sub_cluster(
+                ctypes, formations, [c], Amatrix, match_tb, method=method, squeeze=squeeze))
+    costs, squeezes = template_costs(formations, templates, metric=assign_metric, squeeze=squeeze)
+    return templates, costs
+
+
+class template_assigner(object):
+    # assigns formation observations to the closest of a set of cluster templates, and watches for drift in the assignment costs
+    # calibrate() sets the expected cost of an observation assigned to each template from a set of observations that are known to fit
+    # the templates (e.g. those the templates were built from): an assignment is an outlier if its cost is above the quantile
+    # of the calibration costs of its template. Drift is flagged when more than max_outlier_fraction of the last window assignments
+    # are outliers (about 1-quantile are expected)
+    def __init__(self, templates, match_tb, metric='LL', squeeze=default_squeeze, quantile=0.95, window=200, max_outlier_fraction=0.15, recluster_kwargs=None):
+        self.match_tb = match_tb  # used for the pitch size when re-clustering
+        self.metric = metric
+        self.squeeze = squeeze
+        self.quantile = quantile
+        self.window = window
+        self.max_outlier_fraction = max_outlier_fraction
+        self.recluster_kwargs = {} if recluster_kwargs is None else recluster_kwargs
+        self.set_templates(templates)
+        self.observations = []  # every formation that has been assigned (or calibrated), to re-cluster from
+        self.labels = np.zeros(0, dtype=int)
+        self.costs = np.zeros(0)
+        self.outliers = np.zeros(0, dtype=bool)
+        self.recluster_job = None
+        self.executor = None
+
+    def set_templates(self, templates):
+        if len(templates) == 0:
+            raise ValueError("template_assigner needs at least one template")
+        self.templates = list(templates)
+        self.template_snapshots = [form.formation_arrays(T) for T in self.templates]
+        self.thresholds = None  # until calibrated
+
+    def calibrate(self, formations, costs=None):
+        # sets the outlier threshold of each template from the costs of formations (which are also kept, as observations to re-cluster
+        # from). costs is the (nformations x ntemplates) template_costs, if they are already known. Templates with fewer than 10
+        # calibration observations use the threshold of all of them. Formations that can't be scored against the templates (label -1)
+        # are kept as observations but don't count towards the thresholds
+        if costs is None:
+            costs, squeezes = template_costs(formations, self.template_snapshots, metric=self.metric, squeeze=self.squeeze)
+        labels, best = best_templates(costs)
+        scored = labels >= 0
+        self.thresholds = np.full(len(self.templates), np.quantile(best[scored], self.quantile) if np.any(scored) else np.inf)
+        for k in range(len(self.templates)):
+            if np.sum(labels == k) >= 10:
+                self.thresholds[k] = np.quantile(best[labels == k], self.quantile)
+        self.observations = list(formations)
+        self.labels = labels
+        self.costs = best
+        self.outliers = self.is_outlier(labels, best)
+        return labels
+
+    def assign(self, formations, recluster=True):
+        # assigns each formation to its lowest cost template. Returns (labels, costs, squeezes): the template index, its cost and
+        # the best squeeze value of each formation (-1, nan and nan for formations with a different number of players to the
+        # templates, which are not assigned and are left out of the drift window). If the recent assignments have drifted and recluster is True, a full re-cluster
+        # of all the observations is started in a background process (see update_templates)
+        if self.thresholds is None:
+            raise ValueError("template_assigner must be calibrated before formations are assigned")
+        costs, squeezes = template_costs(formations, self.template_snapshots, metric=self.metric, squeeze=self.squeeze)
+        labels, best = best_templates(costs)
+        self.observations += list(formations)
+        self.labels = np.concatenate((self.labels, labels))
+        self.costs = np.concatenate((self.costs, best))
+        self.outliers = np.concatenate((self.outliers, self.is_outlier(labels, best)))
+        if recluster and self.drifted() and self.recluster_job is None:
+            self.start_recluster()
+        return labels, best, np.where(labels >= 0, squeezes[np.arange(len(labels)), np.maximum(labels, 0)], np.nan)
+
+    def is_outlier(self, labels, costs):
+        # assignments with a cost above the threshold of their template (False for formations that weren't assigned)
+        scored = labels >= 0
+        outliers = np.zeros(len(labels), dtype=bool)
+        outliers[scored] = costs[scored] > self.thresholds[labels[scored]]
+        return outliers
+
+    def outlier_fraction(self):
+        # fraction of the last window assignments that are outliers
+        recent = self.outliers[self.labels >= 0][-self.window:]
+        return np.mean(recent) if len(recent) > 0 else 0.
+
+    def drifted(self):
+        return np.sum(self.labels >= 0) >= self.window and self.outlier_fraction() > self.max_outlier_fraction
+
+    def start_recluster(self, background=True):
+        # re-clusters all the observations with recluster_formations, in a background process unless background is False
+        # Scripts that use the background process need an if __name__ == '__main__' guard, as the worker may import the calling script
+        args = (self.observations, self.match_tb)
+        kwargs = dict(self.recluster_kwargs)
+        kwargs.update({'assign_metric': self.metric, 'squeeze': self.squeeze})
+        if not background:
+            templates, costs = recluster_formations(*args, **kwargs)
+            if len(templates) > 0:
+                self.install_templates(templates, costs)
+            return None
+        self.executor = futures.ProcessPoolExecutor(max_workers=1)
+        self.recluster_job = self.executor.submit(recluster_formations, *args, **kwargs)
+        self.recluster_nobs = len(self.observations)
+        return self.recluster_job
+
+    def update_templates(self, wait=False):
+        # installs the templates from a finished background re-cluster (waiting for it if wait is True). Returns True if the templates
+        # were replaced: False if the re-cluster isn't finished or found no clusters (the current templates are kept). Observations assigned while the re-cluster was running are assigned again to the new templates
+        if self.recluster_job is None or not (wait or self.recluster_job.done()):
+            return False
+        job, nobs = self.recluster_job, self.recluster_nobs
+        self.recluster_job = None
+        self.executor.shutdown()
+        self.executor = None
+        templates, costs = job.result()
+        if len(templates) == 0:
+            return False
+        late = self.observations[nobs:]
+        if late:
+            late_costs, squeezes = template_costs(late, templates, metric=self.metric, squeeze=self.squeeze)
+            costs = np.vstack((costs, late_costs))
+        self.install_templates(templates, costs)
+        return True
+
+    def install_templates(self, templates, costs):
+        # replaces the templates, and calibrates them from the costs of all the observations
+        self.set_templates(templates)
+        self.calibrate(self.observations, costs=costs)
@@ -2,12 +2,13 @@
 """
 Created on Thu Mar  7 15:44:50 2019
 
-Module for measuring ball and player velocity (and acceleration, eventually) from tracking data
+Module for measuring ball and player velocity and acceleration from tracking data
 
 @author: laurieshaw
 """
 
 import numpy as np
+import Tracking_Arrays as ta
 import scipy.signal as signal
 import scipy.stats as stats
 from scipy.signal import butter, lfilter, freqz
@@ -50,175 +51,367 @@ def smooth_ball_position(frames, match, _filter='Savitzky-Golay', window=5, poly
 
 def estimate_ball_velocities(frames, match, _filter='Savitzky-Golay', window=5, polyorder=3, maxspeed=40):
     # Apply filter to ball displacement between frames to get a smooth estimate of velocity
-    x = []
-    xraw = []
-    for half in [1, 2]:  # do each half seperately
-        istart = match.period_attributes[half]['iStart']  # first frame in half
-        iend = match.period_attributes[half]['iEnd']  # last frame in half
-        nframes = iend-istart+1
-        dr = np.nan*np.zeros((nframes, 3), dtype=float)
-        dt = np.nan*np.zeros(nframes, dtype=float)
-        mask = []
-        count = 0
-        print(istart, iend)
-        for frame in frames[istart:iend+1]:
-            frame.ball_speed_filter3 = np.nan  # in 3d
-            frame.ball_speed_filter2 = np.nan  # in the x-y plane only
-            # The ball isn't necessarily in every frame, so figure out which frames it is in
-            if frame.ball:
-                mask.append(count)
-                dr[count, :] = np.array(
-                    [frame.ball_pos_x, frame.ball_pos_y, frame.ball_pos_z])/100.  # to m
-                dt[count] = frame.timestamp*60  # to seconds
-                count += 1
-        dr = np.diff(dr, axis=0)
-        dt = np.diff(dt)
-        # Calculate velocity (dr is now dr/dt)
-        for i in [0, 1, 2]:  # there must be a better way of doing this way
-            dr[:, i] = dr[:, i]/dt
-        dr_raw = dr.copy()
-        # remove anamolously high ball velocities
-        # perhaps should be nan, but this would affect surrounding frames
-        dr[np.abs(dr) > maxspeed] = 0.0
-        # Apply filters
-        dr[:, 0] = signal.savgol_filter(
-            dr[:, 0], window_length=window, polyorder=polyorder)
-        dr[:, 1] = signal.savgol_filter(
-            dr[:, 1], window_length=window, polyorder=polyorder)
-        dr[:, 2] = signal.savgol_filter(
-            dr[:, 2], window_length=window, polyorder=polyorder)
-        frames[istart].ball_vx = 0.
-        frames[istart].ball_vy = 0.
-        frames[istart].ball_vz = 0.
-        frames[istart].ball_speed_filter2 = 0
-        frames[istart].ball_speed_filter3 = 0
+    # frames is a list of (timestamped) tracab_frames or a Tracking_Arrays.tracking_arrays store
+    # The ball trajectory is split into segments at frames where the ball is missing and where the ball goes in or out of play,
+    # and each segment is filtered separately (see ball_velocities)
+    # returns frames and the ball velocity (nframes x 3, in m/s) and speed in the x-y plane and in 3d, nan where not measured
+    if isinstance(frames, ta.tracking_arrays):
+        estimate_ball_velocities_arrays(
+            frames, window=window, polyorder=polyorder, maxspeed=maxspeed)
+        v = frames.ball[:, ta.BALL_VX:ta.BALL_VZ+1]
+    else:
+        nframes = len(frames)
+        period = np.array([getattr(frame, 'period', 0) for frame in frames], dtype=int)
+        t = np.array([frame.timestamp for frame in frames], dtype=float)*60  # to seconds
+        inframe = np.array([frame.ball for frame in frames], dtype=bool)
+        r = np.nan*np.zeros((nframes, 3), dtype=float)
+        status = -1*np.ones(nframes, dtype=int)
+        ball_frames = [frame for frame in frames if frame.ball]
+        r[inframe] = [(frame.ball_pos_x, frame.ball_pos_y, frame.ball_pos_z)
+                      for frame in ball_frames]
+        status[inframe] = [ta.BALL_STATUS_CODES.get(frame.ball_status, -1)
+                           for frame in ball_frames]
+        v = ball_velocities(r/100., t, inframe, period, status,
+                            window, polyorder, maxspeed)  # to m
         # add ball velocity to frame data
-        for i in mask[1:]:
-            if frames[istart+i].ball:
-                v = dr[i-1, :]
-                frames[istart+i].ball_vx = v[0]
-                frames[istart+i].ball_vy = v[1]
-                frames[istart+i].ball_vz = v[2]
-                frames[istart+i].ball_speed_filter2 = np.sqrt(v[0]**2+v[1]**2)
-                frames[istart +
-                       i].ball_speed_filter3 = np.sqrt(v[0]**2+v[1]**2+v[2]**2)
-        x.append(dr)
-        xraw.append(dr_raw)
-    dr = np.vstack(tuple(x))
-    dr_raw = np.vstack(tuple(xraw))
-    return frames, dr, dt, dr_raw
+        for frame, p, (vx, vy, vz) in zip(frames, period, v):
+            if p in [1, 2]:
+                frame.ball_vx = vx
+                frame.ball_vy = vy
+                frame.ball_vz = vz
+                frame.ball_speed_filter2 = np.sqrt(vx**2+vy**2)
+                frame.ball_speed_filter3 = np.sqrt(vx**2+vy**2+vz**2)
+    speed2 = np.sqrt(v[:, 0]**2+v[:, 1]**2)  # in the x-y plane only
+    speed3 = np.sqrt(v[:, 0]**2+v[:, 1]**2+v[:, 2]**2)  # in 3d
+    return frames, v, speed2, speed3
 
 
 def estimate_player_velocities(team1_players, team0_players, match, _filter='Savitzky-Golay', window=7, polyorder=1, maxspeed=14):
     # Frame of interest is in the center of the window
-    # estimated velocities for players in team1
-    # TODO: add accelerations too
-    for p in team1_players.keys():  # cycle through players individually
-        nframes = len(team1_players[p].frame_targets)
-        dr = np.zeros((nframes, 2), dtype=float)
-        dt = np.zeros(nframes, dtype=float)
-        for i, frame in enumerate(team1_players[p].frame_targets):
-            dr[i, :] = np.array([frame.pos_x, frame.pos_y])/100.  # to m
-            # to seconds # FIX THIS! Add time stamps to tracab_target?
-            dt[i] = team1_players[p].frame_timestamps[i]*60
-            frame.vx = np.nan
-            frame.vy = np.nan
-            frame.speed_filter = np.nan
-        dr = np.diff(dr, axis=0)
-        dt = np.diff(dt)
-        for i in [0, 1]:
-            dr[:, i] = dr[:, i]/dt
-        # remove anamolously high ball velocities
-        # perhaps should be nan, but this would affect surrounding frames
-        dr[np.abs(dr) > maxspeed] = 0.0
-        # Apply filters
-        dr[:, 0] = signal.savgol_filter(
-            dr[:, 0], window_length=window, polyorder=polyorder)
-        dr[:, 1] = signal.savgol_filter(
-            dr[:, 1], window_length=window, polyorder=polyorder)
-        # Put velocity information back into frames
-        for i, frame in enumerate(team1_players[p].frame_targets[1:]):
-            frame.vx = dr[i, 0]
-            frame.vy = dr[i, 1]
-            frame.speed_filter = np.sqrt(frame.vx**2 + frame.vy**2)
-    # estimated velocities for players in team0
-    for p in team0_players.keys():
-        nframes = len(team0_players[p].frame_targets)
-        dr = np.zeros((nframes, 2), dtype=float)
-        dt = np.zeros(nframes, dtype=float)
-        for i, frame in enumerate(team0_players[p].frame_targets):
-            dr[i, :] = np.array([frame.pos_x, frame.pos_y])/100.  # to m
-            # to seconds # FIX THIS! Add time stamps to tracab_target?
-            dt[i] = team0_players[p].frame_timestamps[i]*60
-            frame.vx = np.nan
-            frame.vy = np.nan
-            frame.speed_filter = np.nan
-        dr = np.diff(dr, axis=0)
-        dt = np.diff(dt)
-        for i in [0, 1]:
-            dr[:, i] = dr[:, i]/dt
-        # perhaps should be nan, but this would affect surrounding frames
-        dr[np.abs(dr) > maxspeed] = 0.0
-        dr[:, 0] = signal.savgol_filter(
-            dr[:, 0], window_length=window, polyorder=polyorder)
-        dr[:, 1] = signal.savgol_filter(
-            dr[:, 1], window_length=window, polyorder=polyorder)
-        for i, frame in enumerate(team0_players[p].frame_targets[1:]):
-            frame.vx = dr[i, 0]
-            frame.vy = dr[i, 1]
-            frame.speed_filter = np.sqrt(frame.vx**2 + frame.vy**2)
-
-
-def estimate_com_frames(frames_tb, match_tb, team1exclude, team0exclude):
-    for frame in frames_tb:
-        # home team
-        players = frame.team1_players
-        frame.team1_x = 0.0
-        frame.team1_y = 0.0
-        frame.team1_vx = 0.
-        frame.team1_vy = 0.
-        nv = 0
-        pids = players.keys()
-        pids = [pid for pid in pids if pids not in team1exclude]
-        for pids in pids:
-            frame.team1_x += players[pids].pos_x
-            frame.team1_y += players[pids].pos_y
-            frame.team1_vx += players[pids].vx
-            frame.team1_vy += players[pids].vy
-            nv += 1
-        if nv > 0:
-            frame.team1_x = frame.team1_x / float(nv)
-            frame.team1_y = frame.team1_y / float(nv)
-            frame.team1_vx = frame.team1_vx / float(nv)
-            frame.team1_vy = frame.team1_vy / float(nv)
-        else:
-            frame.team1_x = np.nan
-            frame.team1_y = np.nan
-            frame.team1_vx = np.nan
-            frame.team1_vy = np.nan
-        # away team
-        players = frame.team0_players
-        frame.team0_x = 0.0
-        frame.team0_y = 0.0
-        frame.team0_vx = 0.
-        frame.team0_vy = 0.
-        nv = 0
-        pids = players.keys()
-        pids = [pid for pid in pids if pids not in team0exclude]
-        for pids in pids:
-            frame.team0_x += players[pids].pos_x
-            frame.team0_y += players[pids].pos_y
-            frame.team0_vx += players[pids].vx
-            frame.team0_vy += players[pids].vy
-            nv += 1
-        if nv > 0:
-            frame.team0_x = frame.team0_x / float(nv)
-            frame.team0_y = frame.team0_y / float(nv)
-            frame.team0_vx = frame.team0_vx / float(nv)
-            frame.team0_vy = frame.team0_vy / float(nv)
-        else:
-            frame.team0_x = np.nan
-            frame.team0_y = np.nan
-            frame.team0_vx = np.nan
-            frame.team0_vy = np.nan
+    # team1_players and team0_players are from Tracab.get_players. All players are filtered at once (see segment_velocities):
+    # each trajectory is split into the spans in which the player is on the pitch during a half
+    # see estimate_player_accelerations for accelerations
+    players = list(team1_players.values()) + list(team0_players.values())
+    if len(players) == 0:
+        return
+    t = np.asarray(players[0].frame_timestamps, dtype=float)*60  # to seconds
+    r = np.array([p.data[:, ta.X:ta.Y+1] for p in players])/100.  # to m
+    # frames outside of the halves have a timestamp of -1, and the clock restarts at the start of each half
+    valid = np.array([p.present for p in players]) & (t >= 0)
+    breaks = np.ones(len(t), dtype=bool)
+    breaks[1:] = np.diff(t) <= 0
+    v = segment_velocities(r, t, valid, breaks, window, polyorder, maxspeed)
+    # Put velocity information back into frames
+    for p, pv in zip(players, v):
+        p.set_velocities(pv[:, 0], pv[:, 1])
+
+
+def estimate_com_frames(frames_tb, match_tb, team1exclude, team0exclude, extras=False):
+    # team centre of mass position and velocity in every frame, excluding the players in team1exclude and team0exclude (e.g. the goalkeepers)
+    # frames_tb is a list of tracab_frames (the results are set as frame.team1_x, frame.team1_y, frame.team1_vx, frame.team1_vy, etc)
+    # or a Tracking_Arrays.tracking_arrays store. See estimate_com_arrays for extras
+    if isinstance(frames_tb, ta.tracking_arrays):
+        return estimate_com_arrays(frames_tb, team1exclude, team0exclude, extras=extras)
+    tracking = ta.frames_to_arrays(frames_tb)
+    estimate_com_arrays(tracking, team1exclude, team0exclude, extras=extras)
+    for k in tracking.frame_data.keys():
+        for frame, value in zip(frames_tb, tracking.frame_data[k].tolist()):
+            setattr(frame, k, value)
     return frames_tb
+
+
+def estimate_com_arrays(tracking, team1exclude, team0exclude, extras=False):
+    # team centre of mass position and velocity in every frame of a tracking_arrays store, excluding the players in team1exclude and
+    # team0exclude. Written to tracking.frame_data as team1_x, team1_y, team1_vx, team1_vy and team0_x, ... (nan if no players)
+    # If extras is True also measures the team shape (see team_com)
+    for team, exclude in [(1, team1exclude), (0, team0exclude)]:
+        players, jerseys, _ = tracking.get_team(team)
+        include = ~np.isin(jerseys, list(exclude))
+        com = team_com(players[:, include, :], extras=extras)
+        for k in com.keys():
+            tracking.frame_data['team%d_%s' % (team, k)] = com[k]
+    return tracking
+
+
+def team_com(players, extras=False):
+    # players: (nframes, nplayers, NPLAYER_FIELDS) array, nan where a player is not in the frame
+    # returns a dictionary of (nframes,) arrays: x, y (mean position) and vx, vy (mean velocity), and if extras is True
+    # length and width (extent in x and y), stretch (mean distance of the players from the centre of mass) and spread (root mean
+    # square distance from the centre of mass)
+    present = ~np.isnan(players[:, :, ta.X])
+    n = np.sum(present, axis=1)
+    moving = present & ~np.isnan(players[:, :, ta.VX]) & ~np.isnan(players[:, :, ta.VY])
+    nv = np.sum(moving, axis=1)
+    com = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for k, field, mask, count in [('x', ta.X, present, n), ('y', ta.Y, present, n), ('vx', ta.VX, moving, nv), ('vy', ta.VY, moving, nv)]:
+            com[k] = np.sum(np.where(mask, players[:, :, field], 0.), axis=1) / count
+        if extras:
+            x = players[:, :, ta.X]
+            y = players[:, :, ta.Y]
+            d = np.sqrt((x-com['x'][:, np.newaxis])**2 + (y-com['y'][:, np.newaxis])**2)
+            d = np.where(present, d, 0.)
+            com['stretch'] = np.sum(d, axis=1) / n
+            com['spread'] = np.sqrt(np.sum(d**2, axis=1) / n)
+            com['length'] = np.where(present, x, -np.inf).max(axis=1) - np.where(present, x, np.inf).min(axis=1)
+            com['width'] = np.where(present, y, -np.inf).max(axis=1) - np.where(present, y, np.inf).min(axis=1)
+            for k in ['length', 'width']:
+                com[k][n == 0] = np.nan
+    return com
+
+
+def estimate_player_velocities_arrays(tracking, window=7, polyorder=1, maxspeed=14):
+    # Estimates player velocities (in m/s) for a Tracking_Arrays.tracking_arrays store and writes them to the VX, VY fields
+    # Each player's trajectory is split into segments in which they are continuously on the pitch during a half, so that
+    # players that are not in a frame do not contaminate the velocities of the surrounding frames
+    in_play = (tracking.period == 1) | (tracking.period == 2)
+    players = np.concatenate((tracking.team1, tracking.team0), axis=1)
+    r = players[:, :, ta.X:ta.Y+1].transpose(1, 0, 2)/100.  # to m, (players, frames, 2)
+    valid = (~np.isnan(players[:, :, ta.X]) & in_play[:, np.newaxis]).T
+    v = segment_velocities(r, tracking.timestamp*60., valid, period_breaks(
+        tracking.period), window, polyorder, maxspeed)
+    n1 = tracking.team1.shape[1]
+    tracking.team1[:, :, ta.VX:ta.VY+1] = v[:n1].transpose(1, 0, 2)
+    tracking.team0[:, :, ta.VX:ta.VY+1] = v[n1:].transpose(1, 0, 2)
+    return tracking
+
+
+def estimate_ball_velocities_arrays(tracking, window=5, polyorder=3, maxspeed=40):
+    # Estimates the ball velocity (in m/s) for a Tracking_Arrays.tracking_arrays store and writes it to the BALL_VX, BALL_VY, BALL_VZ fields
+    tracking.ball[:, ta.BALL_VX:ta.BALL_VZ+1] = ball_velocities(tracking.ball[:, ta.BALL_X:ta.BALL_Z+1]/100., tracking.timestamp*60.,
+                                                                 tracking.ball_in_frame(), tracking.period, tracking.ball_status, window, polyorder, maxspeed)
+    return tracking
+
+
+def ball_velocities(r, t, inframe, period, status, window, polyorder, maxspeed):
+    # r: (nframes, 3) ball positions (m), t: (nframes,) times (s), inframe: True where the ball is in the frame, status: ball status code
+    # The ball trajectory in each half is split into segments in which the ball is continuously in the frame and either in or out
+    # of play, so that the filter does not ring across gaps or the large changes in ball position at restarts
+    valid = ((period == 1) | (period == 2)) & inframe
+    breaks = period_breaks(period)
+    breaks[1:] |= status[1:] != status[:-1]
+    v = segment_velocities(r[np.newaxis, :, :], t, valid[np.newaxis, :],
+                           breaks, window, polyorder, maxspeed)
+    return v[0]
+
+
+def estimate_player_accelerations_arrays(tracking, window=13, polyorder=3, jerk=False):
+    # Estimates player accelerations (in m/s/s) for a Tracking_Arrays.tracking_arrays store from the second derivative of a
+    # Savitzky-Golay fit to the player positions (see segment_derivatives), and the jerk (m/s/s/s) too if jerk is True
+    # returns {'team1': acc, 'team0': acc} with (nframes, nslots, 2) arrays (and 'team1_jerk', 'team0_jerk'), nan where not measured
+    in_play = (tracking.period == 1) | (tracking.period == 2)
+    players = np.concatenate((tracking.team1, tracking.team0), axis=1)
+    r = players[:, :, ta.X:ta.Y+1].transpose(1, 0, 2)/100.  # to m, (players, frames, 2)
+    valid = (~np.isnan(players[:, :, ta.X]) & in_play[:, np.newaxis]).T
+    derivs = [2, 3] if jerk else [2]
+    results = segment_derivatives(r, tracking.timestamp*60., valid, period_breaks(
+        tracking.period), window, polyorder, derivs)
+    n1 = tracking.team1.shape[1]
+    accelerations = {}
+    for deriv, d in zip(derivs, results):
+        suffix = '' if deriv == 2 else '_jerk'
+        accelerations['team1'+suffix] = d[:n1].transpose(1, 0, 2)
+        accelerations['team0'+suffix] = d[n1:].transpose(1, 0, 2)
+    return accelerations
+
+
+def estimate_player_accelerations(team1_players, team0_players, match, window=13, polyorder=3, jerk=False):
+    # as estimate_player_accelerations_arrays for the players from Tracab.get_players: sets the ax and ay (and jx, jy) masked arrays of each player
+    players = list(team1_players.values()) + list(team0_players.values())
+    if len(players) == 0:
+        return
+    t = np.asarray(players[0].frame_timestamps, dtype=float)*60  # to seconds
+    r = np.array([p.data[:, ta.X:ta.Y+1] for p in players])/100.  # to m
+    valid = np.array([p.present for p in players]) & (t >= 0)
+    breaks = np.ones(len(t), dtype=bool)
+    breaks[1:] = np.diff(t) <= 0
+    derivs = [2, 3] if jerk else [2]
+    results = segment_derivatives(
+        r, t, valid, breaks, window, polyorder, derivs)
+    for k, p in enumerate(players):
+        p.ax = np.ma.masked_invalid(results[0][k, :, 0])
+        p.ay = np.ma.masked_invalid(results[0][k, :, 1])
+        if jerk:
+            p.jx = np.ma.masked_invalid(results[1][k, :, 0])
+            p.jy = np.ma.masked_invalid(results[1][k, :, 1])
+
+
+# fields of the player event tables (see detect_player_events). istart and iend are the first and last frame of the event
+EVENT_DTYPE = [('event', 'U12'), ('istart', np.int64), ('iend', np.int64), ('start_frameid', np.int64), ('period', np.int8),
+               ('start_time', float), ('duration', float), ('peak', float), ('distance', float)]
+
+
+def detect_player_events(tracking, accelerations=None, sprint_speed=7., sprint_duration=1., acceleration=3., acceleration_duration=0.5, frame_rate=None):
+    # Finds sprints (speed above sprint_speed m/s for at least sprint_duration s) and high accelerations and decelerations (tangential
+    # acceleration above acceleration m/s/s, or below -acceleration, for at least acceleration_duration s) for every player in a
+    # tracking_arrays store with velocities measured. accelerations is from estimate_player_accelerations_arrays (measured if None).
+    # frame_rate is the match frame rate (match.iFrameRateFps); if None it is estimated from the timestamps, rounded to whole frames
+    # per second (the timestamps are floats in minutes, so the raw estimate is not exact)
+    # Returns a dictionary of event tables (structured arrays with EVENT_DTYPE fields, one row per event) keyed by (team, jersey number)
+    if accelerations is None:
+        accelerations = estimate_player_accelerations_arrays(tracking)
+    if frame_rate is None:
+        frame_rate = np.round(1./(np.median(np.diff(tracking.timestamp[tracking.timestamp >= 0]))*60.))  # frames per second
+    frame_rate = float(frame_rate)
+    breaks = period_breaks(tracking.period)
+    in_play = (tracking.period == 1) | (tracking.period == 2)
+    tables = {}
+    for team in [1, 0]:
+        players, jerseys, _ = tracking.get_team(team)
+        v = players[:, :, ta.VX:ta.VY+1].transpose(1, 0, 2)
+        a = accelerations['team%d' % (team)].transpose(1, 0, 2)
+        speed = np.sqrt(v[:, :, 0]**2 + v[:, :, 1]**2)
+        # acceleration along the direction of motion
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tangential = (a[:, :, 0]*v[:, :, 0] + a[:, :, 1]*v[:, :, 1]) / speed
+        valid = ~np.isnan(speed) & in_play[np.newaxis, :]
+        events = [event_runs('sprint', speed, speed, valid, breaks, sprint_speed, sprint_duration, frame_rate, tracking),
+                  event_runs('acceleration', tangential, speed, valid, breaks,
+                             acceleration, acceleration_duration, frame_rate, tracking),
+                  event_runs('deceleration', -tangential, speed, valid, breaks, acceleration, acceleration_duration, frame_rate, tracking)]
+        slots = np.concatenate([e[0] for e in events])
+        events = np.concatenate([e[1] for e in events])
+        order = np.lexsort((events['istart'], slots))
+        slots = slots[order]
+        events = events[order]
+        bounds = np.searchsorted(slots, np.arange(len(jerseys)+1))
+        for s, j in enumerate(jerseys):
+            tables[(team, int(j))] = events[bounds[s]:bounds[s+1]]
+    return tables
+
+
+def event_runs(name, quantity, speed, valid, breaks, threshold, min_duration, frame_rate, tracking):
+    # runs of at least min_duration seconds in which quantity (nplayers, nframes) is above threshold
+    # returns the player slot of each run and a structured array of the runs (EVENT_DTYPE)
+    with np.errstate(invalid='ignore'):
+        above = valid & (quantity > threshold)
+    starts, ends = segment_runs(above, breaks)
+    keep = (ends-starts) >= int(np.ceil(min_duration*frame_rate))
+    starts = starts[keep]
+    ends = ends[keep]
+    nframes = quantity.shape[1]
+    events = np.zeros(len(starts), dtype=EVENT_DTYPE)
+    slots = starts // nframes
+    events['event'] = name
+    events['istart'] = starts % nframes
+    events['iend'] = (ends-1) % nframes
+    events['start_frameid'] = tracking.frameid[events['istart']]
+    events['period'] = tracking.period[events['istart']]
+    events['start_time'] = tracking.timestamp[events['istart']]
+    events['duration'] = (ends-starts)/frame_rate
+    if len(starts) > 0:
+        # reduce over [start, end) of each run: reduceat over the interleaved bounds and keep every other result
+        bounds = np.ravel(np.column_stack((starts, ends)))
+        q = np.append(np.where(above, quantity, 0.).ravel(), 0.)
+        sp = np.append(np.where(above, speed, 0.).ravel(), 0.)
+        events['peak'] = np.maximum.reduceat(q, bounds)[::2]
+        events['distance'] = np.add.reduceat(sp, bounds)[::2]/frame_rate
+    return slots, events
+
+
+def period_breaks(period):
+    # True in the first frame of each period
+    breaks = np.ones(len(period), dtype=bool)
+    breaks[1:] = period[1:] != period[:-1]
+    return breaks
+
+
+def segment_velocities(r, t, valid, breaks, window, polyorder, maxspeed):
+    # r: (ntargets, nframes, ndim) positions, t: (nframes,) times in seconds, valid: (ntargets, nframes) True where the position can
+    # be used, breaks: (nframes,) True where a new segment must start (e.g. the start of a period)
+    # Returns (ntargets, nframes, ndim) velocities, nan where not valid. Velocities are measured separately in each run of
+    # consecutive valid frames: the displacements between frames are divided by the time step, anomalously high values are set
+    # to zero and the result is Savitzky-Golay filtered (as savgol_filter with mode='interp' applied to each run). Runs that are
+    # shorter than the window are not filtered. The result for a frame only depends on frames within window+1 frames of it (see
+    # Tracab.iter_tracab_frames)
+    ntargets, nframes, ndim = r.shape
+    v = np.nan*np.zeros(r.shape, dtype=float)
+    if nframes < 2:
+        return v
+    # velocity between frames i-1 and i, valid if both frames are valid and in the same segment
+    dvalid = valid[:, 1:] & valid[:, :-1] & ~breaks[np.newaxis, 1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dr = np.diff(r, axis=1) / np.diff(t)[np.newaxis, :, np.newaxis]
+    dr[~dvalid] = 0.0
+    # remove anamolously high velocities
+    dr[np.abs(dr) > maxspeed] = 0.0
+    starts, ends = segment_runs(dvalid, breaks[1:])
+    dr = filter_segments(dr, starts, ends, window, polyorder)
+    # velocity at frame i is from the displacement between frames i-1 and i, the first frame takes the velocity of the second
+    v[:, 1:][dvalid] = dr[dvalid]
+    first_frames = np.unravel_index(starts, dvalid.shape)
+    v[first_frames] = dr[first_frames]
+    return v
+
+
+def segment_derivatives(r, t, valid, breaks, window, polyorder, derivs):
+    # r: (ntargets, nframes, ndim) positions, t, valid and breaks as segment_velocities
+    # Returns a list with the deriv'th time derivative of the positions for each deriv in derivs (e.g. [2, 3] for acceleration and jerk),
+    # from a Savitzky-Golay fit to each run of consecutive valid frames. nan outside of the runs and in runs shorter than the window.
+    # Assumes a constant time step
+    steps = np.diff(t)[~breaks[1:]]
+    delta = np.median(steps[steps > 0]) if np.any(steps > 0) else 1.
+    starts, ends = segment_runs(valid, breaks)
+    return [filter_segments(r, starts, ends, window, polyorder, deriv=deriv, delta=delta) for deriv in derivs]
+
+
+def segment_runs(valid, breaks):
+    # runs of consecutive True elements of valid (ntargets, n) that do not cross a break (n,) or the start of a target
+    # returns the start and (exclusive) end of each run as indices into the flattened array
+    target_breaks = np.zeros(valid.shape, dtype=bool)
+    target_breaks[:] = breaks[np.newaxis, :]
+    target_breaks[:, 0] = True
+    return valid_segments(valid.ravel(), target_breaks.ravel())
+
+
+def filter_segments(x, starts, ends, window, polyorder, deriv=0, delta=1.):
+    # Savitzky-Golay filters x (ntargets, n, ndim) along axis 1, separately in each run (starts and ends are from segment_runs). The result
+    # is the same as savgol_filter(mode='interp') applied to each run on its own. Runs that are shorter than the window are left
+    # unfiltered (or are nan if deriv > 0). Elements outside of the runs are nan
+    shape = x.shape
+    ndim = shape[2]
+    x = x.reshape(-1, ndim)
+    out = np.nan*np.zeros(x.shape, dtype=float)
+    inrun = run_mask(starts, ends, len(x))
+    if deriv == 0:
+        out[inrun] = x[inrun]
+    x = np.where(inrun[:, np.newaxis], x, 0.)
+    # filter every target at once. Away from the ends of each run this is the same as filtering the run on its own
+    filtered = signal.savgol_filter(x.reshape(shape), window_length=window, polyorder=polyorder,
+                                    deriv=deriv, delta=delta, axis=1, mode='constant').reshape(-1, ndim)
+    long_runs = (ends-starts) >= window
+    starts = starts[long_runs]
+    ends = ends[long_runs]
+    inlong = run_mask(starts, ends, len(x))
+    out[inlong] = filtered[inlong]
+    # at the ends of each run, evaluate the polynomial fit to the first (last) window elements
+    halfwin = window // 2
+    edge = np.array([signal.savgol_coeffs(window, polyorder, deriv=deriv, delta=delta, pos=k, use='dot')
+                     for k in range(window)])
+    first = x[starts[:, np.newaxis] + np.arange(window)]
+    last = x[ends[:, np.newaxis] - window + np.arange(window)]
+    out[starts[:, np.newaxis] + np.arange(halfwin)] = np.einsum(
+        'kj,sjd->skd', edge[:halfwin], first)
+    out[ends[:, np.newaxis] - halfwin + np.arange(halfwin)] = np.einsum(
+        'kj,sjd->skd', edge[window-halfwin:], last)
+    return out.reshape(shape)
+
+
+def run_mask(starts, ends, n):
+    # boolean array of length n, True inside the runs [starts, ends)
+    inrun = np.zeros(n+1, dtype=int)
+    np.add.at(inrun, starts, 1)
+    np.add.at(inrun, ends, -1)
+    return np.cumsum(inrun[:-1]) > 0
+
+
+def valid_segments(valid, breaks):
+    # start and (exclusive) end index of each run of consecutive valid elements, where a run also ends before each break
+    valid = np.asarray(valid, dtype=bool)
+    boundary = np.ones(len(valid)+1, dtype=bool)
+    boundary[1:-1] = (valid[1:] != valid[:-1]) | breaks[1:]
+    edges = np.flatnonzero(boundary)
+    starts = edges[:-1]
+    ends = edges[1:]
+    keep = valid[starts] if len(starts) > 0 else np.zeros(0, dtype=bool)
+    return starts[keep], ends[keep]
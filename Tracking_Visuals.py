@@ -10,6 +10,7 @@ Module to visualise player positions and velocities on the pitch, including movi
 import datetime as dt
 import matplotlib.pyplot as plt
 import numpy as np
+import Tracking_Arrays as ta
 import matplotlib.animation as animation
 import graham_scan as gs
 
@@ -113,7 +114,8 @@ def get_frames_between_timestamps(frames, match, tstart, tend):
     # returns frames between two timestamps
     # tstart, tend are tuples (half [1,2], frame timestamp)
     if match.provider == 'Tracab':
-        ihalf = match.period_attributes[tstart[0]]['iStart']
+        fstart, fend = ta.get_time_index(frames, match).frame_range(tstart, tend)
+        return frames[fstart:fend]
     elif match.provider == 'SecondSpectrum':
         ihalf = match.period_framenum[tstart[0]-1]
     timestamps = np.array([f.timestamp for f in frames[ihalf:]])
@@ -126,7 +128,7 @@ def find_framenum_at_timestamp(frames, match, half, timestamp):
     # returns first frame after a given point in time
     # timestamp is a tuple (half [1,2], frame timestamp)
     if match.provider == 'Tracab':
-        ihalf = match.period_attributes[half]['iStart']
+        return ta.get_time_index(frames, match).framenum(half, timestamp)
     elif match.provider == 'SecondSpectrum':
         ihalf = match.period_framenum[half-1]
     timestamps = np.array([f.timestamp for f in frames[ihalf:]])
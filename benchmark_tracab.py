@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:40:02 2026
+
+Benchmarks for reading Tracab data. Runs on a real match if fpath/fname are set below, otherwise
+on a synthetic match written to a temporary directory.
+"""
+
+import Tracab as tracab
+import Tracking_Arrays as ta
+import numpy as np
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+# path to directory of Tracab data and match id (DSL layout). Leave fpath as None to use a synthetic match
+fpath = None
+fname = '984455'
+
+
+def write_synthetic_tracab_match(fpath, fname, half_length_mins=45., fps=25, seed=0):
+    # writes a Tracab-like .dat and metadata .xml file (DSL layout) with random-walk players and ball
+    rng = np.random.RandomState(seed)
+    nhalf = int(half_length_mins*60*fps)
+    pre, gap, post = 5*fps, 15*60*fps, 5*fps
+    first = 100000
+    start1 = first + pre
+    end1 = start1 + nhalf - 1
+    start2 = end1 + gap
+    end2 = start2 + nhalf - 1
+    nframes = end2 + post - first + 1
+    if not os.path.exists(os.path.join(fpath, fname)):
+        os.makedirs(os.path.join(fpath, fname))
+    fmetadata, fdata = tracab.get_tracabdata_paths(fpath, fname, league='DSL')
+    with open(fmetadata, 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<TracabMetaData sVersion="1.0">\n')
+        f.write('<match iId="1" dtDate="2019-07-13 18:00:00" iFrameRateFps="%d" fPitchXSizeMeters="105.00" fPitchYSizeMeters="68.00" fTrackingAreaXSizeMeters="111.00" fTrackingAreaYSizeMeters="88.00">\n' % (fps))
+        for pid, (s, e) in enumerate([(start1, end1), (start2, end2), (0, 0), (0, 0)]):
+            f.write('<period iId="%d" iStartFrame="%d" iEndFrame="%d"/>\n' % (pid+1, s, e))
+        f.write('</match>\n</TracabMetaData>\n')
+    # home team defends the right hand goal in the first half
+    home = np.vstack(([4800., 0.], rng.uniform([300, -3000], [3000, 3000], size=(10, 2))))
+    away = -1*home
+    positions = np.concatenate((home, away))[None, :, :] + \
+        np.cumsum(rng.normal(0, 5, size=(nframes, 22, 2)), axis=0)
+    ball = np.cumsum(rng.normal(0, 30, size=(nframes, 3)), axis=0)
+    ball[:, 2] = np.abs(ball[:, 2])
+    jerseys = list(range(1, 12)) + list(range(1, 12))
+    owner = rng.randint(0, 2, size=nframes)
+    owner = np.repeat(owner[::250], 250)[:nframes]
+    alive = rng.uniform(size=nframes // 500 + 1) > 0.2
+    alive = np.repeat(alive, 500)[:nframes]
+    with open(fdata, 'w') as f:
+        for i in range(nframes):
+            if i == nframes // 2:  # a substitution for each team
+                jerseys[5] = 18
+                jerseys[17] = 22
+            targets = ['%d,%d,%d,%d,%d,%1.2f' % (1 if k < 11 else 0, k+1, jerseys[k], positions[i, k, 0], positions[i, k, 1], rng.uniform(0, 8))
+                       for k in range(22)]
+            targets.append('3,23,0,%d,%d,1.00' % (ball[i, 0]/2, ball[i, 1]/2))
+            line = '%d:%s;:' % (first+i, ';'.join(targets))
+            if rng.uniform() > 0.01:
+                line += '%d,%d,%d,%1.2f,%s,%s%s;:' % (ball[i, 0], ball[i, 1], ball[i, 2], rng.uniform(0, 3000), 'HA'[owner[i]],
+                                                     'Alive' if alive[i] else 'Dead', ',Whistle' if rng.uniform() < 0.01 else '')
+            f.write(line + '\n')
+    return fmetadata, fdata
+
+
+def benchmark_ingest(fdata, repeats=3):
+    # compares the line-by-line tracab_frame reader with the vectorized tracking_arrays reader
+    t_frames = min(timeit.repeat(
+        lambda: tracab.read_tracab_frames(fdata), number=1, repeat=repeats))
+    t_arrays = min(timeit.repeat(
+        lambda: tracab.read_tracab_dat(fdata), number=1, repeat=repeats))
+    # check that both readers agree
+    reference = ta.frames_to_arrays(tracab.read_tracab_frames(fdata))
+    tracking = tracab.read_tracab_dat(fdata)
+    for k in ['frameid', 'team1', 'team0', 'ball', 'ball_team', 'ball_status', 'ball_contact']:
+        np.testing.assert_array_equal(getattr(reference, k), getattr(tracking, k), err_msg=k)
+    print("Ingest of %d frames: %1.2f s (frames), %1.3f s (arrays), speed up %1.1fx" %
+          (tracking.nframes, t_frames, t_arrays, t_frames/t_arrays))
+    return t_frames, t_arrays
+
+
+def read_tracab_match_bs4(fmetadata):
+    # the old BeautifulSoup metadata reader, for comparison
+    from bs4 import BeautifulSoup
+    with open(fmetadata, "r") as f:
+        soup = BeautifulSoup(f.read(), 'xml')
+    period_attributes = {}
+    for p in soup.find_all('period'):
+        if int(p.attrs['iEndFrame']) > int(p.attrs['iStartFrame']):
+            period_attributes[int(p.attrs['iId'])] = dict(p.attrs)
+    return tracab.tracab_match(dict(soup.match.attrs), period_attributes)
+
+
+def benchmark_metadata(fmetadata, repeats=5, number=100):
+    # compares the BeautifulSoup and ElementTree metadata readers, and the time to import bs4 and Tracab in a new interpreter
+    t_bs4 = min(timeit.repeat(lambda: read_tracab_match_bs4(
+        fmetadata), number=number, repeat=repeats))/number
+    t_etree = min(timeit.repeat(lambda: tracab.read_tracab_match(
+        fmetadata), number=number, repeat=repeats))/number
+    assert read_tracab_match_bs4(fmetadata).period_attributes == tracab.read_tracab_match(
+        fmetadata).period_attributes
+    print("Metadata parse: %1.2f ms (bs4), %1.2f ms (ElementTree), speed up %1.1fx" %
+          (t_bs4*1e3, t_etree*1e3, t_bs4/t_etree))
+    t_imports = {}
+    for module in ['bs4', 'Tracab']:
+        t_imports[module] = min([_import_time(module) for r in range(repeats)])
+    print("Import in a new interpreter: %1.0f ms (bs4, no longer imported by Tracab), %1.0f ms (Tracab)" %
+          (t_imports['bs4']*1e3, t_imports['Tracab']*1e3))
+    return t_bs4, t_etree, t_imports
+
+
+def _import_time(module):
+    # wall time to start python and import module, less the time to start python
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for statement in ['pass', 'import '+module]:
+        t0 = timeit.default_timer()
+        subprocess.check_call([sys.executable, '-c', statement], cwd=cwd)
+        times.append(timeit.default_timer()-t0)
+    return times[1]-times[0]
+
+
+if __name__ == '__main__':
+    if fpath is None:
+        fpath = tempfile.mkdtemp() + '/'
+        print("Writing synthetic match to %s" % (fpath))
+        write_synthetic_tracab_match(fpath, fname)
+    fmetadata, fdata = tracab.get_tracabdata_paths(fpath, fname, league='DSL')
+    benchmark_metadata(fmetadata)
+    benchmark_ingest(fdata)
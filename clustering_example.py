@@ -11,7 +11,6 @@ import Tracking_Visuals as vis
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.cluster.hierarchy as sch
-import cPickle as pickle
 
 fpath = '/Path/To/Directory/of/Tracking/Data/'  # path to directory of Tracab data
 
@@ -87,9 +86,6 @@ print("finished calculating matrix. saving.")
 # plt.matshow(Amatrix)
 # plt.show()
 
-fname = "formation_measures.pkl"
-results = [formation_stats, all_formations, Amatrix, Smatrix]
-#results = [formation_stats,Amatrix]
-
-with open(fname, 'wb') as output:
-    pickle.dump(results, output, pickle.HIGHEST_PROTOCOL)
+# formations, distance matrices and formation_stats are saved as arrays with a JSON manifest. Read them back with
+# form.formation_library("formation_library")
+form.save_formation_library("formation_library", all_formations, Amatrix=Amatrix, Smatrix=Smatrix, formation_stats=formation_stats)
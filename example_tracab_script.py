@@ -67,18 +67,18 @@ axes2[2].set_xlabel('time (mins)')
 
 
 # EXAMPLE: make a plot of a player 2's position (home team) over the first half
-# this is a bit clumsy
+# player trajectories are masked arrays aligned to frames_tb (masked in frames the player is not in)
 fig, ax = vis.plot_pitch(match_tb)  # plot pitch
-px = np.array([f.pos_x for f in team1_players[2].frame_targets])
-py = np.array([f.pos_y for f in team1_players[2].frame_targets])
-t = np.array(team1_players[2].frame_timestamps)
+px = team1_players[2].pos_x
+py = team1_players[2].pos_y
+t = team1_players[2].frame_timestamps
 flast = vis.find_framenum_at_timestamp(
     frames_tb, match_tb, 2, 0)  # first frame of second half
 ax.plot(px[0:flast], py[0:flast], 'r.')
 
 # EXAMPLE: make a timeseries plot of player 2's velocity (x and y components) and speed over the first half
-vx = np.array([f.vx for f in team1_players[2].frame_targets])
-vy = np.array([f.vy for f in team1_players[2].frame_targets])
+vx = team1_players[2].vx
+vy = team1_players[2].vy
 fig, ax = plt.subplots()
 ax.plot(t[0:flast], vx[0:flast], 'r')
 ax.plot(t[0:flast], vy[0:flast], 'b')